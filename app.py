@@ -1,10 +1,32 @@
-from FlightRadar24.api import FlightRadar24API
+import time
+
+# מדידת זמן הייבוא של המודול כולו, כולל flask / numpy (מוצג ב-/metrics תחת startup)
+_IMPORT_STARTED = time.perf_counter()
+
 from typing import List, Dict, Tuple
-from flask import Flask, jsonify, render_template_string
+from flask import Blueprint, Flask, Response, current_app, jsonify, redirect, request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import wraps
+from types import SimpleNamespace
+from werkzeug.serving import WSGIRequestHandler, make_server
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import os
 import random
-import time
+import socket
+import struct
+import sys
+import numpy as np
+import threading
+import urllib.error
+import urllib.request
 
-app = Flask(__name__)
+# ה-routes נרשמים על blueprint; האפליקציה עצמה נבנית ב-create_app
+bp = Blueprint("radar", __name__)
 
 # HTML + JS + Leaflet במחרוזת אחת (שלא צריך קבצים חיצוניים)
 
@@ -53,6 +75,48 @@ TEMPLATE = r"""
       filter: drop-shadow(0 0 6px rgba(0,0,0,0.5));
     }
 
+    /* אשכול מטוסים (בזום רחוק) */
+    .plane-cluster {
+      width: 34px;
+      height: 34px;
+      border-radius: 50%;
+      background: rgba(30, 90, 200, 0.8);
+      border: 2px solid #fff;
+      color: #fff;
+      font-size: 13px;
+      font-weight: 700;
+      display: flex;
+      align-items: center;
+      justify-content: center;
+      box-shadow: 0 2px 6px rgba(0,0,0,0.35);
+    }
+
+    /* הודעה כשהשרת מגיש נתונים ישנים (ה-upstream לא זמין) */
+    #status {
+      position: absolute;
+      top: 10px;
+      left: 50%;
+      transform: translateX(-50%);
+      z-index: 1000;
+      background: #ffe9a8;
+      border: 1px solid #b58a00;
+      border-radius: 7px;
+      padding: 6px 12px;
+      font-size: 14px;
+      display: none;
+    }
+
+    /* כפתור שכבת הצפיפות */
+    .heatmap-toggle {
+      background: #fff;
+      border: 2px solid rgba(0,0,0,0.2);
+      border-radius: 4px;
+      padding: 4px 8px;
+      font-size: 13px;
+      cursor: pointer;
+    }
+    .heatmap-toggle-on { background: #ffd27a; }
+
 
   </style>
 
@@ -73,16 +137,29 @@ TEMPLATE = r"""
 
 <body>
 <div id="map"></div>
+<div id="status"></div>
 
 <script>
   // כל כמה שניות לרענן (מוזן מהשרת)
   const REFRESH_SECONDS = {{ refresh_seconds|tojson }};
 
+  // אופן הציור: dom (סמן לכל מטוס), canvas (הכל על canvas אחד),
+  // auto (canvas כשיש יותר מ-CANVAS_AUTO_THRESHOLD מטוסים)
+  const RENDER_MODE = {{ render_mode|tojson }};
+  const CANVAS_AUTO_THRESHOLD = 400;
+  // במצב canvas מוצגים tooltips רק לנבחר, למטוס שמתחת לעכבר ול-N הקרובים למרכז
+  const CANVAS_TOOLTIPS_NEAREST = 8;
+  // כמה מילישניות ציור מותר בכל frame לפני שממשיכים ב-frame הבא
+  const FRAME_BUDGET_MS = 8;
+  // מהזום הזה (שבו אין אשכולות) מבקשים רק את חלון המפה (/viewport) כ-diff
+  const VIEWPORT_MIN_ZOOM = {{ viewport_min_zoom|tojson }};
+
   // יצירת מפה (מרכז – ישראל)
   const map = L.map('map').setView([32.08, 34.78], 7);
 
   // שכבת רקע (OpenStreetMap)
-  L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+  // האריחים עוברים דרך ה-cache של השרת (/tiles) ולא ישירות ל-OSM
+  L.tileLayer('/tiles/{z}/{x}/{y}.png', {
     maxZoom: 19,
     attribution: '&copy; OpenStreetMap'
   }).addTo(map);
@@ -90,29 +167,13 @@ TEMPLATE = r"""
   // שכבה לסמנים
   const markersLayer = L.layerGroup().addTo(map);
 
+  // שכבה קבועה (נקודות ציון וגדרות) - נטענת ומצוירת פעם אחת בלבד
+  const LANDMARKS_URL = {{ landmarks_url|tojson }};
+  const landmarksLayer = L.layerGroup().addTo(map);
+
   // כדי לשמר בחירה בין רענונים (כי אנחנו עושים clearLayers)
   let selectedKey = null;
 
-  // מיפוי קידומת callsign לשם חברה (אפשר להרחיב)
-  const AIRLINE_BY_PREFIX = {
-    'ELY': 'El Al',
-    'LY': 'El Al',
-    'WZZ': 'Wizz Air',
-    'ISR': 'Israir',
-    'AIZ': 'Arkia',
-    'ETH': 'Ethiopian Airlines',
-    'HFA': 'Haifa Air',
-    'ICL': 'Challenge Airlines',
-    'BBG': 'Blue Bird',
-    'CYF': 'Cyprus Airways',
-    'RYR': 'Ryan Air',
-    'CYP': 'Cyprus Air',
-    'SQY': 'Vision Air',
-    'FDB': 'Fly Dubai',
-    'RJA': 'Royal Jordanian',
-    'ETD': 'Etihad'
-  };
-
   function cleanName(s) {
     return (s || '').replace(/\n/g, '').trim();
   }
@@ -126,6 +187,7 @@ TEMPLATE = r"""
 
   // key יציב למטוס: ננסה להשתמש ב-callsign (שורה 3 ב-info)
   function extractKey(p) {
+    if (p.id) return p.id;
     const parts = splitInfo(p);
     const callsign = (parts[2] || '').trim();
     if (callsign && callsign !== 'N/A') return callsign;
@@ -139,20 +201,10 @@ TEMPLATE = r"""
     return (callsign && callsign !== 'N/A') ? callsign : null;
   }
 
-  function airlineNameFromCallsign(callsign) {
-    //if (!callsign || callsign.length < 3) return null;
-    //const prefix = callsign.substring(0, 3).toUpperCase();
-    //return AIRLINE_BY_PREFIX[prefix] || null;
-    return AIRLINE_BY_PREFIX[callsign] || null;
-  }
-
-  // קביעת "כניסה/יציאה" בצורה גסה לפי המסלול ב-name
-  // - אם יש "->TLV" / "->ETM" => נכנס (מזרחה)
-  // - אם מתחיל ב "TLV->" / "ETM->" => יוצא (מערבה)
+  // "כניסה/יציאה" מחושב בשרת לפי HOME_AIRPORTS (p.direction)
   function classifyDirection(p) {
-    const name = cleanName(p.name);
-    if (name.includes('->TLV') || name.includes('->ETM')) return 'IN';
-    if (name.startsWith('TLV->') || name.startsWith('ETM->')) return 'OUT';
+    if (p.direction === 'arriving') return 'IN';
+    if (p.direction === 'departing') return 'OUT';
     return 'UNK';
   }
 
@@ -216,8 +268,8 @@ TEMPLATE = r"""
     const callsign = p.callsign //extractCallsign(p);
     const altOrOther = p.altitude || '';
 
-    //const airlineName = airlineNameFromCallsign(callsign);
-    const airlineName = AIRLINE_BY_PREFIX[p.airline];
+    // שם החברה ושם סוג המטוס מגיעים מהשרת (טבלאות ייחוס)
+    const airlineName = p.airline_name;
 
     let html = '';
     if (name) html += `<strong>${name}</strong><br>`;
@@ -232,56 +284,523 @@ TEMPLATE = r"""
 
     if (airlineName) html += `${airlineName}<br>`;
     if (callsign) html += `${callsign}<br>`;
-    if (aircraftType) html += `Aircraft type :${aircraftType}<br>`;
+    if (aircraftType) html += `Aircraft type :${p.aircraft_name || aircraftType}<br>`;
     if (speedOrOther) html += `Speed :${speedOrOther}<br>`;
     if (altOrOther) html += `Altitude :${altOrOther}`;
 
     return html.trim();
   }
 
+  // הצגת אזהרה כשהנתונים לא עדכניים
+  function showStatus(data) {
+    const el = document.getElementById('status');
+    if (data.stale) {
+      el.textContent = `הנתונים לא עדכניים (לפני ${Math.round(data.age || 0)} שניות)`;
+      el.style.display = 'block';
+    } else {
+      el.style.display = 'none';
+    }
+  }
+
+  // תזמון הבקשה הבאה: רק אחרי שהקודמת הסתיימה, ולא כשהלשונית מוסתרת.
+  // השרת מחזיר next_poll_ms (מתי יהיה מידע חדש / מתי ה-upstream יחזור)
+  let pollTimer = null;
+  let inFlight = false;
+  let reloadRequested = false;
+  // מצב /viewport: מזהה המנוי והמטוסים שיש לנו (id -> נקודה), מתעדכן מה-diff
+  let viewportSub = null;
+  const viewportPoints = new Map();
+
+  // כתובת הבקשה הבאה: זום רחוק - /data עם אשכולות, זום קרוב - רק חלון המפה
+  function dataUrl() {
+    const extra = '&ts=' + Date.now();
+    if (map.getZoom() < VIEWPORT_MIN_ZOOM) {
+      // רק השדות שהדף מציג בפועל
+      return '/data?fields=tooltip&zoom=' + map.getZoom() + extra;
+    }
+    // קצת שוליים מסביב כדי שהזזה קטנה לא תחייב בקשה
+    const b = map.getBounds().pad(0.2);
+    return '/viewport?fields=tooltip&bounds=' +
+      [b.getSouth(), b.getWest(), b.getNorth(), b.getEast()].map(v => v.toFixed(4)).join(',') +
+      (viewportSub ? '&sub=' + viewportSub : '') + extra;
+  }
+
+  // תשובת /viewport (diff) -> אותו מבנה כמו /data
+  function applyViewportDiff(data) {
+    if (data.full) viewportPoints.clear();
+    (data.remove || []).forEach(id => viewportPoints.delete(id));
+    (data.upsert || []).forEach(p => viewportPoints.set(p.id, p));
+    viewportSub = data.sub;
+    return { ...data, points: Array.from(viewportPoints.values()) };
+  }
+
+  function scheduleNext(delayMs) {
+    clearTimeout(pollTimer);
+    pollTimer = null;
+    if (document.hidden) return; // visibilitychange ימשיך כשהלשונית תחזור
+    pollTimer = setTimeout(loadData, delayMs);
+  }
+
+  document.addEventListener('visibilitychange', () => {
+    if (document.hidden) {
+      clearTimeout(pollTimer);
+      pollTimer = null;
+    } else if (!inFlight) {
+      loadData();
+    }
+  });
+
   async function loadData() {
+    // לא שולחים בקשה נוספת כל עוד הקודמת לא חזרה
+    if (inFlight) {
+      reloadRequested = true;
+      return;
+    }
+    inFlight = true;
+    clearTimeout(pollTimer);
+    let delayMs = REFRESH_SECONDS * 1000;
+
     try {
-      const res = await fetch('/data?ts=' + Date.now(), { cache: 'no-store' });
+      const url = dataUrl();
+      const res = await fetch(url, { cache: 'no-store' });
       if (!res.ok) {
+        const retryAfter = Number(res.headers.get('Retry-After'));
+        if (retryAfter > 0) delayMs = retryAfter * 1000;
         console.error('HTTP error from /data:', res.status, res.statusText);
         return;
       }
 
-      const data = await res.json();
+      let data = await res.json();
+      if (url.startsWith('/viewport')) {
+        data = applyViewportDiff(data);
+      } else {
+        viewportSub = null;
+        viewportPoints.clear();
+      }
+      showStatus(data);
+      if (typeof data.next_poll_ms === 'number') delayMs = data.next_poll_ms;
+
+      const planes = data.points || [];
+      if (RENDER_MODE === 'canvas' || (RENDER_MODE === 'auto' && planes.length > CANVAS_AUTO_THRESHOLD)) {
+        renderCanvas(data);
+      } else {
+        renderDom(data);
+      }
 
-      markersLayer.clearLayers();
+      console.log('עודכן:', new Date().toLocaleTimeString(), 'נ"ק:', (data.points || []).length);
+    } catch (err) {
+      console.error('שגיאה בטעינת הנתונים', err);
+    } finally {
+      inFlight = false;
+      if (reloadRequested) {
+        reloadRequested = false;
+        loadData();
+      } else {
+        scheduleNext(delayMs);
+      }
+    }
+  }
 
-      (data.points || []).forEach(p => {
-        if (typeof p.lat !== 'number' || typeof p.lng !== 'number') return;
+  // מצב dom: סמן (DivIcon + tooltip קבוע) לכל מטוס
+  function renderDom(data) {
+    planeCanvas.setData([], []);
+    markersLayer.clearLayers();
+
+    // בזום רחוק השרת מחזיר אשכולות - עיגול עם מספר המטוסים
+    (data.clusters || []).forEach(c => {
+      const icon = L.divIcon({
+        html: `<div class="plane-cluster">${c.count}</div>`,
+        className: '',
+        iconSize: [34, 34],
+        iconAnchor: [17, 17]
+      });
+      L.marker([c.lat, c.lng], { icon })
+        .on('click', () => map.setView([c.lat, c.lng], map.getZoom() + 2))
+        .addTo(markersLayer);
+    });
 
-        const key = extractKey(p);
-        const isSelected = (selectedKey && key && selectedKey === key);
+    (data.points || []).forEach(p => {
+      if (typeof p.lat !== 'number' || typeof p.lng !== 'number') return;
 
-        const dir = classifyDirection(p);
-        //const rot = rotationDegByDirection(dir);
+      const key = extractKey(p);
+      const isSelected = (selectedKey && key && selectedKey === key);
 
-        const ICON_BASE_HEADING = 45; // האייקון שלך מצביע 45° ימינה כברירת מחדל
+      const dir = classifyDirection(p);
+      //const rot = rotationDegByDirection(dir);
 
-        let rot = 0;
-        if (typeof p.heading === 'number') {
-          rot = (p.heading - ICON_BASE_HEADING + 360) % 360;  // <-- התיקון
-        } else {
-          rot = rotationDegByDirection(classifyDirection(p));
+      const ICON_BASE_HEADING = 45; // האייקון שלך מצביע 45° ימינה כברירת מחדל
+
+      let rot = 0;
+      if (typeof p.heading === 'number') {
+        rot = (p.heading - ICON_BASE_HEADING + 360) % 360;  // <-- התיקון
+      } else {
+        rot = rotationDegByDirection(classifyDirection(p));
+      }
+
+      const icon = makePlaneDivIcon(rot, isSelected);
+      const marker = L.marker([p.lat, p.lng], { icon });
+
+      // להעלות את הנבחר בחזית
+      if (isSelected) {
+        marker.setZIndexOffset(10000);
+      }
+
+      const html = buildTooltipHtml(p);
+      if (html) {
+        marker.bindTooltip(html, {
+          permanent: true,
+          direction: 'top',
+          offset: [0, -10],
+          opacity: 0.97,
+          className: tooltipClass(isSelected)
+        });
+      }
+
+      // בלחיצה: לסמן כנבחר (והרינדור הבא ישים אותו בחזית + class מודגש)
+      marker.on('click', () => {
+        selectedKey = key;
+        loadData(); // רינדור מחדש כדי להחיל selected על כולם
+      });
+
+      marker.addTo(markersLayer);
+    });
+  }
+
+  // מצב canvas: המטוסים והאשכולות מצוירים על canvas אחד
+  function renderCanvas(data) {
+    markersLayer.clearLayers();
+    const planes = (data.points || []).filter(p => typeof p.lat === 'number' && typeof p.lng === 'number');
+    planeCanvas.setData(planes, data.clusters || []);
+  }
+
+  // ---------------------------------------------------------------------
+  // שכבת canvas למטוסים
+  // ---------------------------------------------------------------------
+
+  // ספרייטים מסובבים מראש (כל 10 מעלות) - כל מטוס הוא drawImage אחד
+  const SPRITE_SIZE = 26;
+  const SPRITE_STEP_DEG = 10;
+  const SPRITE_BASE_HEADING = 45; // כמו ICON_BASE_HEADING במצב dom
+  const spriteImage = new Image();
+  let sprites = null;
+
+  function buildSprites() {
+    const dpr = window.devicePixelRatio || 1;
+    sprites = [];
+    for (let deg = 0; deg < 360; deg += SPRITE_STEP_DEG) {
+      const c = document.createElement('canvas');
+      c.width = c.height = Math.ceil(SPRITE_SIZE * dpr);
+      const ctx = c.getContext('2d');
+      ctx.scale(dpr, dpr);
+      ctx.translate(SPRITE_SIZE / 2, SPRITE_SIZE / 2);
+      ctx.rotate((deg - SPRITE_BASE_HEADING) * Math.PI / 180);
+      ctx.drawImage(spriteImage, -SPRITE_SIZE / 2, -SPRITE_SIZE / 2, SPRITE_SIZE, SPRITE_SIZE);
+      sprites.push(c);
+    }
+    planeCanvas.redraw();
+  }
+  spriteImage.onload = buildSprites;
+  spriteImage.src = '/static/icons/plane.jpg';
+
+  function spriteFor(heading) {
+    const h = ((typeof heading === 'number' ? heading : 0) % 360 + 360) % 360;
+    return sprites[Math.round(h / SPRITE_STEP_DEG) % sprites.length];
+  }
+
+  const HIT_CELL_PX = 32;
+  const HIT_RADIUS_PX = 14;
+
+  const PlaneCanvasLayer = L.Layer.extend({
+    initialize() {
+      this._planes = [];
+      this._clusters = [];
+      this._xs = new Float32Array(0);
+      this._ys = new Float32Array(0);
+      this._grid = new Map();
+      this._hoveredKey = null;
+      this._frame = null;
+      this._drawIndex = 0;
+    },
+
+    onAdd(map) {
+      this._map = map;
+      this._canvas = L.DomUtil.create('canvas', 'leaflet-zoom-hide');
+      this._canvas.style.position = 'absolute';
+      map.getPanes().overlayPane.appendChild(this._canvas);
+      this._tooltips = L.layerGroup().addTo(map);
+      map.on('moveend resize', this._reset, this);
+      map.on('mousemove', this._onMouseMove, this);
+      map.on('click', this._onClick, this);
+      this._reset();
+    },
+
+    onRemove(map) {
+      if (this._frame) cancelAnimationFrame(this._frame);
+      L.DomUtil.remove(this._canvas);
+      this._tooltips.remove();
+      map.off('moveend resize', this._reset, this);
+      map.off('mousemove', this._onMouseMove, this);
+      map.off('click', this._onClick, this);
+    },
+
+    setData(planes, clusters) {
+      this._planes = planes;
+      this._clusters = clusters;
+      this.redraw();
+    },
+
+    // ה-canvas תמיד בגודל המסך ובמיקום הפינה השמאלית העליונה שלו
+    _reset() {
+      const size = this._map.getSize();
+      const dpr = window.devicePixelRatio || 1;
+      L.DomUtil.setPosition(this._canvas, this._map.containerPointToLayerPoint([0, 0]));
+      this._canvas.width = Math.round(size.x * dpr);
+      this._canvas.height = Math.round(size.y * dpr);
+      this._canvas.style.width = size.x + 'px';
+      this._canvas.style.height = size.y + 'px';
+      this.redraw();
+    },
+
+    redraw() {
+      if (!this._map) return;
+      if (this._frame) cancelAnimationFrame(this._frame);
+      this._drawIndex = 0;
+      this._frame = requestAnimationFrame(() => this._drawFrame());
+    },
+
+    // הטלה של כל המטוסים לקואורדינטות מסך + רשת לבדיקת פגיעה בעכבר
+    _project() {
+      const n = this._planes.length;
+      this._xs = new Float32Array(n);
+      this._ys = new Float32Array(n);
+      this._grid = new Map();
+      for (let i = 0; i < n; i++) {
+        const pt = this._map.latLngToContainerPoint([this._planes[i].lat, this._planes[i].lng]);
+        this._xs[i] = pt.x;
+        this._ys[i] = pt.y;
+        const cell = Math.floor(pt.x / HIT_CELL_PX) + ',' + Math.floor(pt.y / HIT_CELL_PX);
+        let list = this._grid.get(cell);
+        if (!list) this._grid.set(cell, list = []);
+        list.push(i);
+      }
+    },
+
+    // ציור בחלקים: לא יותר מ-FRAME_BUDGET_MS בכל frame כדי שהמפה תישאר חלקה
+    _drawFrame() {
+      this._frame = null;
+      const start = performance.now();
+      const ctx = this._canvas.getContext('2d');
+      const dpr = window.devicePixelRatio || 1;
+      ctx.setTransform(dpr, 0, 0, dpr, 0, 0);
+
+      if (this._drawIndex === 0) {
+        ctx.clearRect(0, 0, this._canvas.width, this._canvas.height);
+        this._project();
+        this._drawClusters(ctx);
+      }
+      if (!sprites) return; // הספרייטים עוד נטענים - buildSprites יקרא ל-redraw
+
+      const n = this._planes.length;
+      const size = this._map.getSize();
+      const half = SPRITE_SIZE / 2;
+      let i = this._drawIndex;
+      while (i < n) {
+        const x = this._xs[i], y = this._ys[i];
+        if (x > -half && y > -half && x < size.x + half && y < size.y + half) {
+          ctx.drawImage(spriteFor(this._planes[i].heading), x - half, y - half, SPRITE_SIZE, SPRITE_SIZE);
+          if (extractKey(this._planes[i]) === selectedKey) {
+            ctx.beginPath();
+            ctx.arc(x, y, half + 3, 0, 2 * Math.PI);
+            ctx.lineWidth = 2;
+            ctx.strokeStyle = '#000';
+            ctx.stroke();
+          }
+        }
+        i++;
+        if ((i & 127) === 0 && performance.now() - start > FRAME_BUDGET_MS) break;
+      }
+      this._drawIndex = i;
+      if (i < n) {
+        this._frame = requestAnimationFrame(() => this._drawFrame());
+      } else {
+        this._updateTooltips();
+      }
+    },
+
+    _drawClusters(ctx) {
+      ctx.font = 'bold 13px sans-serif';
+      ctx.textAlign = 'center';
+      ctx.textBaseline = 'middle';
+      this._clusterPoints = this._clusters.map(c => {
+        const pt = this._map.latLngToContainerPoint([c.lat, c.lng]);
+        ctx.beginPath();
+        ctx.arc(pt.x, pt.y, 17, 0, 2 * Math.PI);
+        ctx.fillStyle = 'rgba(30, 90, 200, 0.8)';
+        ctx.fill();
+        ctx.lineWidth = 2;
+        ctx.strokeStyle = '#fff';
+        ctx.stroke();
+        ctx.fillStyle = '#fff';
+        ctx.fillText(String(c.count), pt.x, pt.y);
+        return { c, x: pt.x, y: pt.y };
+      });
+    },
+
+    // המטוס הקרוב ביותר לנקודה על המסך (או -1)
+    _hitTest(x, y) {
+      let best = -1, bestD = HIT_RADIUS_PX * HIT_RADIUS_PX;
+      const cx = Math.floor(x / HIT_CELL_PX), cy = Math.floor(y / HIT_CELL_PX);
+      for (let dx = -1; dx <= 1; dx++) {
+        for (let dy = -1; dy <= 1; dy++) {
+          const list = this._grid.get((cx + dx) + ',' + (cy + dy));
+          if (!list) continue;
+          for (const i of list) {
+            const d = (this._xs[i] - x) ** 2 + (this._ys[i] - y) ** 2;
+            if (d < bestD) { bestD = d; best = i; }
+          }
         }
+      }
+      return best;
+    },
+
+    _onMouseMove(e) {
+      const i = this._hitTest(e.containerPoint.x, e.containerPoint.y);
+      const key = i >= 0 ? extractKey(this._planes[i]) : null;
+      this._map.getContainer().style.cursor = key ? 'pointer' : '';
+      if (key !== this._hoveredKey) {
+        this._hoveredKey = key;
+        this._updateTooltips();
+      }
+    },
 
-        let icon = ''
-        if (p.name !== 'here' && p.name !== '.' ) {
-             icon = makePlaneDivIcon(rot, isSelected);
-            } else {
-             icon = makeStaticDivIcon(rot, isSelected);
-            }
-        const marker = L.marker([p.lat, p.lng], { icon });
+    _onClick(e) {
+      const { x, y } = e.containerPoint;
+      const cluster = (this._clusterPoints || []).find(p => (p.x - x) ** 2 + (p.y - y) ** 2 <= 17 * 17);
+      if (cluster) {
+        this._map.setView([cluster.c.lat, cluster.c.lng], this._map.getZoom() + 2);
+        return;
+      }
+      const i = this._hitTest(x, y);
+      if (i < 0) return;
+      selectedKey = extractKey(this._planes[i]);
+      this.redraw();
+    },
+
+    // tooltips רק לנבחר, למטוס שמתחת לעכבר ול-N הקרובים למרכז המסך
+    _updateTooltips() {
+      this._tooltips.clearLayers();
+      const n = this._planes.length;
+      if (!n) return;
+      const size = this._map.getSize();
+      const mx = size.x / 2, my = size.y / 2;
+      const visible = [];
+      for (let i = 0; i < n; i++) {
+        const x = this._xs[i], y = this._ys[i];
+        if (x >= 0 && y >= 0 && x <= size.x && y <= size.y) visible.push(i);
+      }
+      visible.sort((a, b) =>
+        ((this._xs[a] - mx) ** 2 + (this._ys[a] - my) ** 2) - ((this._xs[b] - mx) ** 2 + (this._ys[b] - my) ** 2));
 
-        // להעלות את הנבחר בחזית
-        if (isSelected) {
-          marker.setZIndexOffset(10000);
+      const chosen = new Set(visible.slice(0, CANVAS_TOOLTIPS_NEAREST));
+      for (let i = 0; i < n; i++) {
+        const key = extractKey(this._planes[i]);
+        if (key === selectedKey || key === this._hoveredKey) chosen.add(i);
+      }
+
+      chosen.forEach(i => {
+        const p = this._planes[i];
+        const html = buildTooltipHtml(p);
+        if (!html) return;
+        const isSelected = extractKey(p) === selectedKey;
+        L.tooltip({
+          permanent: true,
+          direction: 'top',
+          offset: [0, -10],
+          opacity: 0.97,
+          className: tooltipClass(isSelected)
+        }).setLatLng([p.lat, p.lng]).setContent(html).addTo(this._tooltips);
+      });
+    }
+  });
+
+  const planeCanvas = new PlaneCanvasLayer().addTo(map);
+
+  // שכבת צפיפות (/heatmap): תמונה אחת שמצוירת מהתאים, מתרעננת כל דקה כשהיא מוצגת
+  const HEATMAP_WINDOW_MINUTES = 60;
+  const HEATMAP_REFRESH_MS = 60000;
+  let heatmapEnabled = false;
+  let heatmapOverlay = null;
+  let heatmapTimer = null;
+
+  async function loadHeatmap() {
+    clearTimeout(heatmapTimer);
+    try {
+      const res = await fetch('/heatmap?window=' + HEATMAP_WINDOW_MINUTES, { cache: 'no-store' });
+      if (!res.ok) return;
+      const data = await res.json();
+      if (!heatmapEnabled) return; // כובה בזמן שחיכינו
+      const canvas = document.createElement('canvas');
+      canvas.width = data.cols;
+      canvas.height = data.rows;
+      const ctx = canvas.getContext('2d');
+      const image = ctx.createImageData(data.cols, data.rows);
+      const scale = Math.log1p(data.max || 1);
+      data.cells.forEach(([row, col, band, count]) => {
+        // row נספר מדרום - בתמונה y גדל כלפי מטה
+        const i = ((data.rows - 1 - row) * data.cols + col) * 4;
+        const t = Math.log1p(count) / scale;
+        image.data[i] = 255;
+        image.data[i + 1] = Math.round(220 * (1 - t));
+        image.data[i + 2] = 0;
+        image.data[i + 3] = Math.max(image.data[i + 3], Math.round(60 + 180 * t));
+      });
+      ctx.putImageData(image, 0, 0);
+      if (heatmapOverlay) {
+        heatmapOverlay.setUrl(canvas.toDataURL());
+      } else {
+        heatmapOverlay = L.imageOverlay(canvas.toDataURL(), data.bounds, { opacity: 0.7 }).addTo(map);
+      }
+    } catch (err) {
+      console.error('שגיאה בטעינת מפת הצפיפות', err);
+    } finally {
+      if (heatmapEnabled) heatmapTimer = setTimeout(loadHeatmap, HEATMAP_REFRESH_MS);
+    }
+  }
+
+  const HeatmapToggle = L.Control.extend({
+    options: { position: 'topright' },
+    onAdd() {
+      const button = L.DomUtil.create('button', 'heatmap-toggle');
+      button.textContent = 'צפיפות';
+      L.DomEvent.disableClickPropagation(button);
+      L.DomEvent.on(button, 'click', () => {
+        heatmapEnabled = !heatmapEnabled;
+        button.classList.toggle('heatmap-toggle-on', heatmapEnabled);
+        if (heatmapEnabled) {
+          loadHeatmap();
+        } else {
+          clearTimeout(heatmapTimer);
+          if (heatmapOverlay) map.removeLayer(heatmapOverlay);
+          heatmapOverlay = null;
         }
+      });
+      return button;
+    }
+  });
+  new HeatmapToggle().addTo(map);
 
+  async function loadLandmarks() {
+    try {
+      // ה-URL כולל גרסה - הדפדפן שומר אותו ב-cache לתמיד
+      const res = await fetch(LANDMARKS_URL);
+      if (!res.ok) return;
+      const data = await res.json();
+      (data.geofences || []).forEach(g => {
+        L.rectangle(g.bounds, { color: '#1e5ac8', weight: 1, fill: false, dashArray: '4 4', interactive: false })
+          .addTo(landmarksLayer);
+      });
+      (data.landmarks || []).forEach(p => {
+        const marker = L.marker([p.lat, p.lng], { icon: makeStaticDivIcon(0, false) });
         const html = buildTooltipHtml(p);
         if (html) {
           marker.bindTooltip(html, {
@@ -289,27 +808,25 @@ TEMPLATE = r"""
             direction: 'top',
             offset: [0, -10],
             opacity: 0.97,
-            className: tooltipClass(isSelected)
+            className: tooltipClass(false)
           });
         }
-
-        // בלחיצה: לסמן כנבחר (והרינדור הבא ישים אותו בחזית + class מודגש)
-        marker.on('click', () => {
-          selectedKey = key;
-          loadData(); // רינדור מחדש כדי להחיל selected על כולם
-        });
-
-        marker.addTo(markersLayer);
+        marker.addTo(landmarksLayer);
       });
-
-      console.log('עודכן:', new Date().toLocaleTimeString(), 'נ"ק:', (data.points || []).length);
     } catch (err) {
-      console.error('שגיאה בטעינת הנתונים', err);
+      console.error('שגיאה בטעינת נקודות הציון', err);
     }
   }
 
+  loadLandmarks();
+
+  // זום משנה את רמת הקיבוץ - טוענים מחדש; בזום קרוב גם הזזה משנה את החלון
+  map.on('zoomend', () => loadData());
+  map.on('dragend', () => {
+    if (map.getZoom() >= VIEWPORT_MIN_ZOOM) loadData();
+  });
+
   loadData();
-  setInterval(loadData, REFRESH_SECONDS * 1000);
 </script>
 
 </body>
@@ -388,19 +905,6 @@ OK_TEMPLATE = r"""
 
   const map = L.map('map').setView([32.08, 34.78], 7);
 
-  const AIRLINE_BY_PREFIX = {
-  'ELY': 'El Al',
-  'WZZ': 'Wizz Air',
-  'ISR': 'Israir',
-  'AIZ': 'Arkia',
-  'ETH': 'Ethiopian Airlines',
-  'HFA': 'Haifa Air',
-  'ICL': 'Challenge Airlines',
-  'BBG': 'Blue Bird',
-  'CYF': 'Cyprus Airways',
-  'RYR': 'RYAN Air'
-  // אפשר להוסיף חופשי
-};
 
   L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
     maxZoom: 19,
@@ -446,7 +950,7 @@ OK_TEMPLATE = r"""
     if (!p || !p.info) return { callsign: null, airline: null };
 
     const parts = String(p.info).split('<br>');
-    const airline = AIRLINE_BY_PREFIX[p.airline] || null;
+    const airline = p.airline_name || null;
     const callsign = p.callsign 
 
     return { callsign, airline };
@@ -816,8 +1320,24 @@ ORIG_TEMPLATE = r"""
 
 class FlightTracker:
     def __init__(self):
-        """אתחול ה-API של FlightRadar24"""
-        self.fr_api = FlightRadar24API()
+        """אתחול ה-API של FlightRadar24 נדחה לשימוש הראשון"""
+        self._fr_api = None
+        self._fr_api_lock = threading.Lock()
+
+    @property
+    def fr_api(self):
+        # ייבוא מאוחר: FlightRadar24 (עם curl_cffi / bs4) הוא בערך חצי מזמן
+        # הייבוא של השרת, ו-workers שקוראים מ-snapshots משותפים לא צריכים אותו בכלל
+        if self._fr_api is None:
+            with self._fr_api_lock:
+                if self._fr_api is None:
+                    from FlightRadar24.api import FlightRadar24API
+                    self._fr_api = FlightRadar24API()
+        return self._fr_api
+
+    @fr_api.setter
+    def fr_api(self, api):
+        self._fr_api = api
 
     def is_point_in_polygon(self, lat: float, lon: float,
                             top_left: Tuple[float, float],
@@ -853,6 +1373,25 @@ class FlightTracker:
         Returns:
             רשימת טיסות עם המידע שלהן
         """
+        return self.fetch_tile(top_left, bottom_right)[0]
+
+    def result_limit(self) -> int:
+        """כמה טיסות לכל היותר FlightRadar24 מחזיר בקריאה אחת"""
+        try:
+            return int(self.fr_api.get_flight_tracker_config().limit)
+        except (AttributeError, TypeError, ValueError):
+            return TILE_DEFAULT_RESULT_LIMIT
+
+    def fetch_tile(self,
+                   top_left: Tuple[float, float],
+                   bottom_right: Tuple[float, float]) -> Tuple[List[Dict], int]:
+        """
+        קריאה אחת ל-upstream עבור מלבן אחד
+
+        Returns:
+            (הטיסות בתוך המלבן, כמה טיסות ה-upstream החזיר לפני הסינון)
+            המספר השני משמש לזיהוי אריח "רווי" שנחתך במגבלת התוצאות
+        """
         # יצירת bounds בפורמט הנכון
         bounds_zone = f"{top_left[0]},{bottom_right[0]},{top_left[1]},{bottom_right[1]}"
 
@@ -877,7 +1416,10 @@ class FlightTracker:
                     'altitude': flight.altitude,
                     'speed': flight.ground_speed,
                     'heading': flight.heading,
-                    'vertical_speed': flight.vertical_speed if hasattr(flight, 'vertical_speed') else 0
+                    'vertical_speed': flight.vertical_speed if hasattr(flight, 'vertical_speed') else 0,
+                    'icao_24bit': flight.icao_24bit.upper() if getattr(flight, 'icao_24bit', None) else 'N/A',
+                    # מתי נמדד המיקום (FlightRadar24 מגיש אותו באיחור של כמה שניות)
+                    'position_time': getattr(flight, 'time', None) or 0
                 }
 
                 # בדיקה שהטיסה באמת בתוך הפוליגון
@@ -888,7 +1430,17 @@ class FlightTracker:
                 # מדלגים על טיסות עם נתונים חסרים
                 continue
 
-        return flights_in_area
+        return flights_in_area, len(flights)
+
+    def get_flight_details(self, flight_id: str) -> Dict:
+        """
+        פרטים מלאים על טיסה אחת (מסלול, לוח זמנים, תמונות)
+
+        Args:
+            flight_id: ה-id של הטיסה כפי שמופיע ב-get_flights_in_area
+        """
+        # ה-API מצפה לאובייקט טיסה אבל משתמש רק ב-id שלו
+        return self.fr_api.get_flight_details(SimpleNamespace(id=flight_id))
 
     def print_flight_info(self, flights: List[Dict]):
         """הדפסה מסודרת של מידע הטיסות"""
@@ -913,254 +1465,3658 @@ class FlightTracker:
             print(f"  מהירות אנכית: {flight['vertical_speed']} רגל/דקה")
 
 
-def main():
-    # הגדרת הפוליגון - ניתן לשנות את הקואורדינטות כאן
-    # דוגמה: אזור מרכז ישראל (תל אביב-ירושלים)
-    TOP_LEFT = (32.5, 34.5)  # (latitude, longitude) - שמאל למעלה
-    BOTTOM_RIGHT = (31.5, 35.5)  # (latitude, longitude) - ימין למטה
+# ---------------------------------------------------------------------------
+# הגנה על ה-upstream: הגבלת קצב, מפסק (circuit breaker) והגשת snapshot אחרון
+# ---------------------------------------------------------------------------
+
+# האזור הכללי שמוצג במפה ותיבת האתר הקטנה (שמאל-למעלה, ימין-למטה)
+AREA_TOP_LEFT = (32.5, 34.5)
+AREA_BOTTOM_RIGHT = (31.5, 35.5)
+SITE_TOP_LEFT = (32.10137, 34.71449)
+SITE_BOTTOM_RIGHT = (32.0276367, 34.8127718)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# קבצי ייחוס שמגיעים עם הקוד, ו-cache מקומי של מה שהורד מה-API
+DATA_DIR = os.path.join(BASE_DIR, "data")
+CACHE_DIR = os.path.join(BASE_DIR, "cache")
+# כל כמה זמן לרענן את טבלאות הייחוס (חברות תעופה, סוגי מטוסים)
+REFERENCE_TTL_SECONDS = 7 * 24 * 3600.0
+# אחרי כשלון ברענון - לנסות שוב בעוד שעה
+REFERENCE_RETRY_SECONDS = 3600.0
+# רק התהליך שפונה ל-upstream (standalone / ingest) מרענן; ה-workers בודקים
+# בתדירות הזו אם הוא כתב cache חדש
+REFERENCE_RELOAD_CHECK_SECONDS = 60.0
+# רענון הטבלאות רץ ברקע ומוכן לחכות לאסימון של ה-upstream
+REFERENCE_TOKEN_WAIT_SECONDS = 30.0
+
+# נקודות ציון קבועות במפה (here, פינות האתר וכו') - נטענות פעם אחת ומוגשות
+# ב-/landmarks, לא בכל תשובת /data
+LANDMARKS_PATH = os.path.join(DATA_DIR, "landmarks.json")
+
+# שדות התעופה "שלנו": טיסה שיעדה אחד מהם נכנסת, שמוצאה אחד מהם יוצאת
+HOME_AIRPORTS = ("TLV", "ETM")
+
+# נקודת הייחוס שלנו ("here" במפה)
+HERE = (32.05642, 34.77310)
+
+# נקודות קרקע שעבורן מחשבים "מי יעבור מעלינו" (closest point of approach)
+GROUND_POINTS = {
+    "here": HERE,
+}
+# כמה שניות קדימה מחשבים, ובאיזה מרחק (ק"מ) מעבר נחשב "מעלינו"
+OVERFLIGHT_HORIZON_SECONDS = 600.0
+OVERFLIGHT_MAX_DISTANCE_KM = 5.0
+# ערכי horizon / within שמותר לבקש (כל ערך אחר מעוגל כלפי מעלה לקרוב ביותר).
+# כל צירוף נשמר ב-cache של ה-snapshot, אז הקבוצה חייבת להיות קטנה וסגורה
+OVERFLIGHT_HORIZON_STEPS_SECONDS = (60.0, 120.0, 300.0, 600.0, 900.0, 1800.0, 3600.0)
+OVERFLIGHT_DISTANCE_STEPS_KM = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+
+REGIONS = {
+    "area": (AREA_TOP_LEFT, AREA_BOTTOM_RIGHT),
+    "site": (SITE_TOP_LEFT, SITE_BOTTOM_RIGHT),
+    # אזור גדול (למשל כל ישראל) נמשך אוטומטית באריחים - ראו TILE_MAX_DEGREES
+    # "israel": ((33.35, 34.25), (29.50, 35.90)),
+}
+
+# גדרות (geofences) שעליהן מדווחים אירועי כניסה / יציאה / שהייה.
+# אפשר להוסיף כמה שרוצים - כולן נבדקות מול ה-snapshot של "area"
+GEOFENCES = {
+    "site": (SITE_TOP_LEFT, SITE_BOTTOM_RIGHT),
+}
+# אחרי כמה שניות בתוך גדר נשלח אירוע dwell
+GEOFENCE_DWELL_SECONDS = 60.0
+# כמה אירועים אחרונים שומרים בזיכרון
+GEOFENCE_EVENT_LOG_SIZE = 5000
+
+# חלונות הזמן (בדקות) של הסטטיסטיקה ב-/stats
+STATS_WINDOWS_MINUTES = (5, 60, 1440)
+# גבולות רצועות הגובה (ברגל) בסטטיסטיקה: "<1000", "1000-5000", ..., "30000+"
+STATS_ALTITUDE_BANDS_FEET = (1000, 5000, 10000, 20000, 30000)
+
+# מפת צפיפות (/heatmap): דוגמים את מיקומי המטוסים פעם ב-HEATMAP_SAMPLE_SECONDS
+# למאגר מעגלי בגודל קבוע (~24 שעות באזור עמוס)
+HEATMAP_SAMPLE_SECONDS = 30.0
+HEATMAP_HISTORY_POSITIONS = 2_000_000
+# גודל תא ברירת מחדל (מעלות), התא הקטן ביותר שמותר ומספר התאים המקסימלי
+HEATMAP_DEFAULT_CELL_DEGREES = 0.02
+HEATMAP_MIN_CELL_DEGREES = 0.002
+HEATMAP_MAX_CELLS = 1_000_000
+HEATMAP_DEFAULT_WINDOW_MINUTES = 60
+# כמה צירופים של (חלון, רזולוציה) שומרים מוכנים
+HEATMAP_CACHE_ENTRIES = 16
+
+# פרטי טיסה (/flight/<id>): כמה לשמור בזיכרון ולכמה זמן
+FLIGHT_DETAILS_CACHE_SIZE = 500
+FLIGHT_DETAILS_TTL_SECONDS = 120.0
+# טעינה מראש של פרטי טיסה למטוסים שנכנסים לגדרות האלה
+FLIGHT_DETAILS_PREFETCH_FENCES = ("site",)
+# לפרטי טיסה תקציב ומפסק משלהם: מזהים שמגיעים מהמשתמש לא יכולים לחסום
+# את רענון ה-snapshots (ולהפך)
+FLIGHT_DETAILS_RATE_PER_SECOND = 0.2
+FLIGHT_DETAILS_BURST = 3
+# טעינה מראש לוקחת אסימון רק אם נשארים אחריו לפחות כמה אסימונים ללחיצות של משתמשים
+FLIGHT_DETAILS_PREFETCH_RESERVE = 2
+# תשובות upstream שפירושן "אין דבר כזה" - לא נחשבות כשלון של המפסק
+UPSTREAM_NOT_FOUND_STATUSES = (400, 404, 410)
+
+# אריחי המפה (/tiles) עוברים דרך cache מקומי על הדיסק.
+# RADAR_TILE_URL מאפשר להחליף את שרת האריחים (למשל שרת מקומי לבדיקות)
+TILE_UPSTREAM_URL = os.environ.get("RADAR_TILE_URL", "https://tile.openstreetmap.org/{z}/{x}/{y}.png")
+TILE_CACHE_DIR = os.path.join(CACHE_DIR, "tiles")
+TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# אחרי כמה זמן אריח נטען מחדש (אם ה-upstream לא זמין - מוגש הישן)
+TILE_MAX_AGE_SECONDS = 7 * 24 * 3600.0
+# כמה הורדות במקביל ל-upstream (מדיניות OSM: לכל היותר 2)
+TILE_UPSTREAM_CONCURRENCY = 2
+TILE_FETCH_TIMEOUT_SECONDS = 10.0
+TILE_MAX_ZOOM = 19
+TILE_USER_AGENT = "web_f_radar-tile-cache/1.0"
+
+# אילו שדות לשלוח לכל נקודה (/data?fields=minimal או fields=lat,lng,callsign).
+# None = כל השדות
+FIELD_PRESETS = {
+    "minimal": ("id", "lat", "lng", "heading"),
+    "tooltip": ("id", "lat", "lng", "heading", "name", "direction", "airline_name", "callsign",
+                "aircraft", "aircraft_name", "speed", "altitude"),
+    "full": None,
+}
+# כל השדות שאפשר לבקש ב-fields
+POINT_FIELDS = ("id", "lat", "lng", "name", "info", "airline", "callsign", "speed", "altitude", "heading",
+                "aircraft", "airline_name", "aircraft_name", "direction", "dest_distance_km")
+# כמה סטים שונים של fields נשמרים לכל payload של snapshot. מעבר לזה (לקוחות
+# שמבקשים צירופים חריגים) ה-payload נבנה לכל בקשה ולא נשמר
+FIELD_VARIANTS_PER_SNAPSHOT = 8
+
+# שדות שיש להם אינדקס (hash) בכל snapshot, וכך גם שמות הפרמטרים לסינון:
+#   /data?airline=ELY,ISR&callsign=ELY001
+INDEXED_FIELDS = ("id", "callsign", "registration", "airline")
+# שדות מספריים שאפשר לסנן לפי טווח: /data?max_altitude=5000&min_speed=100
+RANGE_FIELDS = ("altitude", "speed", "vertical_speed")
+# רשימת המעקב של /watchlist כשלא מעבירים פרמטרים (אותם מפתחות כמו INDEXED_FIELDS)
+# למשל: {"registration": ("4X-EKA", "4X-EDF"), "callsign": ("ELY001",)}
+WATCHLIST: Dict[str, Tuple[str, ...]] = {}
+
+# מתחת לזום הזה /data?zoom= מחזיר אשכולות (clusters) במקום מטוסים בודדים.
+# גודל תא הרשת של אשכול בפיקסלים על המסך
+CLUSTER_MAX_ZOOM = 9
+CLUSTER_CELL_PIXELS = 64
+
+# מנויי viewport (/viewport): מנוי שלא נשאל כל כך הרבה זמן נמחק,
+# ומספר המנויים בזיכרון מוגבל (הישן ביותר יוצא)
+VIEWPORT_IDLE_SECONDS = 120.0
+VIEWPORT_MAX_SUBSCRIPTIONS = 1000
+
+# פריסה מרובת תהליכים: אם מוגדרת תיקייה משותפת (עדיף ב-/dev/shm), תהליך
+# ingest יחיד מושך מה-upstream וכותב לשם, וכל ה-workers רק קוראים ממנה
+SHARED_SNAPSHOT_DIR = os.environ.get("RADAR_SHARED_DIR")
+SHARED_SNAPSHOT_CAPACITY = 32 * 1024 * 1024
+# אם תהליך ה-ingest לא פרסם snapshot חדש כל כך הרבה זמן - מגישים stale
+INGEST_STALE_AFTER_SECONDS = 30.0
+# מצב מצטבר (אירועי גדרות, סטטיסטיקה, heatmap, cache פרטי הטיסה) קיים רק
+# בתהליך ה-ingest; ה-workers מעבירים אליו את נקודות הקצה האלה בכתובת הפנימית הזו
+INGEST_HTTP_ADDRESS = os.environ.get("RADAR_INGEST_ADDR", "127.0.0.1:5051")
+INGEST_PROXY_TIMEOUT_SECONDS = 10.0
+
+# כמה שניות snapshot נחשב "טרי" לפני שפונים שוב ל-FlightRadar24
+SNAPSHOT_TTL_SECONDS = 5.0
+# snapshot ישן מזה מוגש עם stale=True גם כשרענון רץ כרגע ב-thread אחר
+SNAPSHOT_STALE_AFTER_SECONDS = 30.0
+# הודעת "מגישים snapshot ישן" מודפסת לכל אזור לכל היותר פעם בזמן הזה
+STALE_LOG_INTERVAL_SECONDS = 60.0
+
+# מקלט ADS-B מקומי (dump1090 / readsb): נתיב ל-aircraft.json, או tcp://host:port לזרם
+# ה-JSON של readsb (--net-json-port, מטוס אחד בכל שורה). לא מוגדר - רק FlightRadar24
+LOCAL_RECEIVER_SOURCE = os.environ.get("RADAR_LOCAL_RECEIVER")
+# מיקום מהמקלט ישן מזה לא משמש (המטוס יצא מהטווח)
+LOCAL_RECEIVER_MAX_AGE_SECONDS = 15.0
+# המקלט נחשב חי אם הקובץ / הזרם התעדכן בשניות האחרונות
+LOCAL_RECEIVER_HEALTHY_SECONDS = 10.0
+# כשהמקלט חי, FlightRadar24 רק משלים זיהוי ומסלול ומטוסים מחוץ לטווח -
+# פונים אליו פעם בזמן הזה במקום בכל רענון
+LOCAL_RECEIVER_UPSTREAM_TTL_SECONDS = 30.0
+# אם ה-upstream לא זמין, טיסות שרק הוא ראה (בלי מקלט שמעדכן אותן) נשארות
+# ב-snapshot עד שהתוצאה האחרונה שלו בת כמה זמן - ואז יוצאות
+LOCAL_RECEIVER_UPSTREAM_MAX_AGE_SECONDS = 90.0
+# כשיש מקלט, מזהה הטיסה נגזר מקוד ה-ICAO (AIRCRAFT_ID_PREFIX + hex) ולא
+# מ-FlightRadar24, כדי שיהיה יציב בין המקורות; מזהה FlightRadar24 נשמר ב-upstream_id
+AIRCRAFT_ID_PREFIX = "icao-"
+# כללי מיזוג לפי שדה. בקבוצות "טריות" מנצח המקור שהמדידה שלו חדשה יותר
+# (קו רוחב ואורך תמיד יחד); בשדות הזיהוי והמסלול FlightRadar24 מנצח
+# והמקלט רק משלים 'N/A'
+MERGE_FRESHEST_FIELDS = {
+    "position": ("latitude", "longitude"),
+    "state": ("altitude", "speed", "heading", "vertical_speed"),
+}
+MERGE_UPSTREAM_FIELDS = ("callsign", "registration", "aircraft", "airline", "origin", "destination", "icao_24bit")
+
+# תקציב קריאות ל-upstream: קריאה אחת כל 2 שניות בממוצע, עד 10 ברצף.
+# אזור באריחים לוקח את כל האסימונים של הרענון בבת אחת, ולכן ה-burst חייב
+# להספיק לכל האריחים של האזור הגדול ביותר (SnapshotStore בודק את זה)
+UPSTREAM_RATE_PER_SECOND = 0.5
+UPSTREAM_BURST = 10
+
+# שמירת ה-snapshot האחרון לדיסק (cache/) כדי שאחרי אתחול יהיה מה להגיש מיד
+SNAPSHOT_PERSIST_INTERVAL_SECONDS = 30.0
+# snapshot שמור ישן מזה לא נטען באתחול (עדיף לחכות ל-upstream)
+WARM_SNAPSHOT_MAX_AGE_SECONDS = 900.0
+
+# שני אזורים חופפים נמשכים כמלבן אחד אם המלבן המאחד לא גדול מזה כפול סכום השטחים
+REGION_MERGE_MAX_AREA_RATIO = 1.25
+
+# אזור שצלעו גדולה מזה (במעלות) מחולק לאריחים שנמשכים במקביל
+TILE_MAX_DEGREES = 1.0
+# כמה אריחים נמשכים במקביל
+TILE_WORKERS = 4
+# אריח שחזר מלא (במגבלת התוצאות של FlightRadar24) מחולק שוב לארבעה, עד העומק הזה
+TILE_MAX_SPLIT_DEPTH = 3
+# מגבלת התוצאות אם אי אפשר לקרוא אותה מה-API
+TILE_DEFAULT_RESULT_LIMIT = 1500
+# כמה שניות אריח מוכן לחכות לאסימון לפני שהרענון כולו נכשל
+TILE_TOKEN_WAIT_SECONDS = 3.0
+
+# מפסק: אחרי 3 כשלונות רצופים מפסיקים לפנות, backoff מעריכי עד 5 דקות
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_BASE_BACKOFF_SECONDS = 5.0
+BREAKER_MAX_BACKOFF_SECONDS = 300.0
+
+# גבולות לזמן הבקשה הבאה שהשרת מציע ללקוחות (next_poll_ms)
+MIN_POLL_SECONDS = 1.0
+MAX_POLL_SECONDS = 60.0
+# מספר בקשות במקביל שמעליו מאטים את הלקוחות (פי 2 בכל כפולה של הסף)
+POLL_LOAD_SOFT_LIMIT = 20
+
+# הגבלת בקשות נכנסות: תקציב לכל לקוח + תקרה גלובלית לבקשות במקביל.
+# חלק מהתקרה שמור לבקשות בעדיפות (stream / טעינה ראשונה של הדף)
+CLIENT_RATE_PER_SECOND = 2.0
+CLIENT_BURST = 10
+MAX_TRACKED_CLIENTS = 10000
+MAX_CONCURRENT_REQUESTS = 32
+PRIORITY_RESERVED_SLOTS = 8
+
+
+class UpstreamUnavailable(Exception):
+    """ה-upstream לא זמין כרגע (מוגבל קצב, מפסק פתוח או שגיאה)"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class UpstreamNotFound(Exception):
+    """ה-upstream ענה, ואין אצלו את מה שביקשנו (למשל מזהה טיסה לא מוכר)"""
+
+
+class TokenBucket:
+    """דלי אסימונים פשוט ובטוח לשימוש מכמה threads"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0, reserve: float = 0.0) -> bool:
+        """
+        לקיחת אסימון בלי לחכות. מחזיר False אם הדלי ריק
 
-    print(f"מחפש טיסות באזור:")
-    print(f"  פינה שמאלית עליונה: {TOP_LEFT}")
-    print(f"  פינה ימנית תחתונה: {BOTTOM_RIGHT}")
+        Args:
+            reserve: כמה אסימונים חייבים להישאר אחרי הלקיחה (לקריאות חשובות יותר)
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens + reserve:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1.0, timeout: float = 0.0) -> bool:
+        """לקיחת אסימון, ואם צריך - המתנה של עד timeout שניות"""
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire(tokens):
+            wait = self.wait_time(tokens)
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """כמה שניות עד שיהיה מספיק אסימונים"""
+        with self._lock:
+            self._refill(time.monotonic())
+            missing = tokens - self._tokens
+            return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+
+class CircuitBreaker:
+    """
+    מפסק עם backoff מעריכי.
 
-    # יצירת אובייקט FlightTracker
-    tracker = FlightTracker()
+    closed    - הכל תקין, קריאות עוברות
+    open      - אחרי failure_threshold כשלונות רצופים; חוסם עד שה-backoff נגמר
+    half_open - אחרי ה-backoff מאפשרים קריאת ניסיון אחת; הצלחה סוגרת,
+                כשלון פותח מחדש עם backoff כפול
+    """
 
-    try:
-        # חיפוש טיסות באזור
-        flights = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
+    def __init__(self, failure_threshold: int, base_backoff: float, max_backoff: float):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self._open_until:
+                # קריאת ניסיון אחת בלבד
+                self.state = "half_open"
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        """כמה שניות עד שהמפסק יאפשר קריאה (0 אם סגור)"""
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            return max(0.0, self._open_until - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.trips = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.trips += 1
+                backoff = min(self.max_backoff, self.base_backoff * (2 ** (self.trips - 1)))
+                # jitter כדי שכמה מופעים לא יחזרו בדיוק באותו רגע
+                backoff *= random.uniform(0.8, 1.2)
+                self.state = "open"
+                self._open_until = time.monotonic() + backoff
+
+
+def upstream_status(error: Exception):
+    """קוד ה-HTTP מתוך שגיאה של ספריית ה-upstream (או None)"""
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+def call_guarded(limiter: TokenBucket, breaker: CircuitBreaker, fn, *args, wait: float = 0.0):
+    """
+    קריאה ל-upstream דרך הגבלת קצב ומפסק.
 
-        # הצגת התוצאות
-        # tracker.print_flight_info(flights)
+    Args:
+        limiter: None - האסימון כבר נלקח מראש (ראו SnapshotStore.fetch_region)
+        wait: כמה שניות מותר לחכות לאסימון (ברירת מחדל - לא מחכים)
 
+    Raises:
+        UpstreamUnavailable אם הקריאה נחסמה או נכשלה
+        UpstreamNotFound אם ה-upstream ענה "לא נמצא" (המפסק לא נפתח בגלל זה)
+    """
+    if not breaker.allow():
+        raise UpstreamUnavailable("circuit open", breaker.retry_in())
+    if limiter is not None and not limiter.acquire(timeout=wait):
+        raise UpstreamUnavailable("rate limited", limiter.wait_time())
+    try:
+        result = fn(*args)
     except Exception as e:
-        print(f"שגיאה: {e}")
-        import traceback
-        traceback.print_exc()
+        if upstream_status(e) in UPSTREAM_NOT_FOUND_STATUSES:
+            # ה-upstream עצמו תקין - רק הבקשה לא טובה
+            breaker.record_success()
+            raise UpstreamNotFound(str(e)) from e
+        breaker.record_failure()
+        raise UpstreamUnavailable(f"{type(e).__name__}: {e}", breaker.retry_in()) from e
+    breaker.record_success()
+    return result
+
+
+def normalize_key(value) -> str:
+    """ערך לחיפוש: אותיות גדולות בלי רווחים ומקפים ("4x-eka" == "4XEKA"). N/A -> ריק"""
+    if not value or value == 'N/A':
+        return ""
+    return "".join(ch for ch in str(value).upper() if ch.isalnum())
+
+
+class Snapshot:
+    """תמונת מצב אחת של הטיסות באזור, כפי שהתקבלה מה-upstream"""
+
+    def __init__(self, flights: List[Dict], fetched_at: float, generation: int):
+        self.flights = flights
+        self.fetched_at = fetched_at
+        self.generation = generation
+        # מבנים שמחושבים מה-snapshot פעם אחת (לפי דרישה) ונשמרים איתו
+        self._derived: Dict = {}
+        self._derived_lock = threading.RLock()
+
+    def age(self) -> float:
+        """גיל ה-snapshot בשניות"""
+        return max(0.0, time.time() - self.fetched_at)
+
+    def derived(self, key, build):
+        """
+        ערך שנגזר מה-snapshot ונשמר בו (אינדקסים, payloads וכו').
+        build() נקרא פעם אחת בלבד לכל key.
+        """
+        value = self._derived.get(key)
+        if value is None:
+            with self._derived_lock:
+                value = self._derived.get(key)
+                if value is None:
+                    value = build()
+                    self._derived[key] = value
+        return value
+
+    def derived_variant(self, key, variant, build, max_variants: int):
+        """
+        כמו derived, לערך שתלוי גם בפרמטר מהלקוח (variant). לכל key נשמרים
+        עד max_variants ערכים שונים של variant; מעבר לזה build() נקרא בכל פעם.
+        """
+        with self._derived_lock:
+            variants = self._derived.setdefault(("variants", key), set())
+            cached = variant in variants or len(variants) < max_variants
+            if cached:
+                variants.add(variant)
+        if not cached:
+            return build()
+        return self.derived((key, variant), build)
+
+    def by_id(self) -> Dict[str, Dict]:
+        """מיפוי flight id -> טיסה"""
+        return self.derived("by_id", lambda: {flight['id']: flight for flight in self.flights})
+
+    def index(self, key: str) -> Dict[str, List[int]]:
+        """אינדקס hash: ערך מנורמל (normalize_key) של השדה -> מספרי השורות ב-flights"""
+        def build():
+            buckets: Dict[str, List[int]] = {}
+            for i, flight in enumerate(self.flights):
+                value = normalize_key(flight.get(key))
+                if value:
+                    buckets.setdefault(value, []).append(i)
+            return buckets
+
+        return self.derived(("index", key), build)
+
+    def sorted_column(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        עמודה מספרית ממוינת לחיפוש טווחים בחיפוש בינארי
 
+        Returns:
+            (values, order) - הערכים בסדר עולה, ומספר השורה של כל אחד מהם
+        """
+        def build():
+            column = self.arrays()[key]
+            order = np.argsort(column, kind="stable")
+            return column[order], order
+
+        return self.derived(("sorted", key), build)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """עמודות מספריות של ה-snapshot (באותו סדר כמו flights) לחישובים וקטוריים"""
+        return self.derived("arrays", self._build_arrays)
+
+    def _build_arrays(self) -> Dict[str, np.ndarray]:
+        def column(key):
+            return np.array([flight[key] or 0 for flight in self.flights], dtype=np.float64)
+
+        return {
+            "lat": column('latitude'),
+            "lon": column('longitude'),
+            "altitude": column('altitude'),
+            "speed": column('speed'),
+            "heading": column('heading'),
+            "vertical_speed": column('vertical_speed'),
+        }
 
-@app.route("/")
-def index():
-    # אפשר לשנות כאן את זמן הרענון בשניות
-    return render_template_string(TEMPLATE, refresh_seconds=5)
 
+class SharedSnapshotFile:
+    """
+    snapshot אחד בקובץ ממופה לזיכרון (mmap), משותף בין תהליכים.
 
-@app.route("/data")
-def data():
+    מבנה: header של 32 בתים (magic, generation, fetched_at, length) ואחריו
+    ה-JSON של הטיסות. הכתיבה היא seqlock: generation אי-זוגי בזמן כתיבה,
+    זוגי כשהתוכן עקבי. קורא בודק את ה-generation לפני ואחרי ומנסה שוב
+    אם היה באמצע כתיבה. בקשה רגילה קוראת רק את 8 הבתים של ה-generation -
+    הפענוח קורה פעם אחת לכל snapshot חדש בכל worker.
     """
-    כאן מחזירים JSON שמייצג נקודות.
-    כרגע – דוגמה רנדומלית. במקום זה אתה יכול לקרוא ל-API שלך.
-    הפורמט:
-    {
-      "points": [
-        {"lat": ..., "lng": ..., "name": "...", "info": "..."},
-        ...
-      ]
-    }
+
+    MAGIC = b"RADARSN1"
+    HEADER = struct.Struct("<8sQdQ")
+
+    def __init__(self, path: str, capacity: int = SHARED_SNAPSHOT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self._mm = None
+
+    def _open(self, create: bool):
+        if self._mm is not None:
+            return self._mm
+        if create:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a+b") as f:
+                if os.fstat(f.fileno()).st_size < self.capacity:
+                    f.truncate(self.capacity)
+        elif not os.path.exists(self.path):
+            return None
+        with open(self.path, "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        if create and self._mm[:8] != self.MAGIC:
+            self.HEADER.pack_into(self._mm, 0, self.MAGIC, 0, 0.0, 0)
+        return self._mm
+
+    def generation(self) -> int:
+        """מונה הגרסה הנוכחי (0 אם אין עדיין snapshot)"""
+        mm = self._open(create=False)
+        if mm is None or mm[:8] != self.MAGIC:
+            return 0
+        return struct.unpack_from("<Q", mm, 8)[0]
+
+    def write(self, flights: List[Dict], fetched_at: float) -> int:
+        """פרסום snapshot חדש (רק מתהליך ה-ingest). מחזיר את ה-generation החדש"""
+        payload = json.dumps(flights, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        if self.HEADER.size + len(payload) > self.capacity:
+            raise ValueError(f"snapshot של {len(payload)} בתים גדול מהקובץ המשותף ({self.capacity})")
+        mm = self._open(create=True)
+        generation = struct.unpack_from("<Q", mm, 8)[0]
+        generation += 1 if generation % 2 == 0 else 0
+        struct.pack_into("<Q", mm, 8, generation)  # אי-זוגי: באמצע כתיבה
+        mm[self.HEADER.size:self.HEADER.size + len(payload)] = payload
+        struct.pack_into("<dQ", mm, 16, fetched_at, len(payload))
+        struct.pack_into("<Q", mm, 8, generation + 1)
+        return generation + 1
+
+    def read(self, retries: int = 50):
+        """
+        קריאת ה-snapshot האחרון
+
+        Returns:
+            (flights, fetched_at, generation) או None אם עוד לא פורסם כלום
+        """
+        mm = self._open(create=False)
+        if mm is None:
+            return None
+        for _ in range(retries):
+            magic, before, fetched_at, length = self.HEADER.unpack_from(mm, 0)
+            if magic != self.MAGIC or before == 0:
+                return None
+            if before % 2 == 0:
+                payload = mm[self.HEADER.size:self.HEADER.size + length]
+                if struct.unpack_from("<Q", mm, 8)[0] == before:
+                    return json.loads(payload), fetched_at, before
+            time.sleep(0.001)
+        raise UpstreamUnavailable("shared snapshot busy", 1.0)
+
+
+def split_tiles(top_left: Tuple[float, float], bottom_right: Tuple[float, float],
+                max_degrees: float = None) -> List[Tuple[Tuple[float, float], Tuple[float, float]]]:
     """
-    # NW = (34.25, 33.35)
-    # SE = (35.90, 29.50)
+    חלוקת מלבן לאריחים שווים
 
-    # TOP_LEFT = (32.0573501,34.7737489)      # (latitude, longitude) - שמאל למעלה
-    # BOTTOM_RIGHT = (32.0655618,34.7788870)
-    # TOP_LEFT = (34.25, 33.35)      # (latitude, longitude) - שמאל למעלה
-    # BOTTOM_RIGHT = (35.90, 29.50)
+    Args:
+        top_left, bottom_right: (lat, lon) של המלבן
+        max_degrees: גודל צלע מקסימלי לאריח. None - חלוקה לארבעה רבעים
 
-    TOP_LEFT = (32.5, 34.5)  # (latitude, longitude) - שמאל למעלה
-    BOTTOM_RIGHT = (31.5, 35.5)
+    Returns:
+        רשימת (top_left, bottom_right) שמכסה את המלבן בדיוק
+    """
+    top_lat, left_lon = top_left
+    bottom_lat, right_lon = bottom_right
+    if max_degrees is None:
+        rows = cols = 2
+    else:
+        rows = max(1, int(np.ceil((top_lat - bottom_lat) / max_degrees - 1e-9)))
+        cols = max(1, int(np.ceil((right_lon - left_lon) / max_degrees - 1e-9)))
+    lats = np.linspace(top_lat, bottom_lat, rows + 1)
+    lons = np.linspace(left_lon, right_lon, cols + 1)
+    return [((float(lats[r]), float(lons[c])), (float(lats[r + 1]), float(lons[c + 1])))
+            for r in range(rows) for c in range(cols)]
 
-    points = []
-    # for i in range(5):
-    #    points.append({
-    #        "lat": base_lat + random.uniform(-0.5, 0.5),
-    #        "lng": base_lng + random.uniform(-0.5, 0.5),
-    #        "name": f"נקודה {i+1}",
-    #        "info": f"זמן: {time.strftime('%H:%M:%S')}"
-    #    })
 
-    tracker = FlightTracker()
-    # ff = tracker.get_flights_in_area()
-    # points = tracker.get_flights_in_area((180,-90),(-180,90))
-
-    # flight = tracker.get_flights_in_area((35.90, 29.50),(34.25, 33.35))
-    flight = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
-
-    # for flight1 in flight:
-    #    points.append(flight1)
-
-    for i, flight in enumerate(flight, 1):
-        print(f"\nטיסה                           #{i}      :")
-        print(f"  שם קריאה: {flight['callsign']}")
-        print(f"  רישום: {flight['registration']}")
-        print(f"  מטוס: {flight['aircraft']}")
-        print(f"  חברת תעופה: {flight['airline']}")
-        print(f"  מוצא: {flight['origin']} → יעד: {flight['destination']}")
-        print(f"  מיקום: ({flight['latitude']:.4f}, {flight['longitude']:.4f})")
-        print(f"  גובה: {flight['altitude']} רגל")
-        print(f"  מהירות: {flight['speed']} קשר")
-        print(f"  כיוון: {flight['heading']}°")
-        print(f"  מהירות אנכית: {flight['vertical_speed']} רגל/דקה")
-        points.append({
-            "lat": flight['latitude'],
-            "lng": flight['longitude'],
-            "name": flight['origin'] + "->" + str(flight['destination']),  # + flight['airline'],
-            "info": flight['aircraft'] + " " + str(flight['speed']) + " "
-                    + flight['callsign'] + " "
-                    + str(flight['altitude'])
-            ,
-            "airline": flight['airline'],
-            "callsign": flight['callsign'],
-            "speed": flight['speed'],
-            "altitude": flight['altitude'],
-            "heading": flight['heading'],
-            "aircraft": flight['aircraft']
-        })
+def box_area(box: Tuple[Tuple[float, float], Tuple[float, float]]) -> float:
+    """שטח מלבן (top_left, bottom_right) במעלות רבועות"""
+    (top_lat, left_lon), (bottom_lat, right_lon) = box
+    return max(0.0, top_lat - bottom_lat) * max(0.0, right_lon - left_lon)
 
-    # points.append({
-    #        "lat": (35,90),
-    #        "lng": (37,180),
-    #        "name" : 111,
-    #        "info" : 222
-    #    })
 
-    # tracker.print_flight_info(points)
+def box_contains(outer, inner) -> bool:
+    """האם המלבן inner מוכל כולו ב-outer"""
+    (o_top, o_left), (o_bottom, o_right) = outer
+    (i_top, i_left), (i_bottom, i_right) = inner
+    return o_bottom <= i_bottom and i_top <= o_top and o_left <= i_left and i_right <= o_right
 
-    # points = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
-    # points = tracker.get_flights_in_area((-180,90),(180,-90))
 
-    # 32.05642, 34.77310
-    points.append({
-        "lat": 32.05642,
-        "lng": 34.77310,
-        "name": 'here',
-        "info": 'here'
-    })
+def box_union(a, b):
+    """המלבן הקטן ביותר שמכיל את שניהם"""
+    (a_top, a_left), (a_bottom, a_right) = a
+    (b_top, b_left), (b_bottom, b_right) = b
+    return ((max(a_top, b_top), min(a_left, b_left)), (min(a_bottom, b_bottom), max(a_right, b_right)))
 
-    points.append({
-        #"lat": 32.0791771,  # 32.0720497,
-        #"lng": 34.7031657,  # 34.7296015,
-        "lat" : 32.10137 ,
-        "lng" : 34.71449,
-        "name": '.',
-        "info": '.'
-    })
-    points.append({
-        "lat": 32.0276367,
-        "lng": 34.8127718,
-        "name": '.',
-        "info": '.'
-    })
-    points.append({
-        "lat": 32.065613,  # 32.0577571,
-        "lng": 34.6939822,  # 34.7202464,
-        "name": '.',
-        "info": '.'
-    })
-    points.append({
-        "lat": 32.0446625,
-        "lng": 34.8220416,
-        "name": '.',
-        "info": '.'
-    })
 
-    return jsonify({"points": points})
+def boxes_overlap(a, b) -> bool:
+    (a_top, a_left), (a_bottom, a_right) = a
+    (b_top, b_left), (b_bottom, b_right) = b
+    return a_bottom <= b_top and b_bottom <= a_top and a_left <= b_right and b_left <= a_right
 
 
-@app.route("/data1")
-def data1():
-    """
-    כאן מחזירים JSON שמייצג נקודות.
-    כרגע – דוגמה רנדומלית. במקום זה אתה יכול לקרוא ל-API שלך.
-    הפורמט:
-    {
-      "points": [
-        {"lat": ..., "lng": ..., "name": "...", "info": "..."},
-        ...
-      ]
-    }
+def plan_regions(regions: Dict[str, Tuple[Tuple[float, float], Tuple[float, float]]],
+                 merge_ratio: float = REGION_MERGE_MAX_AREA_RATIO):
     """
-    # NW = (34.25, 33.35)
-    # SE = (35.90, 29.50)
+    בחירת קבוצת המלבנים המינימלית שצריך למשוך מה-upstream כדי לכסות את כל האזורים.
 
-    # TOP_LEFT = (32.0573501,34.7777337489)      # (latitude, longitude) - שמאל למעלה
-    # BOTTOM_RIGHT = (32.0655618,34.7788870)
-    # TOP_LEFT = (34.25, 33.35)      # (latitude, longitude) - שמאל למעלה
-    # BOTTOM_RIGHT = (35.90, 29.50)
+    - אזור שמוכל באזור אחר לא נמשך בנפרד
+    - שני אזורים חופפים מאוחדים למלבן אחד ("a+b") אם המלבן המאחד לא גדול
+      מ-merge_ratio כפול סכום השטחים (כלומר לא מושכים הרבה שטח מת)
 
-    # TOP_LEFT = (32.5, 34.5)      # (latitude, longitude) - שמאל למעלה
-    # BOTTOM_RIGHT = (31.5, 35.5)
-    # changed 10/1/26  # TOP_LEFT = (32.0720497, 34.7296015)  # 32.057, 34.773)      # (latitude, longitude) - שמאל למעלה
-    TOP_LEFT = (32.10137, 34.71449)
-    BOTTOM_RIGHT = (32.0276367, 34.8127718)  # 31.065, 34.778)
+    Returns:
+        (sources, source_of) - המלבנים שנמשכים לפי שם, ולכל אזור מוגדר - שם המקור שלו
+    """
+    sources = dict(regions)
+    changed = True
+    while changed:
+        changed = False
+        names = sorted(sources, key=lambda name: (-box_area(sources[name]), name))
+        for i, a in enumerate(names):
+            for b in names[i + 1:]:
+                if box_contains(sources[a], sources[b]):
+                    del sources[b]
+                elif (boxes_overlap(sources[a], sources[b]) and
+                      box_area(box_union(sources[a], sources[b])) <=
+                      merge_ratio * (box_area(sources[a]) + box_area(sources[b]))):
+                    sources[f"{a}+{b}"] = box_union(sources.pop(a), sources.pop(b))
+                else:
+                    continue
+                changed = True
+                break
+            if changed:
+                break
+
+    source_of = {
+        name: next(source for source, box in sources.items() if box_contains(box, regions[name]))
+        for name in regions
+    }
+    return sources, source_of
 
-    points = []
 
-    tracker = FlightTracker()
+def clip_snapshot(snapshot: Snapshot, top_left: Tuple[float, float],
+                  bottom_right: Tuple[float, float]) -> Snapshot:
+    """
+    snapshot של תת-אזור, שנגזר מקומית מ-snapshot של אזור שמכיל אותו.
+    אותו fetched_at ו-generation כמו המקור (זה אותו מידע בדיוק).
+    """
+    arrays = snapshot.arrays()
+    lat, lon = arrays["lat"], arrays["lon"]
+    inside = np.flatnonzero((bottom_right[0] <= lat) & (lat <= top_left[0]) &
+                            (top_left[1] <= lon) & (lon <= bottom_right[1]))
+    flights = [snapshot.flights[i] for i in inside]
+    return Snapshot(flights, snapshot.fetched_at, snapshot.generation)
 
-    # flight = tracker.get_flights_in_area((35.90, 29.50),(34.25, 33.35))
-    flight = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
-
-
-  
-    for i, flight in enumerate(flight, 1):
-        print(f"\nטיסה                           #{i}      :")
-        print(f"  שם קריאה: {flight['callsign']}")
-        print(f"  רישום: {flight['registration']}")
-        print(f"  מטוס: {flight['aircraft']}")
-        print(f"  חברת תעופה: {flight['airline']}")
-        print(f"  מוצא: {flight['origin']} → יעד: {flight['destination']}")
-        print(f"  מיקום: ({flight['latitude']:.4f}, {flight['longitude']:.4f})")
-        print(f"  גובה: {flight['altitude']} רגל")
-        print(f"  מהירות: {flight['speed']} קשר")
-        print(f"  כיוון: {flight['heading']}°")
-        print(f"  מהירות אנכית: {flight['vertical_speed']} רגל/דקה")
-        points.append({
-            "lat": flight['latitude'],
-            "lng": flight['longitude'],
-            "name": flight['origin'] + "->" + str(flight['destination']),  # + flight['airline'],
-            "info": flight['aircraft'] + " " + str(flight['speed']) + " "
-                    + flight['callsign'] + " "
-                    + str(flight['altitude'])
-            ,
-            "airline": flight['airline'],
-            "callsign": flight['callsign'],
-            "speed": flight['speed'],
-            "altitude": flight['altitude'],
-            "heading": flight['heading'],
-            "aircraft": flight['aircraft']
-        })
 
-    # points.append({
-    #        "lat": (35,90),
-    #        "lng": (37,180),
-    #        "name" : 111,
-    #        "info" : 222
-    #    })
+def receiver_aircraft(entry: Dict, now: float):
+    """
+    מטוס אחד מ-aircraft.json של dump1090 / readsb בצורה של טיסה (כמו fetch_tile),
+    עם זמני המדידה לכל קבוצת שדות (position_time / state_time).
+    שדה שהמקלט לא דיווח נשאר None. מטוס בלי מיקום - None.
 
-    # tracker.print_flight_info(points)
+    Raises:
+        AttributeError / TypeError / ValueError אם הרשומה לא במבנה הצפוי
+    """
+    hex_id = str(entry.get("hex") or "").strip().upper()
+    if not hex_id or entry.get("lat") is None or entry.get("lon") is None:
+        return None
+    seen = float(entry.get("seen", 0.0))
+    altitude = entry.get("alt_baro", entry.get("altitude"))
+    if altitude == "ground":
+        altitude = 0
+    speed = entry.get("gs", entry.get("speed"))
+    heading = entry.get("track")
+    vertical_speed = entry.get("baro_rate", entry.get("geom_rate", entry.get("vert_rate")))
+    callsign = (entry.get("flight") or "").strip()
+    return {
+        'icao_24bit': hex_id,
+        'callsign': callsign or 'N/A',
+        'registration': entry.get("r") or 'N/A',
+        'aircraft': entry.get("t") or 'N/A',
+        # ב-ADS-B אין חברה; שלוש האותיות הראשונות של אות הקריאה הן קוד ה-ICAO שלה
+        'airline': callsign[:3] if len(callsign) > 3 and callsign[:3].isalpha() else 'N/A',
+        'latitude': float(entry["lat"]),
+        'longitude': float(entry["lon"]),
+        'altitude': None if altitude is None else int(altitude),
+        'speed': None if speed is None else int(round(speed)),
+        'heading': None if heading is None else int(round(heading)),
+        'vertical_speed': None if vertical_speed is None else int(vertical_speed),
+        'position_time': now - float(entry.get("seen_pos", seen)),
+        'state_time': now - seen,
+    }
 
-    # points = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
-    # points = tracker.get_flights_in_area((-180,90),(180,-90))
 
-    # 32.05642, 34.77310
+def local_flight(aircraft: Dict) -> Dict:
+    """טיסה שנראית רק במקלט המקומי"""
+    return {
+        'id': AIRCRAFT_ID_PREFIX + aircraft['icao_24bit'].lower(),
+        'callsign': aircraft['callsign'],
+        'registration': aircraft['registration'],
+        'aircraft': aircraft['aircraft'],
+        'airline': aircraft['airline'],
+        'origin': 'N/A',
+        'destination': 'N/A',
+        'latitude': aircraft['latitude'],
+        'longitude': aircraft['longitude'],
+        'altitude': aircraft['altitude'] or 0,
+        'speed': aircraft['speed'] or 0,
+        'heading': aircraft['heading'] or 0,
+        'vertical_speed': aircraft['vertical_speed'] or 0,
+        'icao_24bit': aircraft['icao_24bit'],
+        'position_time': aircraft['position_time'],
+        'upstream_id': 'N/A',
+    }
 
-    # 32.10137, 34.71449
 
+def aircraft_keyed(flights: List[Dict]) -> List[Dict]:
+    """
+    טיסות FlightRadar24 עם מזהה לפי קוד ה-ICAO (ראו AIRCRAFT_ID_PREFIX), כך שמטוס
+    שומר על אותו id כשהוא עובר בין "רק במקלט", "בשני המקורות" ו"רק ב-FlightRadar24"
+    (אחרת גדרות, סטטיסטיקה ו-viewport רואים יציאה וכניסה). טיסה בלי hex שומרת
+    על המזהה שלה; מטוס שמופיע פעמיים (אותו hex) נשאר עם המיקום החדש יותר.
+    """
+    keyed: Dict[str, Dict] = {}
+    for flight in flights:
+        hex_id = flight.get('icao_24bit', 'N/A')
+        if hex_id != 'N/A':
+            flight = dict(flight, id=AIRCRAFT_ID_PREFIX + hex_id.lower(), upstream_id=flight['id'])
+        current = keyed.get(flight['id'])
+        if current is None or flight.get('position_time', 0) > current.get('position_time', 0):
+            keyed[flight['id']] = flight
+    return list(keyed.values())
+
+
+def merge_receiver(flights: List[Dict], fetched_at: float, local: List[Dict],
+                   keep_unmatched: bool = True) -> List[Dict]:
+    """
+    מיזוג מטוסי המקלט המקומי לתוך טיסות FlightRadar24.
+
+    התאמה לפי קוד ה-ICAO (hex) ואם אין - לפי רישום. בטיסה מותאמת כל קבוצה
+    ב-MERGE_FRESHEST_FIELDS נלקחת מהמקלט אם המדידה שלו חדשה מזו של
+    FlightRadar24 (position_time של הטיסה, ואם אין - fetched_at), ושדות MERGE_UPSTREAM_FIELDS נשארים של FlightRadar24 (המקלט משלים רק 'N/A').
+    מטוס שאין לו התאמה נוסף עם מזהה AIRCRAFT_ID_PREFIX + hex.
+
+    Args:
+        flights: טיסות FlightRadar24 (לא משתנות - טיסה מותאמת מועתקת)
+        fetched_at: מתי נמשכו
+        local: מטוסים מ-LocalReceiver.aircraft
+        keep_unmatched: להשאיר טיסות שרק FlightRadar24 ראה. False כשהתוצאה
+                        שלו ישנה מדי - אין מי שיעדכן את המיקום שלהן
+
+    Returns:
+        רשימת הטיסות הממוזגת
+    """
+    by_hex: Dict[str, int] = {}
+    by_registration: Dict[str, int] = {}
+    for i, flight in enumerate(flights):
+        # snapshots שנשמרו לפני שהוספנו icao_24bit
+        hex_id = flight.get('icao_24bit', 'N/A')
+        if hex_id != 'N/A':
+            by_hex[hex_id] = i
+        if flight['registration'] != 'N/A':
+            by_registration[normalize_key(flight['registration'])] = i
+
+    merged = list(flights)
+    matched = set()
+    local_only = []
+    for aircraft in local:
+        i = by_hex.get(aircraft['icao_24bit'])
+        if i is None and aircraft['registration'] != 'N/A':
+            i = by_registration.get(normalize_key(aircraft['registration']))
+        if i is None:
+            local_only.append(local_flight(aircraft))
+            continue
+        matched.add(i)
+        flight = dict(merged[i])
+        measured_at = min(flight.get('position_time') or fetched_at, fetched_at)
+        for group, fields in MERGE_FRESHEST_FIELDS.items():
+            if aircraft[f"{group}_time"] > measured_at:
+                for field in fields:
+                    if aircraft[field] is not None:
+                        flight[field] = aircraft[field]
+        if aircraft['position_time'] > measured_at:
+            flight['position_time'] = aircraft['position_time']
+        for field in MERGE_UPSTREAM_FIELDS:
+            if flight.get(field, 'N/A') == 'N/A' and aircraft.get(field, 'N/A') != 'N/A':
+                flight[field] = aircraft[field]
+        merged[i] = flight
+    if not keep_unmatched:
+        merged = [merged[i] for i in sorted(matched)]
+    return merged + local_only
+
+
+class LocalReceiver:
+    """
+    מטוסים ממקלט ADS-B מקומי (dump1090 / readsb).
 
-    points.append({
-        "lat": 32.05642,
-        "lng": 34.77310,
-        "name": 'here',
-        "info": 'here'
-    })
+    source הוא נתיב ל-aircraft.json (המפענח כותב אותו כל שנייה; נקרא מחדש
+    רק כשה-mtime משתנה), או tcp://host:port לזרם JSON שורה-למטוס. הזרם
+    נקרא ב-thread ברקע שמתחבר מחדש אחרי ניתוק, ונפתח רק בשימוש הראשון.
+    """
 
-    return jsonify({"points": points})
+    def __init__(self, source: str, max_age: float = LOCAL_RECEIVER_MAX_AGE_SECONDS,
+                 healthy_seconds: float = LOCAL_RECEIVER_HEALTHY_SECONDS):
+        self.source = source
+        self.max_age = max_age
+        self.healthy_seconds = healthy_seconds
+        self.errors = 0
+        self._aircraft: Dict[str, Dict] = {}
+        # זמן העדכון האחרון מהמקלט (time.time)
+        self._updated = 0.0
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._address = None
+        self._stream_thread = None
+        if source.startswith("tcp://"):
+            host, _, port = source[len("tcp://"):].rpartition(":")
+            self._address = (host, int(port))
+
+    def healthy(self) -> bool:
+        return time.time() - self._updated <= self.healthy_seconds
+
+    def aircraft(self, top_left: Tuple[float, float], bottom_right: Tuple[float, float]):
+        """
+        המטוסים במלבן שהמיקום שלהם צעיר מ-max_age
 
+        Returns:
+            רשימה (אולי ריקה), או None אם המקלט לא חי - ואז אין לסמוך עליו
+        """
+        if self._address is None:
+            self._read_file()
+        elif self._stream_thread is None:
+            self._stream_thread = threading.Thread(target=self._stream, name="adsb-stream", daemon=True)
+            self._stream_thread.start()
+        if not self.healthy():
+            return None
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            if self._address is not None:
+                # בזרם מטוס שיצא מהטווח פשוט מפסיק להופיע
+                for hex_id in [h for h, a in self._aircraft.items() if a['position_time'] < cutoff]:
+                    del self._aircraft[hex_id]
+            aircraft = list(self._aircraft.values())
+        return [a for a in aircraft
+                if a['position_time'] >= cutoff
+                and bottom_right[0] <= a['latitude'] <= top_left[0]
+                and top_left[1] <= a['longitude'] <= bottom_right[1]]
+
+    def status(self) -> Dict:
+        with self._lock:
+            count = len(self._aircraft)
+        return {
+            "source": self.source,
+            "healthy": self.healthy(),
+            "age": round(time.time() - self._updated, 1) if self._updated else None,
+            "aircraft": count,
+            "errors": self.errors,
+        }
+
+    def _read_file(self):
+        try:
+            mtime = os.stat(self.source).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.source, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # המפענח באמצע כתיבה - ננסה שוב ברענון הבא
+            self.errors += 1
+            return
+        try:
+            now = float(data.get("now", mtime))
+            entries = list(data.get("aircraft", []))
+        except (AttributeError, TypeError, ValueError):
+            # קובץ שלם אבל לא במבנה של aircraft.json
+            self.errors += 1
+            return
+        aircraft = {}
+        for entry in entries:
+            try:
+                parsed = receiver_aircraft(entry, now)
+            except (AttributeError, TypeError, ValueError):
+                self.errors += 1
+                continue
+            if parsed is not None:
+                aircraft[parsed['icao_24bit']] = parsed
+        with self._lock:
+            self._aircraft = aircraft
+            self._updated = now
+            self._mtime = mtime
+
+    def _stream(self):
+        backoff = 1.0
+        while True:
+            try:
+                with socket.create_connection(self._address, timeout=self.healthy_seconds) as conn:
+                    backoff = 1.0
+                    for line in conn.makefile("r", encoding="utf-8"):
+                        now = time.time()
+                        # שורה פגומה מדלגים עליה; חריגה כאן הייתה הורגת את ה-thread בשקט
+                        try:
+                            entry = json.loads(line)
+                            parsed = receiver_aircraft(entry, float(entry.get("now", now)))
+                        except (AttributeError, TypeError, ValueError):
+                            self.errors += 1
+                            continue
+                        with self._lock:
+                            self._updated = now
+                            if parsed is not None:
+                                self._aircraft[parsed['icao_24bit']] = parsed
+            except OSError as e:
+                self.errors += 1
+                print(f"מקלט ADS-B ({self.source}) לא זמין: {e}", file=sys.stderr)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+class SnapshotStore:
+    """
+    מחזיק את ה-snapshot האחרון לכל אזור ומרענן אותו לפי הצורך.
+
+    - snapshot טרי (צעיר מ-ttl) מוגש ישירות בלי לפנות ל-upstream
+    - רענון עובר דרך ה-TokenBucket וה-CircuitBreaker
+    - אם הרענון נכשל או נחסם, מוגש ה-snapshot הטוב האחרון עם stale=True
+
+    אזורים שמוכלים באזור אחר (או חופפים לו) לא נמשכים בנפרד: plan_regions
+    בוחר את קבוצת המקורות המינימלית, ואת השאר גוזרים מקומית מכל snapshot חדש
+    של המקור (ראו clip_snapshot).
+
+    עם receiver (מקלט ADS-B מקומי חי) כל רענון ממזג את המקלט לתוך תוצאת
+    FlightRadar24 האחרונה (merge_receiver), ול-upstream פונים רק פעם
+    ב-LOCAL_RECEIVER_UPSTREAM_TTL_SECONDS. אם ה-upstream לא זמין ממשיכים
+    עם התוצאה הקודמת שלו, עד LOCAL_RECEIVER_UPSTREAM_MAX_AGE_SECONDS - ואחר
+    כך רק עם מה שהמקלט רואה. מזהי הטיסות לפי קוד ה-ICAO (aircraft_keyed).
+
+    עם shared_dir יש שני תפקידים:
+      reader - (ברירת מחדל, workers של ה-HTTP) קורא snapshots מהקבצים המשותפים
+               ולא פונה ל-upstream בכלל
+      ingest - (become_ingest) מושך מה-upstream ומפרסם לקבצים המשותפים
+    """
+
+    def __init__(self, tracker: FlightTracker, regions: Dict[str, Tuple[Tuple[float, float], Tuple[float, float]]],
+                 limiter: TokenBucket, breaker: CircuitBreaker, ttl: float, shared_dir: str = None,
+                 persist_dir: str = None, receiver: LocalReceiver = None):
+        self.tracker = tracker
+        self.regions = regions
+        # מה באמת נמשך מה-upstream, ומאיזה מקור נגזר כל אזור מוגדר
+        self.sources, self.source_of = plan_regions(regions)
+        self._derived_regions: Dict[str, List[str]] = {}
+        for name, source in self.source_of.items():
+            if name != source:
+                self._derived_regions.setdefault(source, []).append(name)
+        self.limiter = limiter
+        self.breaker = breaker
+        for name, box in self.sources.items():
+            count = len(split_tiles(*box, TILE_MAX_DEGREES))
+            if count > limiter.capacity:
+                raise ValueError(f"האזור {name} דורש {count} אריחים ברענון, אבל ה-burst של ה-upstream הוא "
+                                 f"{limiter.capacity} - הרענון לעולם לא יסתיים (הגדילו את UPSTREAM_BURST)")
+        self.ttl = ttl
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._locks = {name: threading.Lock() for name in self.sources}
+        self._generation = 0
+        self._listeners: Dict[str, List] = {}
+        self._tile_pool = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix="tile")
+        self.persist_dir = persist_dir
+        self._persisted_at: Dict[str, float] = {}
+        self._stale_logged_at: Dict[str, float] = {}
+        self.receiver = receiver
+        # התוצאה האחרונה מה-upstream לכל מקור: (flights, fetched_at)
+        self._upstream: Dict[str, Tuple[List[Dict], float]] = {}
+        # רענונים שלא פנו ל-upstream כי המקלט המקומי כיסה את האזור
+        self.upstream_skipped = 0
+        self.role = "standalone"
+        self._shared: Dict[str, SharedSnapshotFile] = {}
+        if shared_dir:
+            self.role = "reader"
+            self._shared = {
+                name: SharedSnapshotFile(os.path.join(shared_dir, f"{name}.snap")) for name in self.sources
+            }
+
+    def become_ingest(self):
+        """התהליך הזה הוא היחיד שפונה ל-upstream ומפרסם לשאר"""
+        if not self._shared:
+            raise RuntimeError("ingest דורש RADAR_SHARED_DIR")
+        self.role = "ingest"
+
+    def add_listener(self, region: str, callback):
+        """callback(snapshot) ייקרא אחרי כל snapshot חדש של האזור"""
+        self._listeners.setdefault(region, []).append(callback)
+
+    def peek(self, region: str):
+        """ה-snapshot האחרון של האזור (או None) בלי לרענן"""
+        return self._snapshots.get(region)
+
+    def get(self, region: str) -> Tuple[Snapshot, bool]:
+        """
+        החזרת snapshot לאזור
+
+        Returns:
+            (snapshot, stale) - stale=True אם הרענון נכשל, או שה-snapshot
+            שמוגש (בזמן שמישהו אחר מרענן) ישן מ-SNAPSHOT_STALE_AFTER_SECONDS
+
+        Raises:
+            UpstreamUnavailable אם אין שום snapshot קודם להגיש
+        """
+        source = self.source_of.get(region, region)
+        if source != region:
+            # אזור נגזר מתעדכן יחד עם המקור שלו (_install)
+            _, stale = self.get(source)
+            return self._snapshots[region], stale
+
+        snapshot = self._snapshots.get(region)
+        if snapshot is not None and snapshot.age() < self.ttl:
+            return snapshot, self._too_old(snapshot)
+
+        lock = self._locks[region]
+        # אם מישהו אחר כבר מרענן - מגישים את מה שיש ולא מחכים
+        if not lock.acquire(blocking=snapshot is None):
+            stale = self._too_old(snapshot)
+            if stale:
+                self._log_stale(region, f"רענון תקוע, מגישים snapshot בן {snapshot.age():.0f} שניות")
+            return snapshot, stale
+        try:
+            # ייתכן שהרענון הושלם בזמן שחיכינו למנעול
+            current = self._snapshots.get(region)
+            if current is not None and current.age() < self.ttl:
+                return current, self._too_old(current)
+            return self._refresh(region), False
+        except UpstreamUnavailable as e:
+            # ייתכן שהרענון התקין snapshot ישן ורק אז נכשל (ingest תקוע)
+            snapshot = snapshot or self._snapshots.get(region)
+            if snapshot is None:
+                raise
+            self._log_stale(region, f"upstream לא זמין ({e.reason}), מגישים snapshot בן {snapshot.age():.0f} שניות")
+            return snapshot, True
+        finally:
+            lock.release()
+
+    def _too_old(self, snapshot: Snapshot) -> bool:
+        return snapshot.age() > max(self.ttl, SNAPSHOT_STALE_AFTER_SECONDS)
+
+    def _log_stale(self, region: str, message: str):
+        now = time.monotonic()
+        if now - self._stale_logged_at.get(region, -STALE_LOG_INTERVAL_SECONDS) >= STALE_LOG_INTERVAL_SECONDS:
+            self._stale_logged_at[region] = now
+            print(f"{region}: {message}", file=sys.stderr)
+
+    def call_upstream(self, fn, *args, wait: float = 0.0, prepaid: bool = False):
+        """
+        קריאה ל-upstream דרך הגבלת הקצב והמפסק של ה-snapshots (ראו call_guarded).
+        פרטי טיסה עוברים דרך תקציב נפרד (fetch_flight_details).
+
+        Args:
+            prepaid: האסימון כבר נלקח (_reserve_tiles) - רק המפסק נבדק
+        """
+        return call_guarded(None if prepaid else self.limiter, self.breaker, fn, *args, wait=wait)
+
+    def _reserve_tiles(self, count: int, wait: float):
+        """
+        לקיחת האסימונים לסבב אריחים שלם בבת אחת. אם אין מספיק (או שהמפסק
+        פתוח) לא נלקח כלום - אחרת רענון שלא יכול להסתיים היה מבזבז אסימונים.
+
+        Raises:
+            UpstreamUnavailable אם אי אפשר לשלם על הסבב
+        """
+        if self.breaker.retry_in() > 0:
+            raise UpstreamUnavailable("circuit open", self.breaker.retry_in())
+        if count > self.limiter.capacity:
+            raise UpstreamUnavailable(f"{count} tiles > burst {self.limiter.capacity}", MAX_POLL_SECONDS)
+        if not self.limiter.acquire(count, timeout=wait):
+            raise UpstreamUnavailable(f"rate limited ({count} tiles)", self.limiter.wait_time(count))
+
+    def _refresh(self, region: str) -> Snapshot:
+        if self.role == "reader":
+            return self._refresh_from_shared(region)
+
+        top_left, bottom_right = self.sources[region]
+        local = self.receiver.aircraft(top_left, bottom_right) if self.receiver else None
+        if local is None:
+            flights = self._fetch_upstream(region)
+            fetched_at = time.time()
+        else:
+            base = self._upstream.get(region)
+            if base is None or time.time() - base[1] >= LOCAL_RECEIVER_UPSTREAM_TTL_SECONDS:
+                try:
+                    self._fetch_upstream(region)
+                    base = self._upstream[region]
+                except UpstreamUnavailable as e:
+                    self._log_stale(region, f"upstream לא זמין ({e.reason}), ממשיכים עם המקלט המקומי")
+                    base = base or ([], 0.0)
+            else:
+                self.upstream_skipped += 1
+            fetched_at = time.time()
+            flights = merge_receiver(base[0], base[1], local,
+                                     keep_unmatched=fetched_at - base[1] <= LOCAL_RECEIVER_UPSTREAM_MAX_AGE_SECONDS)
+
+        self._persist(region, flights, fetched_at)
+        return self._publish(region, flights, fetched_at)
+
+    def _fetch_upstream(self, region: str) -> List[Dict]:
+        flights = self.fetch_region(*self.sources[region])
+        if self.receiver is not None:
+            # גם כשהמקלט לא חי, כדי שהמזהים לא יתחלפו כשהוא חוזר
+            flights = aircraft_keyed(flights)
+        self._upstream[region] = (flights, time.time())
+        return flights
+
+    def find(self, flight_id: str):
+        """הטיסה עם המזהה הזה ב-snapshot האחרון של אחד האזורים (או None)"""
+        for snapshot in list(self._snapshots.values()):
+            flight = snapshot.by_id().get(flight_id)
+            if flight is not None:
+                return flight
+        return None
+
+    def _publish(self, region: str, flights: List[Dict], fetched_at: float) -> Snapshot:
+        if self.role == "ingest":
+            generation = self._shared[region].write(flights, fetched_at)
+        else:
+            self._generation += 1
+            generation = self._generation
+        return self._install(region, Snapshot(flights, fetched_at, generation))
+
+    def _persist_path(self, region: str) -> str:
+        return os.path.join(self.persist_dir, f"snapshot-{region}.json")
+
+    def _persist(self, region: str, flights: List[Dict], fetched_at: float):
+        """שמירת ה-snapshot לדיסק, לכל היותר פעם ב-SNAPSHOT_PERSIST_INTERVAL_SECONDS"""
+        if not self.persist_dir or fetched_at - self._persisted_at.get(region, 0.0) < SNAPSHOT_PERSIST_INTERVAL_SECONDS:
+            return
+        self._persisted_at[region] = fetched_at
+        path = self._persist_path(region)
+        try:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"fetched_at": fetched_at, "flights": flights}, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"לא הצלחנו לשמור את ה-snapshot של {region}: {e}", file=sys.stderr)
+
+    def warm_start(self, refresh: bool = True):
+        """
+        טעינת ה-snapshots האחרונים מהדיסק, כך שהבקשה הראשונה נענית מיד.
+
+        Args:
+            refresh: להתחיל רענון מה-upstream ברקע. בינתיים בקשות מקבלות את
+                     ה-snapshot השמור (המנעול תפוס ולכן לא מחכים לרענון)
+        """
+        if self.role == "reader" or not self.persist_dir:
+            return
+        for region in self.sources:
+            if region in self._snapshots:
+                continue
+            try:
+                with open(self._persist_path(region), encoding="utf-8") as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if time.time() - saved["fetched_at"] > WARM_SNAPSHOT_MAX_AGE_SECONDS:
+                continue
+            self._persisted_at[region] = saved["fetched_at"]
+            self._publish(region, saved["flights"], saved["fetched_at"])
+        if refresh:
+            threading.Thread(target=self._refresh_all, name="warm-refresh", daemon=True).start()
+
+    def _refresh_all(self):
+        for region in self.sources:
+            try:
+                self.get(region)
+            except UpstreamUnavailable as e:
+                print(f"רענון ראשון של {region} נכשל ({e.reason})", file=sys.stderr)
+
+    def fetch_region(self, top_left: Tuple[float, float],
+                     bottom_right: Tuple[float, float]) -> List[Dict]:
+        """
+        משיכת כל הטיסות במלבן. מלבן קטן - קריאה אחת; מלבן גדול מ-TILE_MAX_DEGREES
+        מחולק לאריחים שנמשכים במקביל ומאוחדים לפי מזהה טיסה (טיסה על גבול
+        בין אריחים מופיעה פעם אחת). אריח שחזר מלא מחולק לארבעה ונמשך שוב.
+
+        כל אריח עולה אסימון, ואסימוני הסבב נלקחים מראש בבת אחת (_reserve_tiles):
+        אם אין מספיק, הרענון נכשל מיד בלי לבזבז כלום והאסימונים מצטברים
+        לרענון הבא. אריח שנכשל מכשיל את כל הרענון - עדיף snapshot ישן ושלם על
+        חדש עם חור. אם אין אסימונים לחלוקת אריח מלא, נשארים עם מה שהוא החזיר.
+        """
+        tiles = split_tiles(top_left, bottom_right, TILE_MAX_DEGREES)
+        # המקרה הרגיל (אריח אחד) לא מחכה לאסימון; אזור באריחים מוכן לחכות קצת
+        self._reserve_tiles(len(tiles), 0.0 if len(tiles) == 1 else TILE_TOKEN_WAIT_SECONDS)
+        limit = self.tracker.result_limit()
+        merged: Dict[str, Dict] = {}
+        depth = 0
+        # סבב אחרי סבב (ולא רקורסיה בתוך ה-pool) כדי שאריח לא יחכה לתת-אריחים
+        # שלו על אותו pool ויחסום worker
+        while tiles:
+            if len(tiles) == 1:
+                results = [self.call_upstream(self.tracker.fetch_tile, *tiles[0], prepaid=True)]
+            else:
+                results = list(self._tile_pool.map(
+                    lambda tile: self.call_upstream(self.tracker.fetch_tile, *tile, prepaid=True), tiles))
+            saturated = []
+            for tile, (flights, raw_count) in zip(tiles, results):
+                for flight in flights:
+                    merged[flight['id']] = flight
+                if raw_count >= limit and depth < TILE_MAX_SPLIT_DEPTH:
+                    saturated.extend(split_tiles(*tile, max_degrees=None))
+            if saturated:
+                try:
+                    self._reserve_tiles(len(saturated), TILE_TOKEN_WAIT_SECONDS)
+                except UpstreamUnavailable as e:
+                    print(f"לא מחלקים {len(saturated) // 4} אריחים מלאים ({e.reason}) - ייתכן שחסרות טיסות", file=sys.stderr)
+                    saturated = []
+            tiles = saturated
+            depth += 1
+        return list(merged.values())
+
+    def _refresh_from_shared(self, region: str) -> Snapshot:
+        shared = self._shared[region]
+        current = self._snapshots.get(region)
+        if current is None or shared.generation() != current.generation:
+            published = shared.read()
+            if published is not None:
+                flights, fetched_at, generation = published
+                current = self._install(region, Snapshot(flights, fetched_at, generation))
+        if current is None:
+            raise UpstreamUnavailable("waiting for ingest", 1.0)
+        if current.age() > INGEST_STALE_AFTER_SECONDS:
+            raise UpstreamUnavailable("ingest stalled", self.ttl)
+        return current
+
+    def _install(self, region: str, snapshot: Snapshot) -> Snapshot:
+        self._snapshots[region] = snapshot
+        for callback in self._listeners.get(region, []):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                # מאזין שנכשל לא מפיל את הגשת הנתונים
+                print(f"שגיאה במאזין ל-{region}: {type(e).__name__}: {e}", file=sys.stderr)
+        for name in self._derived_regions.get(region, []):
+            self._install(name, clip_snapshot(snapshot, *self.regions[name]))
+        return snapshot
+
+
+# ---------------------------------------------------------------------------
+# טבלאות ייחוס: שמות חברות תעופה וסוגי מטוסים
+# ---------------------------------------------------------------------------
+
+class ReferenceTable:
+    """
+    טבלת ייחוס (קוד -> שם) שנטענת פעם אחת בזיכרון.
+
+    סדר הטעינה: קובץ מצורף (data/) ועליו ה-cache המקומי (cache/).
+    אם יש loader (למשל FlightRadar24) והמידע ישן מ-ttl, מרעננים ברקע
+    ושומרים ל-cache - החיפוש עצמו תמיד O(1) ולא מחכה לרשת.
+
+    may_refresh() אומר אם התהליך הזה הוא שמרענן. אם לא (worker בפריסה
+    מרובת תהליכים) רק טוענים מחדש את ה-cache כשהתהליך המרענן כותב אותו.
+    """
+
+    def __init__(self, name: str, loader=None, ttl: float = REFERENCE_TTL_SECONDS, may_refresh=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.may_refresh = may_refresh
+        self.bundled_path = os.path.join(DATA_DIR, f"{name}.json")
+        self.cache_path = os.path.join(CACHE_DIR, f"{name}.json")
+        self._table: Dict[str, str] = {}
+        self._bundled: Dict[str, str] = {}
+        self._next_refresh = 0.0
+        self._cache_mtime = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """טעינה מהדיסק בלבד (מהיר, מתאים לזמן עליית השרת)"""
+        self._cache_mtime = self._mtime(self.cache_path)
+        self._bundled = self._read_json(self.bundled_path) or {}
+        table = dict(self._bundled)
+        cached = self._read_json(self.cache_path)
+        if cached:
+            table.update(cached.get("data", {}))
+            self._next_refresh = cached.get("fetched_at", 0.0) + self.ttl
+        self._table = table
+        return self
+
+    @staticmethod
+    def _mtime(path: str):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    @staticmethod
+    def _read_json(path: str):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, code: str):
+        """שם לפי קוד (או None)"""
+        self.maybe_refresh()
+        return self._table.get(code)
+
+    def maybe_refresh(self):
+        """רענון ברקע אם הגיע הזמן (או טעינה מחדש של ה-cache, אם לא אנחנו מרעננים)"""
+        now = time.time()
+        if self.loader is None or now < self._next_refresh:
+            return
+        if self.may_refresh is None or self.may_refresh():
+            self._refresh_in_background()
+            return
+        if self._mtime(self.cache_path) != self._cache_mtime:
+            self.load()
+        self._next_refresh = max(self._next_refresh, now + REFERENCE_RELOAD_CHECK_SECONDS)
+
+    def __len__(self):
+        return len(self._table)
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name=f"refresh-{self.name}", daemon=True).start()
+
+    def refresh(self):
+        """הורדה מחדש מה-loader ושמירה ל-cache"""
+        try:
+            fetched = self.loader()
+            now = time.time()
+            self._install(fetched)
+            self._next_refresh = now + self.ttl
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            self._save(fetched, now)
+            self._cache_mtime = self._mtime(self.cache_path)
+        except Exception as e:
+            print(f"רענון {self.name} נכשל: {type(e).__name__}: {e}")
+            self._next_refresh = time.time() + REFERENCE_RETRY_SECONDS
+        finally:
+            self._refreshing = False
+
+    def _install(self, fetched):
+        self._table = {**self._bundled, **fetched}
+
+    def _save(self, fetched, fetched_at: float):
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"fetched_at": fetched_at, "data": fetched}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+
+AIRPORT_DTYPE = np.dtype([
+    ("iata", "S3"),
+    ("icao", "S4"),
+    ("lat", "f4"),
+    ("lon", "f4"),
+    ("country", "u2"),  # אינדקס לרשימת המדינות
+])
+
+
+class AirportIndex(ReferenceTable):
+    """
+    אינדקס שדות תעופה (קוד IATA -> קואורדינטות, מדינה).
+
+    נשמר כמערך numpy דחוס (18 בתים לשדה) ממוין לפי IATA, שנטען מה-cache
+    עם mmap - כך כמה תהליכים חולקים את אותם דפי זיכרון. החיפוש הוא
+    binary search וקטורי על כל ה-snapshot בבת אחת.
+    """
+
+    def __init__(self, loader=None, ttl: float = REFERENCE_TTL_SECONDS, may_refresh=None):
+        super().__init__("airports", loader, ttl, may_refresh)
+        self.array_path = os.path.join(CACHE_DIR, "airports.npy")
+        self._airports = np.zeros(0, dtype=AIRPORT_DTYPE)
+        self._countries: List[str] = []
+
+    @staticmethod
+    def pack(rows: List[Dict]):
+        """רשימת שדות תעופה -> (מערך דחוס ממוין לפי IATA, רשימת מדינות)"""
+        countries: Dict[str, int] = {}
+        packed = []
+        for row in rows:
+            iata = (row.get("iata") or "").upper()
+            if len(iata) != 3 or row.get("lat") is None or row.get("lon") is None:
+                continue
+            country = countries.setdefault(row.get("country") or "", len(countries))
+            packed.append((iata.encode("ascii", "ignore"), (row.get("icao") or "").encode("ascii", "ignore"),
+                           row["lat"], row["lon"], country))
+        airports = np.array(packed, dtype=AIRPORT_DTYPE)
+        airports.sort(order="iata")
+        return airports, list(countries)
+
+    def load(self):
+        # _save כותב את המערך לפני ה-meta, כך ש-mtime חדש של ה-meta מבטיח מערך חדש
+        self._cache_mtime = self._mtime(self.cache_path)
+        meta = self._read_json(self.cache_path)
+        if meta and os.path.exists(self.array_path):
+            self._airports = np.load(self.array_path, mmap_mode="r")
+            self._countries = meta.get("data", [])
+            self._next_refresh = meta.get("fetched_at", 0.0) + self.ttl
+        else:
+            self._airports, self._countries = self.pack(self._read_json(self.bundled_path) or [])
+        return self
+
+    def _install(self, fetched):
+        self._airports, self._countries = self.pack(fetched)
+
+    def _save(self, fetched, fetched_at: float):
+        tmp_path = self.array_path + ".tmp.npy"
+        np.save(tmp_path, self._airports)
+        os.replace(tmp_path, self.array_path)
+        # לצד המערך נשמרים זמן ההורדה ורשימת המדינות
+        super()._save(self._countries, fetched_at)
+
+    def lookup(self, codes: List[str]) -> np.ndarray:
+        """אינדקסים במערך לכל קוד IATA (-1 אם לא נמצא)"""
+        self.maybe_refresh()
+        airports = self._airports
+        if len(airports) == 0 or not codes:
+            return np.full(len(codes), -1, dtype=np.int64)
+        keys = np.array([(code or "").encode("ascii", "ignore")[:3] for code in codes], dtype="S3")
+        idx = np.searchsorted(airports["iata"], keys)
+        idx = np.minimum(idx, len(airports) - 1)
+        return np.where(airports["iata"][idx] == keys, idx, -1)
+
+    def get(self, code: str):
+        """פרטי שדה תעופה לפי IATA (או None)"""
+        i = int(self.lookup([code])[0])
+        if i < 0:
+            return None
+        airport = self._airports[i]
+        return {
+            "iata": code.upper(),
+            "icao": airport["icao"].decode(),
+            "lat": float(airport["lat"]),
+            "lon": float(airport["lon"]),
+            "country": self._countries[airport["country"]] if airport["country"] < len(self._countries) else "",
+        }
+
+    def coordinates(self, idx: np.ndarray):
+        """(lat, lon) למערך אינדקסים (NaN איפה שאין)"""
+        found = idx >= 0
+        safe = np.where(found, idx, 0)
+        if len(self._airports) == 0:
+            nan = np.full(len(idx), np.nan)
+            return nan, nan
+        lat = np.where(found, self._airports["lat"][safe], np.nan)
+        lon = np.where(found, self._airports["lon"][safe], np.nan)
+        return lat, lon
+
+    def __len__(self):
+        return len(self._airports)
+
+
+def load_airports_from_api() -> List[Dict]:
+    """כל שדות התעופה מ-FlightRadar24 (דרך הגבלת הקצב והמפסק)"""
+    return [
+        {
+            "iata": getattr(airport, "iata", None),
+            "icao": getattr(airport, "icao", None),
+            "lat": airport.latitude,
+            "lon": airport.longitude,
+            "country": getattr(airport, "country", None),
+        }
+        for airport in store.call_upstream(tracker.fr_api.get_airports, wait=REFERENCE_TOKEN_WAIT_SECONDS)
+    ]
+
+
+def load_airlines_from_api() -> Dict[str, str]:
+    """ICAO -> שם חברת התעופה מ-FlightRadar24 (דרך הגבלת הקצב והמפסק)"""
+    return {
+        airline["ICAO"]: airline["Name"]
+        for airline in store.call_upstream(tracker.fr_api.get_airlines, wait=REFERENCE_TOKEN_WAIT_SECONDS)
+        if airline.get("ICAO") and airline.get("Name")
+    }
+
+
+def flight_to_point(flight: Dict) -> Dict:
+    """המרת טיסה (כפי שמחזיר get_flights_in_area) לנקודה במפה"""
+    return {
+        "id": flight['id'],
+        "lat": flight['latitude'],
+        "lng": flight['longitude'],
+        "name": flight['origin'] + "->" + str(flight['destination']),  # + flight['airline'],
+        "info": flight['aircraft'] + " " + str(flight['speed']) + " "
+                + flight['callsign'] + " "
+                + str(flight['altitude'])
+        ,
+        "airline": flight['airline'],
+        "callsign": flight['callsign'],
+        "speed": flight['speed'],
+        "altitude": flight['altitude'],
+        "heading": flight['heading'],
+        "aircraft": flight['aircraft'],
+        "airline_name": airlines.get(flight['airline']),
+        "aircraft_name": aircraft_types.get(flight['aircraft']),
+    }
+
+
+# ---------------------------------------------------------------------------
+# אירועי גדרות: כניסה / יציאה / שהייה
+# ---------------------------------------------------------------------------
+
+def snapshot_diff(previous: Dict[str, Dict], current: Dict[str, Dict]):
+    """
+    השוואת שני snapshots לפי flight id
+
+    Returns:
+        (added, removed, moved) - רשימות של flight ids
+    """
+    added = []
+    moved = []
+    for flight_id, flight in current.items():
+        before = previous.get(flight_id)
+        if before is None:
+            added.append(flight_id)
+        elif (before['latitude'] != flight['latitude'] or before['longitude'] != flight['longitude']
+              or before['altitude'] != flight['altitude']):
+            moved.append(flight_id)
+    removed = [flight_id for flight_id in previous if flight_id not in current]
+    return added, removed, moved
+
+
+class GeofenceEngine:
+    """
+    מנוע אירועים לגדרות מלבניות.
+
+    בכל snapshot בודקים רק טיסות שנוספו / זזו / נעלמו, ורק מול הגדרות
+    שחופפות לתא הרשת של הטיסה, כך שהעבודה פרופורציונלית למספר
+    המטוסים שהשתנו ולא לגודל ה-snapshot כולו.
+    """
+
+    CELL_DEGREES = 0.1
+
+    def __init__(self, fences: Dict[str, Tuple[Tuple[float, float], Tuple[float, float]]],
+                 dwell_seconds: float, max_events: int):
+        self.fences = fences
+        self.dwell_seconds = dwell_seconds
+        self.events = deque(maxlen=max_events)
+        self._seq = 0
+        self._previous: Dict[str, Dict] = {}
+        # flight id -> {fence name: entered_at}
+        self._inside: Dict[str, Dict[str, float]] = {}
+        # (deadline, flight id, fence, entered_at) לאירועי dwell
+        self._dwell_heap = []
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._pending: List[Dict] = []
+        self._cells: Dict[Tuple[int, int], List[str]] = {}
+        for name, (top_left, bottom_right) in fences.items():
+            for cell in self._cells_for_box(top_left, bottom_right):
+                self._cells.setdefault(cell, []).append(name)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(lat // self.CELL_DEGREES), int(lon // self.CELL_DEGREES)
+
+    def _cells_for_box(self, top_left, bottom_right):
+        top, left = self._cell(*top_left)
+        bottom, right = self._cell(*bottom_right)
+        for row in range(bottom, top + 1):
+            for col in range(left, right + 1):
+                yield row, col
+
+    def fences_at(self, lat: float, lon: float) -> List[str]:
+        """שמות הגדרות שהנקודה נמצאת בתוכן"""
+        result = []
+        for name in self._cells.get(self._cell(lat, lon), ()):
+            (top_lat, left_lon), (bottom_lat, right_lon) = self.fences[name]
+            if bottom_lat <= lat <= top_lat and left_lon <= lon <= right_lon:
+                result.append(name)
+        return result
+
+    def add_listener(self, callback):
+        """callback(event) ייקרא לכל אירוע חדש (מחוץ למנעול של המנוע)"""
+        self._listeners.append(callback)
+
+    def _emit(self, kind: str, fence: str, flight: Dict, at: float, **extra):
+        self._seq += 1
+        event = {
+            "seq": self._seq,
+            "type": kind,
+            "fence": fence,
+            "flight_id": flight['id'],
+            "callsign": flight['callsign'],
+            "registration": flight['registration'],
+            "time": at,
+            "lat": flight['latitude'],
+            "lng": flight['longitude'],
+            "altitude": flight['altitude'],
+            **extra,
+        }
+        self.events.append(event)
+        self._pending.append(event)
+
+    def update(self, snapshot: Snapshot):
+        """עדכון המנוע מ-snapshot חדש"""
+        current = snapshot.by_id()
+        now = snapshot.fetched_at
+        with self._lock:
+            added, removed, moved = snapshot_diff(self._previous, current)
+
+            for flight_id in added + moved:
+                flight = current[flight_id]
+                was_inside = self._inside.get(flight_id, {})
+                now_inside = self.fences_at(flight['latitude'], flight['longitude'])
+                for fence in now_inside:
+                    if fence not in was_inside:
+                        self._inside.setdefault(flight_id, {})[fence] = now
+                        heapq.heappush(self._dwell_heap, (now + self.dwell_seconds, flight_id, fence, now))
+                        self._emit("enter", fence, flight, now)
+                for fence in list(was_inside):
+                    if fence not in now_inside:
+                        entered_at = was_inside.pop(fence)
+                        self._emit("exit", fence, flight, now, dwell_seconds=round(now - entered_at, 1))
+                if flight_id in self._inside and not self._inside[flight_id]:
+                    del self._inside[flight_id]
+
+            # טיסות שנעלמו מה-snapshot יוצאות מכל הגדרות
+            for flight_id in removed:
+                for fence, entered_at in self._inside.pop(flight_id, {}).items():
+                    self._emit("exit", fence, self._previous[flight_id], now,
+                               dwell_seconds=round(now - entered_at, 1), lost=True)
+
+            while self._dwell_heap and self._dwell_heap[0][0] <= now:
+                _, flight_id, fence, entered_at = heapq.heappop(self._dwell_heap)
+                # רק אם עדיין באותה כניסה לגדר
+                if self._inside.get(flight_id, {}).get(fence) == entered_at:
+                    self._emit("dwell", fence, current[flight_id], now,
+                               dwell_seconds=round(now - entered_at, 1))
+
+            self._previous = current
+            emitted, self._pending = self._pending, []
+
+        for event in emitted:
+            for callback in self._listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"שגיאה במאזין לאירועי גדרות: {type(e).__name__}: {e}")
+
+    def inside(self, fence: str) -> List[Dict]:
+        """מי נמצא כרגע בתוך הגדר"""
+        with self._lock:
+            return [
+                {"flight_id": flight_id, "entered_at": fences[fence]}
+                for flight_id, fences in self._inside.items() if fence in fences
+            ]
+
+    def query(self, since: int = 0, fence: str = None, kind: str = None,
+              flight_id: str = None, start: float = None, end: float = None,
+              limit: int = 500) -> List[Dict]:
+        """שליפת אירועים מהלוג לפי מסננים (מהישן לחדש)"""
+        with self._lock:
+            events = list(self.events)
+        result = []
+        for event in events:
+            if len(result) >= limit:
+                break
+            if event["seq"] <= since:
+                continue
+            if fence and event["fence"] != fence:
+                continue
+            if kind and event["type"] != kind:
+                continue
+            if flight_id and event["flight_id"] != flight_id and event["callsign"] != flight_id:
+                continue
+            if start is not None and event["time"] < start:
+                continue
+            if end is not None and event["time"] > end:
+                continue
+            result.append(event)
+        return result
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+
+# ---------------------------------------------------------------------------
+# סטטיסטיקה מתגלגלת
+# ---------------------------------------------------------------------------
+
+class TrafficStats:
+    """
+    כמה טיסות נראו ב-5 / 60 / 1440 הדקות האחרונות, לפי חברה, סוג מטוס,
+    רצועת גובה וכיוון (נחיתה / המראה).
+
+    כל טיסה נמצאת בדיוק בדלי אחד - הדקה שבה נראתה לאחרונה - עם הקטגוריות
+    שלה באותו רגע. לכל חלון נשמר סכום רץ של הדליים שבתוכו:
+      - טיסה שעוברת לדלי של הדקה הנוכחית: מורידים מהדלי הישן ומוסיפים לחדש
+        (בחלון שהדלי הישן כבר יצא ממנו - זו טיסה "חוזרת" ונספרת שוב)
+      - דלי שיוצא מחלון עם התקדמות הזמן: מחסרים אותו מהסכום של החלון
+    כך עדכון עולה O(טיסות ב-snapshot) וקריאה O(קטגוריות), בלי קשר לכמה זמן השרת רץ.
+    """
+
+    def __init__(self, windows_minutes=STATS_WINDOWS_MINUTES, altitude_bands=STATS_ALTITUDE_BANDS_FEET):
+        self.windows = tuple(sorted(windows_minutes))
+        self.altitude_bands = tuple(altitude_bands)
+        self._buckets: Dict[int, Counter] = {}
+        self._members: Dict[int, set] = {}
+        # flight id -> (הדקה שבה נראתה לאחרונה, הקטגוריות שלה)
+        self._flights: Dict[str, Tuple[int, Tuple]] = {}
+        self._totals = {window: Counter() for window in self.windows}
+        self._minute = None
+        self._lock = threading.Lock()
+
+    def altitude_band(self, altitude) -> str:
+        feet = altitude or 0
+        for i, limit in enumerate(self.altitude_bands):
+            if feet < limit:
+                return f"<{limit}" if i == 0 else f"{self.altitude_bands[i - 1]}-{limit}"
+        return f"{self.altitude_bands[-1]}+"
+
+    def categories(self, flight: Dict, direction: str) -> Tuple[Tuple[str, str], ...]:
+        return (
+            ("flights", ""),
+            ("airline", flight['airline']),
+            ("aircraft", flight['aircraft']),
+            ("altitude_band", self.altitude_band(flight['altitude'])),
+            ("direction", direction),
+        )
+
+    def update(self, snapshot: Snapshot):
+        """מאזין ל-snapshot חדש: מעביר את הטיסות שבו לדלי של הדקה הנוכחית"""
+        minute = int(snapshot.fetched_at // 60)
+        directions = airport_fields(snapshot)["direction"]
+        with self._lock:
+            self._advance(minute)
+            minute = self._minute
+            for i, flight in enumerate(snapshot.flights):
+                seen = self._flights.get(flight['id'])
+                if seen is not None:
+                    if seen[0] == minute:
+                        continue
+                    self._remove(flight['id'], *seen)
+                self._add(flight['id'], minute, self.categories(flight, directions[i]))
+
+    def _add(self, flight_id: str, minute: int, categories):
+        self._flights[flight_id] = (minute, categories)
+        self._members.setdefault(minute, set()).add(flight_id)
+        bucket = self._buckets.setdefault(minute, Counter())
+        bucket.update(categories)
+        # הדקה הנוכחית נמצאת בכל החלונות
+        for window in self.windows:
+            self._totals[window].update(categories)
+
+    def _remove(self, flight_id: str, minute: int, categories):
+        self._members[minute].discard(flight_id)
+        self._buckets[minute].subtract(categories)
+        for window in self.windows:
+            if minute > self._minute - window:
+                self._totals[window].subtract(categories)
+
+    def _advance(self, minute: int):
+        """קידום הזמן: דליים שיצאו מחלון יורדים מהסכום שלו, וישנים מכל החלונות נמחקים"""
+        if self._minute is None:
+            self._minute = minute
+        if minute <= self._minute:
+            return
+        previous, self._minute = self._minute, minute
+        for window in self.windows:
+            # הדקות שהיו בחלון ועכשיו יצאו ממנו (לכל היותר window דקות)
+            for old in range(previous - window + 1, min(previous, minute - window) + 1):
+                bucket = self._buckets.get(old)
+                if bucket:
+                    self._totals[window].subtract(bucket)
+            self._totals[window] = +self._totals[window]
+        longest = self.windows[-1]
+        for old in range(previous - longest + 1, min(previous, minute - longest) + 1):
+            self._buckets.pop(old, None)
+            for flight_id in self._members.pop(old, ()):
+                del self._flights[flight_id]
+
+    def as_dict(self, now: float = None) -> Dict:
+        """{"5": {"flights": 12, "airline": {...}, ...}, "60": {...}, ...}"""
+        with self._lock:
+            self._advance(int((time.time() if now is None else now) // 60))
+            result = {}
+            for window in self.windows:
+                grouped = {"flights": 0, "airline": {}, "aircraft": {}, "altitude_band": {}, "direction": {}}
+                for (kind, value), count in self._totals[window].items():
+                    if count <= 0:
+                        continue
+                    if kind == "flights":
+                        grouped["flights"] = count
+                    else:
+                        grouped[kind][value] = count
+                result[str(window)] = grouped
+            return result
+
+    def __len__(self):
+        return len(self._flights)
+
+
+# ---------------------------------------------------------------------------
+# מפת צפיפות
+# ---------------------------------------------------------------------------
+
+class PositionHistory:
+    """
+    מאגר מעגלי של מיקומים (זמן, lat, lon, גובה) במערכי numpy בגודל קבוע.
+    לכל מיקום יש מספר סידורי רץ (seq); המיקומים נשמרים לפי סדר הזמן, כך
+    שאפשר למצוא את תחילת חלון זמן בחיפוש בינארי.
+    """
+
+    def __init__(self, capacity: int = HEATMAP_HISTORY_POSITIONS, sample_seconds: float = HEATMAP_SAMPLE_SECONDS):
+        self.capacity = capacity
+        self.sample_seconds = sample_seconds
+        self._time = np.zeros(capacity, dtype=np.float64)
+        self._lat = np.zeros(capacity, dtype=np.float32)
+        self._lon = np.zeros(capacity, dtype=np.float32)
+        self._alt = np.zeros(capacity, dtype=np.float32)
+        self.seq = 0
+        self._last_sample = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def oldest(self) -> int:
+        """המספר הסידורי של המיקום הישן ביותר שעוד לא נדרס"""
+        return max(0, self.seq - self.capacity)
+
+    def record(self, snapshot: Snapshot):
+        """מאזין ל-snapshot חדש: שומר את המיקומים, לכל היותר פעם ב-sample_seconds"""
+        if snapshot.fetched_at - self._last_sample < self.sample_seconds or not snapshot.flights:
+            return
+        arrays = snapshot.arrays()
+        columns = [(self._lat, arrays["lat"]), (self._lon, arrays["lon"]), (self._alt, arrays["altitude"])]
+        with self.lock:
+            self._last_sample = snapshot.fetched_at
+            n = min(len(snapshot.flights), self.capacity)
+            slots = np.arange(self.seq, self.seq + n) % self.capacity
+            self._time[slots] = snapshot.fetched_at
+            for target, source in columns:
+                target[slots] = source[-n:]
+            self.seq += n
+
+    def seq_at(self, since: float) -> int:
+        """המספר הסידורי של המיקום הראשון שנדגם ב-since או אחריו (קוראים עם lock)"""
+        low, high = self.oldest, self.seq
+        while low < high:
+            mid = (low + high) // 2
+            if self._time[mid % self.capacity] < since:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def columns(self, start: int, end: int) -> np.ndarray:
+        """המיקומים [start, end) כמערך (n, 3) של lat, lon, גובה (קוראים עם lock)"""
+        slots = np.arange(start, end) % self.capacity
+        return np.column_stack([self._lat[slots], self._lon[slots], self._alt[slots]])
+
+
+class Heatmap:
+    """
+    היסטוגרמה תלת-ממדית (lat, lon, גובה) של המיקומים מ-PositionHistory בחלון זמן.
+
+    התוצאה נשמרת לכל (חלון, גודל תא, רצועות גובה) יחד עם טווח המספרים
+    הסידוריים שהיא מכסה; בבקשה הבאה מוסיפים רק את ההיסטוגרמה של המיקומים
+    החדשים ומחסרים את אלה שיצאו מהחלון, במקום לחשב הכל מחדש.
+    """
+
+    def __init__(self, history: PositionHistory, top_left: Tuple[float, float],
+                 bottom_right: Tuple[float, float], max_entries: int = HEATMAP_CACHE_ENTRIES):
+        self.history = history
+        self.top_left = top_left
+        self.bottom_right = bottom_right
+        self.max_entries = max_entries
+        # key -> (counts, start seq, end seq)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def edges(self, cell: float, altitude_edges: Tuple[float, ...]):
+        """גבולות התאים: lat מדרום לצפון, lon ממערב למזרח, גובה כפי שהתבקש"""
+        top_lat, left_lon = self.top_left
+        bottom_lat, right_lon = self.bottom_right
+        rows = max(1, int(np.ceil((top_lat - bottom_lat) / cell - 1e-9)))
+        cols = max(1, int(np.ceil((right_lon - left_lon) / cell - 1e-9)))
+        return (bottom_lat + cell * np.arange(rows + 1),
+                left_lon + cell * np.arange(cols + 1),
+                np.asarray(altitude_edges, dtype=np.float64))
+
+    def _histogram(self, edges, start: int, end: int) -> np.ndarray:
+        shape = tuple(len(e) - 1 for e in edges)
+        if start >= end:
+            return np.zeros(shape, dtype=np.int64)
+        counts, _ = np.histogramdd(self.history.columns(start, end), bins=edges)
+        return counts.astype(np.int64)
+
+    def counts(self, window_seconds: float, cell: float, altitude_edges: Tuple[float, ...]) -> np.ndarray:
+        """
+        Returns:
+            מערך (שורות lat, עמודות lon, רצועות גובה) של מספר המיקומים בכל תא
+        """
+        key = (window_seconds, cell, altitude_edges)
+        edges = self.edges(cell, altitude_edges)
+        with self._lock:
+            with self.history.lock:
+                end = self.history.seq
+                start = self.history.seq_at(time.time() - window_seconds)
+                entry = self._entries.get(key)
+                if entry is None or entry[1] < self.history.oldest or start < entry[1]:
+                    counts = self._histogram(edges, start, end)
+                else:
+                    counts, cached_start, cached_end = entry
+                    counts = (counts + self._histogram(edges, cached_end, end)
+                              - self._histogram(edges, cached_start, start))
+            self._entries[key] = (counts, start, end)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return counts
+
+
+# ---------------------------------------------------------------------------
+# חישובים גיאוגרפיים וקטוריים
+# ---------------------------------------------------------------------------
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """מרחק על פני כדור הארץ (ק"מ) מנקודה אחת למערך נקודות"""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bearing_deg(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """כיוון (0-360, 0=צפון) מנקודה אחת למערך נקודות"""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    dlon = lon2 - lon1
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(x, y)) + 360.0) % 360.0
+
+
+def nearest_flights(snapshot: Snapshot, lat: float, lon: float, k: int,
+                    ground_altitude_ft: float = 0.0) -> List[Dict]:
+    """
+    k הטיסות הקרובות ביותר לנקודה
+
+    Returns:
+        רשימה ממוינת לפי מרחק, לכל טיסה: distance_km, bearing_deg, altitude_separation_ft
+    """
+    arrays = snapshot.arrays()
+    count = len(snapshot.flights)
+    if count == 0 or k <= 0:
+        return []
+    distances = haversine_km(lat, lon, arrays["lat"], arrays["lon"])
+    k = min(k, count)
+    # argpartition = O(n), ממיינים רק את ה-k שנבחרו
+    idx = np.argpartition(distances, k - 1)[:k]
+    idx = idx[np.argsort(distances[idx])]
+    bearings = bearing_deg(lat, lon, arrays["lat"][idx], arrays["lon"][idx])
+
+    result = []
+    for i, bearing in zip(idx, bearings):
+        flight = snapshot.flights[i]
+        result.append({
+            **flight,
+            "distance_km": round(float(distances[i]), 3),
+            "bearing_deg": round(float(bearing), 1),
+            "altitude_separation_ft": float(arrays["altitude"][i] - ground_altitude_ft),
+        })
+    return result
+
+
+def airport_fields(snapshot: Snapshot) -> Dict[str, List]:
+    """
+    שדות שמחושבים מראש לכל טיסה ב-snapshot לפי אינדקס שדות התעופה:
+      direction        - arriving / departing / overflying / unknown (לפי HOME_AIRPORTS)
+      dest_distance_km - מרחק מהמיקום הנוכחי ליעד (None אם היעד לא ידוע)
+    """
+    def build():
+        home = set(HOME_AIRPORTS)
+        direction = []
+        for flight in snapshot.flights:
+            if flight['destination'] in home:
+                direction.append("arriving")
+            elif flight['origin'] in home:
+                direction.append("departing")
+            elif flight['origin'] == 'N/A' and flight['destination'] == 'N/A':
+                direction.append("unknown")
+            else:
+                direction.append("overflying")
+
+        distance = [None] * len(snapshot.flights)
+        if snapshot.flights:
+            arrays = snapshot.arrays()
+            dest_idx = airports.lookup([flight['destination'] for flight in snapshot.flights])
+            dest_lat, dest_lon = airports.coordinates(dest_idx)
+            km = haversine_km(arrays["lat"], arrays["lon"], dest_lat, dest_lon)
+            distance = [None if np.isnan(d) else round(float(d), 1) for d in km]
+        return {"direction": direction, "dest_distance_km": distance}
+
+    return snapshot.derived("airport_fields", build)
+
+
+def snapshot_points(snapshot: Snapshot) -> List[Dict]:
+    """נקודות המפה של ה-snapshot, כולל השדות המחושבים מראש (פעם אחת לכל snapshot)"""
+    def build():
+        fields = airport_fields(snapshot)
+        return [
+            {**flight_to_point(flight),
+             "direction": fields["direction"][i],
+             "dest_distance_km": fields["dest_distance_km"][i]}
+            for i, flight in enumerate(snapshot.flights)
+        ]
+
+    return snapshot.derived("points", build)
+
+
+def parse_fields(value: str):
+    """
+    ערך הפרמטר fields -> tuple של שדות (או None = הכל).
+    מקבל שם של preset או רשימה מופרדת בפסיקים.
+    """
+    if not value:
+        return None
+    if value in FIELD_PRESETS:
+        preset = FIELD_PRESETS[value]
+        return None if preset is None else canonical_fields(preset)
+    return canonical_fields(field.strip() for field in value.split(",")) or None
+
+
+def canonical_fields(requested) -> Tuple[str, ...]:
+    """
+    רק שדות מוכרים, בלי כפילויות ובסדר של POINT_FIELDS - כך אותו סט
+    (גם preset) תמיד ממופה לאותו payload שמור
+    """
+    requested = set(requested)
+    return tuple(field for field in POINT_FIELDS if field in requested)
+
+
+def project_points(points: List[Dict], fields) -> List[Dict]:
+    """הנקודות עם השדות המבוקשים בלבד (fields=None - כמו שהן)"""
+    if fields is None:
+        return points
+    return [{key: point[key] for key in fields if key in point} for point in points]
+
+
+def parse_lookup(args) -> Dict[str, Tuple[str, ...]]:
+    """
+    פרמטרי החיפוש מתוך request.args (רק INDEXED_FIELDS).
+    כל פרמטר יכול להכיל כמה ערכים מופרדים בפסיקים.
+    """
+    criteria = {}
+    for key in INDEXED_FIELDS:
+        value = args.get(key)
+        if value:
+            values = tuple(filter(None, (normalize_key(v) for v in value.split(","))))
+            if values:
+                criteria[key] = values
+    return criteria
+
+
+def lookup_rows(snapshot: Snapshot, criteria: Dict[str, Tuple[str, ...]], match_all: bool = True) -> List[int]:
+    """
+    מספרי השורות שתואמים לחיפוש, דרך האינדקסים של ה-snapshot - O(תוצאות) ולא O(טיסות).
+
+    Args:
+        criteria: שדה -> ערכים מנורמלים. בתוך שדה - "או"
+        match_all: True - כל השדות חייבים להתאים ("וגם"), False - מספיק אחד ("או")
+
+    Returns:
+        מספרי שורות ממוינים
+    """
+    matches = []
+    for key, values in criteria.items():
+        index = snapshot.index(key)
+        rows = set()
+        for value in values:
+            rows.update(index.get(value, ()))
+        matches.append(rows)
+    if not matches:
+        return []
+    if match_all:
+        # מתחילים מהקבוצה הקטנה ביותר
+        matches.sort(key=len)
+        rows = matches[0].intersection(*matches[1:])
+    else:
+        rows = set().union(*matches)
+    return sorted(rows)
+
+
+def parse_ranges(args) -> Dict[str, Tuple[float, float]]:
+    """
+    טווחי הסינון מתוך request.args: min_<שדה> / max_<שדה> לכל RANGE_FIELDS
+
+    Raises:
+        ValueError אם גבול אינו מספר סופי (nan / inf) או ש-min גדול מ-max
+    """
+    ranges = {}
+    for key in RANGE_FIELDS:
+        low = args.get(f"min_{key}", type=float)
+        high = args.get(f"max_{key}", type=float)
+        if low is None and high is None:
+            continue
+        # float() מקבל nan / inf; nan נכשל בכל השוואה ומחזיר את כל הנקודות
+        if not all(np.isfinite(bound) for bound in (low, high) if bound is not None):
+            raise ValueError(f"min_{key} / max_{key} must be finite numbers")
+        if low is not None and high is not None and low > high:
+            raise ValueError(f"min_{key} is greater than max_{key}")
+        ranges[key] = (-np.inf if low is None else low, np.inf if high is None else high)
+    return ranges
+
+
+def filter_rows(snapshot: Snapshot, criteria: Dict[str, Tuple[str, ...]],
+                ranges: Dict[str, Tuple[float, float]]) -> List[int]:
+    """
+    שילוב של חיפוש באינדקסים (criteria, ראו lookup_rows) וסינון טווחים ("וגם").
+
+    מתחילים מהמועמדים הכי מעטים - תוצאת האינדקסים, או הטווח הצר ביותר שנמצא
+    בחיפוש בינארי על העמודה הממוינת - ובודקים עליהם בלבד את שאר הטווחים.
+    """
+    arrays = snapshot.arrays()
+    pending = dict(ranges)
+    if criteria:
+        rows = np.array(lookup_rows(snapshot, criteria), dtype=np.int64)
+    elif pending:
+        slices = {}
+        for key, (low, high) in pending.items():
+            values, order = snapshot.sorted_column(key)
+            slices[key] = order[np.searchsorted(values, low, "left"):np.searchsorted(values, high, "right")]
+        narrowest = min(slices, key=lambda key: len(slices[key]))
+        rows = slices[narrowest]
+        del pending[narrowest]
+    else:
+        return list(range(len(snapshot.flights)))
+
+    for key, (low, high) in pending.items():
+        values = arrays[key][rows]
+        rows = rows[(values >= low) & (values <= high)]
+    return np.sort(rows).tolist()
+
+
+def serialized_point_items(snapshot: Snapshot, fields) -> List[bytes]:
+    """
+    כל נקודה כ-JSON נפרד (לפי סדר flights), כך שתשובה מסוננת מורכבת
+    מהנקודות שנמצאו בלבד. מחושב פעם אחת לכל snapshot ולכל סט שדות.
+    """
+    def build():
+        points = project_points(snapshot_points(snapshot), fields)
+        return [json.dumps(point, separators=(",", ":"), ensure_ascii=False).encode("utf-8") for point in points]
+
+    return snapshot.derived_variant("point_items", fields, build, FIELD_VARIANTS_PER_SNAPSHOT)
+
+
+def serialized_points(snapshot: Snapshot, fields) -> bytes:
+    """
+    מערך הנקודות כ-JSON מוכן, עם השדות המבוקשים בלבד.
+    מחושב פעם אחת לכל snapshot ולכל סט שדות - שאר הבקשות מקבלות את אותם bytes.
+    """
+    def build():
+        points = project_points(snapshot_points(snapshot), fields)
+        return json.dumps(points, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    return snapshot.derived_variant("points_json", fields, build, FIELD_VARIANTS_PER_SNAPSHOT)
+
+
+def cluster_cell_degrees(zoom: int) -> float:
+    """גודל תא הרשת במעלות כך שבזום הנתון הוא יהיה CLUSTER_CELL_PIXELS פיקסלים"""
+    return CLUSTER_CELL_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+def serialized_clusters(snapshot: Snapshot, zoom: int, fields) -> Tuple[bytes, bytes]:
+    """
+    קיבוץ המטוסים לפי רשת שמתאימה לזום (פעם אחת לכל snapshot וזום).
+
+    Returns:
+        (points, clusters) כ-JSON מוכן: מטוסים שלבד בתא נשלחים כרגיל,
+        לכל תא עם יותר ממטוס אחד - count, מרכז הכובד וכיוון דומיננטי
+    """
+    def build():
+        points = snapshot_points(snapshot)
+        if not points:
+            return b"[]", b"[]"
+        arrays = snapshot.arrays()
+        cell = cluster_cell_degrees(zoom)
+        rows = np.floor(arrays["lat"] / cell).astype(np.int64)
+        cols = np.floor(arrays["lon"] / cell).astype(np.int64)
+        _, cell_of, counts = np.unique(np.stack([rows, cols], axis=1), axis=0,
+                                       return_inverse=True, return_counts=True)
+        cell_of = cell_of.reshape(-1)
+
+        lat = np.bincount(cell_of, weights=arrays["lat"]) / counts
+        lng = np.bincount(cell_of, weights=arrays["lon"]) / counts
+        # ממוצע מעגלי של הכיוונים (כך ש-350 ו-10 נותנים 0 ולא 180)
+        heading = np.radians(arrays["heading"])
+        sin_sum = np.bincount(cell_of, weights=np.sin(heading))
+        cos_sum = np.bincount(cell_of, weights=np.cos(heading))
+        mean_heading = (np.degrees(np.arctan2(sin_sum, cos_sum)) + 360.0) % 360.0
+
+        singles = project_points([points[i] for i in np.nonzero(counts[cell_of] == 1)[0]], fields)
+        clusters = [
+            {"lat": round(float(lat[c]), 5), "lng": round(float(lng[c]), 5),
+             "count": int(counts[c]), "heading": round(float(mean_heading[c]))}
+            for c in np.nonzero(counts > 1)[0]
+        ]
+        return (json.dumps(singles, separators=(",", ":"), ensure_ascii=False).encode("utf-8"),
+                json.dumps(clusters, separators=(",", ":")).encode("utf-8"))
+
+    return snapshot.derived_variant(("clusters", zoom), fields, build, FIELD_VARIANTS_PER_SNAPSHOT)
+
+
+def points_response(snapshot: Snapshot, stale: bool, fields, zoom: int = None, rows: List[int] = None):
+    """
+    תשובת {"points": [...], ...meta} שמורכבת מה-JSON המוכן של ה-snapshot,
+    בלי לסדר מחדש את כל הנקודות בכל בקשה.
+    בזום נמוך מ-CLUSTER_MAX_ZOOM מתווסף "clusters" והנקודות הן רק מטוסים בודדים.
+    rows (תוצאת filter_rows) - רק הטיסות האלה, בלי אשכולות.
+    """
+    clusters = None
+    if rows is not None:
+        items = serialized_point_items(snapshot, fields)
+        body = b"[" + b",".join(items[i] for i in rows) + b"]"
+    elif zoom is not None and zoom < CLUSTER_MAX_ZOOM:
+        body, clusters = serialized_clusters(snapshot, max(0, zoom), fields)
+    else:
+        body = serialized_points(snapshot, fields)
+    meta = json.dumps(snapshot_meta(snapshot, stale), separators=(",", ":")).encode("utf-8")
+    if clusters is not None:
+        meta = b'{"clusters":' + clusters + b"," + meta[1:]
+    return Response(b'{"points":' + body + b"," + meta[1:], mimetype="application/json")
+
+
+def viewport_rows(snapshot: Snapshot, south: float, west: float, north: float, east: float) -> np.ndarray:
+    """
+    מספרי השורות של המטוסים בתוך המלבן: חיפוש בינארי על עמודת ה-lat הממוינת
+    ואז סינון lon רק על הרצועה שנמצאה
+    """
+    values, order = snapshot.sorted_column("lat")
+    rows = order[np.searchsorted(values, south, "left"):np.searchsorted(values, north, "right")]
+    lon = snapshot.arrays()["lon"][rows]
+    return rows[(lon >= west) & (lon <= east)]
+
+
+class ViewportSubscriptions:
+    """
+    מנויים על חלון מפה: כל לקוח שולח בכל בקשה את גבולות המפה שלו ומקבל רק
+    את מה שהשתנה אצלו מאז הבקשה הקודמת - מטוסים חדשים / שהשתנו בחלון (upsert)
+    ומזהים של מטוסים שיצאו ממנו (remove).
+
+    כולם נגזרים מאותו snapshot משותף (viewport_rows + ה-JSON המוכן לכל נקודה),
+    כך שמספר הלקוחות לא משפיע על הפניות ל-upstream. לכל מנוי נשמר רק מה
+    שנשלח אליו (id -> ה-JSON של הנקודה), וזה מה שמושווה.
+
+    המנויים בזיכרון של התהליך: מנוי לא מוכר (פג, או worker אחר) מקבל תשובה מלאה.
+    """
+
+    def __init__(self, max_subscriptions: int = VIEWPORT_MAX_SUBSCRIPTIONS, idle_seconds: float = VIEWPORT_IDLE_SECONDS):
+        self.max_subscriptions = max_subscriptions
+        self.idle_seconds = idle_seconds
+        self._subscriptions: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _checkout(self, sub_id: str, fields):
+        """המנוי הקיים (ומסמן שימוש), או מנוי חדש אם אין / פג / שונו השדות"""
+        now = time.monotonic()
+        with self._lock:
+            # ניקוי מנויים שלא נשאלו (הם בסדר שימוש - הישנים בהתחלה)
+            while self._subscriptions:
+                oldest = next(iter(self._subscriptions.values()))
+                if now - oldest["used_at"] < self.idle_seconds:
+                    break
+                self._subscriptions.popitem(last=False)
+            subscription = self._subscriptions.get(sub_id) if sub_id else None
+            if subscription is None or subscription["fields"] != fields:
+                sub_id = os.urandom(8).hex()
+                subscription = {"id": sub_id, "fields": fields, "sent": None, "lock": threading.Lock()}
+                self._subscriptions[sub_id] = subscription
+                while len(self._subscriptions) > self.max_subscriptions:
+                    self._subscriptions.popitem(last=False)
+            subscription["used_at"] = now
+            self._subscriptions.move_to_end(sub_id)
+        return subscription
+
+    def poll(self, sub_id: str, snapshot: Snapshot, bounds: Tuple[float, float, float, float], fields) -> Dict:
+        """
+        Returns:
+            {"sub": id, "full": bool, "upsert": [JSON bytes...], "remove": [ids]}
+            full=True - מנוי חדש, הלקוח צריך לנקות את מה שיש לו
+        """
+        subscription = self._checkout(sub_id, fields)
+        items = serialized_point_items(snapshot, fields)
+        flights = snapshot.flights
+        current = {flights[i]['id']: items[i] for i in viewport_rows(snapshot, *bounds)}
+        with subscription["lock"]:
+            sent = subscription["sent"]
+            full = sent is None
+            if full:
+                upsert = list(current.values())
+                remove = []
+            else:
+                upsert = [item for flight_id, item in current.items() if sent.get(flight_id) != item]
+                remove = [flight_id for flight_id in sent if flight_id not in current]
+            subscription["sent"] = current
+        return {"sub": subscription["id"], "full": full, "upsert": upsert, "remove": remove}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+KNOTS_TO_KM_PER_SEC = 1.852 / 3600.0
+FEET_TO_KM = 0.0003048
+# מתחת למהירות הזו (קשר) מטוס נחשב על הקרקע
+MIN_AIRBORNE_SPEED_KNOTS = 50
+
+
+def closest_approach(snapshot: Snapshot, ground_points: Dict[str, Tuple[float, float]],
+                     horizon: float) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    חיזוי נקודת המפגש הקרובה ביותר (CPA) של כל המטוסים לכל נקודות הקרקע
+    במעבר וקטורי אחד, בהנחה של מהירות וכיוון קבועים.
+
+    ההטלה היא מקומית (equirectangular) סביב כל נקודת קרקע - מדויק מספיק
+    לטווחים של עשרות ק"מ.
+
+    Returns:
+        לכל נקודת קרקע: מערכים t (שניות עד ה-CPA), distance_km (אופקי),
+        slant_km (כולל גובה) ו-altitude (רגל בזמן ה-CPA)
+    """
+    arrays = snapshot.arrays()
+    names = list(ground_points)
+    # מימדים: [נקודת קרקע, מטוס]
+    lat0 = np.array([ground_points[name][0] for name in names])[:, None]
+    lon0 = np.array([ground_points[name][1] for name in names])[:, None]
+
+    km_per_deg_lat = 110.574
+    km_per_deg_lon = 111.320 * np.cos(np.radians(lat0))
+    x = (arrays["lon"][None, :] - lon0) * km_per_deg_lon
+    y = (arrays["lat"][None, :] - lat0) * km_per_deg_lat
+
+    speed = arrays["speed"] * KNOTS_TO_KM_PER_SEC
+    heading = np.radians(arrays["heading"])
+    vx = (speed * np.sin(heading))[None, :]
+    vy = (speed * np.cos(heading))[None, :]
+
+    v2 = vx ** 2 + vy ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(v2 > 0, -(x * vx + y * vy) / v2, 0.0)
+    t = np.clip(t, 0.0, horizon)
+
+    distance = np.hypot(x + vx * t, y + vy * t)
+    altitude = np.maximum(0.0, arrays["altitude"][None, :] + arrays["vertical_speed"][None, :] * t / 60.0)
+    slant = np.hypot(distance, altitude * FEET_TO_KM)
+
+    return {
+        name: {"t": t[i], "distance_km": distance[i], "slant_km": slant[i], "altitude": altitude[i]}
+        for i, name in enumerate(names)
+    }
+
+
+def quantize_up(value: float, steps: Tuple[float, ...]) -> float:
+    """הערך הקטן ביותר ב-steps (ממוינים) שלא קטן מ-value; מעבר לטווח - האחרון"""
+    for step in steps:
+        if value <= step:
+            return step
+    return steps[-1]
+
+
+def upcoming_overflights(snapshot: Snapshot, horizon: float, max_distance_km: float) -> Dict[str, List[Dict]]:
+    """מטוסים שיעברו עד max_distance_km מכל נקודת קרקע בתוך horizon שניות, לפי סדר הגעה"""
+    def build():
+        if not snapshot.flights:
+            return {name: [] for name in GROUND_POINTS}
+        predictions = closest_approach(snapshot, GROUND_POINTS, horizon)
+        airborne = snapshot.arrays()["speed"] >= MIN_AIRBORNE_SPEED_KNOTS
+        result = {}
+        for name, p in predictions.items():
+            idx = np.nonzero(airborne & (p["distance_km"] <= max_distance_km))[0]
+            idx = idx[np.argsort(p["t"][idx])]
+            result[name] = [
+                {
+                    **snapshot.flights[i],
+                    "cpa_seconds": round(float(p["t"][i]), 1),
+                    "cpa_at": round(snapshot.fetched_at + float(p["t"][i]), 1),
+                    "cpa_distance_km": round(float(p["distance_km"][i]), 3),
+                    "cpa_slant_km": round(float(p["slant_km"][i]), 3),
+                    "cpa_altitude": round(float(p["altitude"][i])),
+                }
+                for i in idx
+            ]
+        return result
+
+    return snapshot.derived(("overflights", horizon, max_distance_km), build)
+
+
+# ---------------------------------------------------------------------------
+# פרטי טיסה לפי דרישה
+# ---------------------------------------------------------------------------
+
+class LRUCache:
+    """
+    cache בגודל מוגבל עם TTL, שמאחד בקשות במקביל לאותו מפתח:
+    הראשון טוען, כל השאר מחכים לאותה תוצאה (גם לאותה שגיאה).
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, key: str):
+        """הערך אם קיים ולא פג תוקף (או None), בלי לטעון"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def get(self, key: str, loader, timeout: float = 30.0):
+        """
+        הערך מה-cache, או loader() אם אין (פעם אחת לכל מפתח)
+
+        Returns:
+            (value, cached) - cached=True אם הוגש מה-cache
+        """
+        value = self.peek(key)
+        if value is not None:
+            self.hits += 1
+            return value, True
+
+        with self._lock:
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+        if not owner:
+            return future.result(timeout=timeout), True
+
+        self.misses += 1
+        try:
+            value = loader()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            with self._lock:
+                self._items[key] = (time.monotonic(), value)
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+            future.set_result(value)
+            return value, False
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        return self.peek(key) is not None
+
+    def __len__(self):
+        return len(self._items)
+
+
+def fetch_flight_details(flight_id: str, prepaid: bool = False):
+    """
+    פרטי טיסה דרך ה-cache. ה-upstream נקרא דרך details_limiter / details_breaker,
+    כך שמזהים לא מוכרים מהמשתמש לא פוגעים ברענון ה-snapshots.
+
+    Args:
+        prepaid: האסימון כבר נלקח מ-details_limiter (ראו prefetch_flight_details)
+
+    Raises:
+        UpstreamNotFound אם אין טיסה כזו
+        UpstreamUnavailable אם ה-upstream לא זמין
+    """
+    upstream_id = flight_id
+    if flight_id.startswith(AIRCRAFT_ID_PREFIX):
+        # מזהה לפי קוד ICAO (יש מקלט מקומי) - צריך את המזהה של FlightRadar24
+        flight = store.find(flight_id)
+        upstream_id = flight.get('upstream_id', 'N/A') if flight else 'N/A'
+        if upstream_id == 'N/A':
+            raise UpstreamNotFound(f"no upstream details for {flight_id}")
+
+    def load():
+        limiter = None if prepaid else details_limiter
+        details = call_guarded(limiter, details_breaker, tracker.get_flight_details, upstream_id)
+        if not details:
+            raise UpstreamNotFound(f"unknown flight {flight_id}")
+        return details
+
+    try:
+        return flight_details.get(flight_id, load)
+    except FutureTimeoutError:
+        # חיכינו לטעינה של בקשה אחרת לאותה טיסה, וה-upstream לא ענה בזמן
+        raise UpstreamUnavailable("flight details lookup timed out", 1.0 / FLIGHT_DETAILS_RATE_PER_SECOND)
+
+
+def prefetch_flight_details(event: Dict):
+    """טעינה מראש ברקע של פרטי טיסה שנכנסה לגדר מעניינת"""
+    if event["type"] != "enter" or event["fence"] not in FLIGHT_DETAILS_PREFETCH_FENCES:
+        return
+    if event["flight_id"] in flight_details:
+        return
+    # לחיצות של משתמשים קודמות: בלי אסימונים פנויים מעבר לשמורה - מוותרים
+    if not details_limiter.try_acquire(reserve=FLIGHT_DETAILS_PREFETCH_RESERVE):
+        metrics.inc("flight_details_prefetch_skipped")
+        return
+
+    def run():
+        try:
+            fetch_flight_details(event["flight_id"], prepaid=True)
+            metrics.inc("flight_details_prefetched")
+        except (UpstreamUnavailable, UpstreamNotFound):
+            # prefetch הוא best-effort - לא מתעקשים כשה-upstream עמוס
+            pass
+
+    prefetch_pool.submit(run)
+
+
+# ---------------------------------------------------------------------------
+# cache מקומי לאריחי המפה
+# ---------------------------------------------------------------------------
+
+class TileCache:
+    """
+    proxy לאריחי מפה עם cache על הדיסק (<dir>/<z>/<x>/<y>.png).
+
+    - mtime של הקובץ = מתי הורד (לטריות), atime = מתי הוגש לאחרונה (ל-LRU).
+      את atime מעדכנים בעצמנו, כך שזה עובד גם על דיסק עם noatime
+    - כשהגודל הכולל עובר max_bytes סורקים את התיקייה ומוחקים את מה שלא הוגש
+      הכי הרבה זמן, עד 90% מהמגבלה. הסריקה מהדיסק ולא מהזיכרון, כך שכמה
+      workers יכולים לחלוק את אותה תיקייה
+    - בקשות במקביל לאותו אריח מחכות להורדה אחת (כמו LRUCache)
+    - אם ההורדה נכשלה ויש עותק ישן - מגישים אותו
+    """
+
+    def __init__(self, url_template: str, directory: str, max_bytes: int, max_age: float,
+                 concurrency: int = TILE_UPSTREAM_CONCURRENCY, timeout: float = TILE_FETCH_TIMEOUT_SECONDS):
+        self.url_template = url_template
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self._upstream = threading.Semaphore(concurrency)
+        self._loading: Dict[Tuple[int, int, int], Future] = {}
+        self._lock = threading.Lock()
+        # הערכה של הגודל הכולל; מתעדכנת מהדיסק בכל פינוי
+        self._bytes = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.directory, str(z), str(x), f"{y}.png")
+
+    def get(self, z: int, x: int, y: int) -> Tuple[bytes, str]:
+        """
+        Returns:
+            (התוכן, מקור) - מקור הוא "hit", "miss" או "stale"
+
+        Raises:
+            urllib.error.HTTPError / OSError אם ההורדה נכשלה ואין עותק ישן
+        """
+        path = self.path(z, x, y)
+        cached = self._read(path)
+        if cached is not None and time.time() - cached[1] < self.max_age:
+            self.hits += 1
+            return cached[0], "hit"
+
+        key = (z, x, y)
+        with self._lock:
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._loading[key] = future
+        try:
+            if not owner:
+                return future.result(timeout=self.timeout * 2), "miss"
+            self.misses += 1
+            try:
+                data = self._download(z, x, y)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            self._store(path, data)
+            future.set_result(data)
+            return data, "miss"
+        except (urllib.error.URLError, OSError):
+            if cached is not None:
+                return cached[0], "stale"
+            raise
+        finally:
+            if owner:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+    def _read(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            mtime = os.stat(path).st_mtime
+            os.utime(path, (time.time(), mtime))
+            return data, mtime
+        except OSError:
+            return None
+
+    def _download(self, z: int, x: int, y: int) -> bytes:
+        url = self.url_template.format(z=z, x=x, y=y)
+        req = urllib.request.Request(url, headers={"User-Agent": TILE_USER_AGENT})
+        with self._upstream:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.read()
+
+    def _store(self, path: str, data: bytes):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"לא הצלחנו לשמור אריח {path}: {e}")
+            return
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, _, size in self._scan())
+            else:
+                self._bytes += len(data)
+            over = self._bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def _scan(self):
+        """(atime, path, size) לכל אריח בתיקייה"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_atime, path, st.st_size
+
+    def evict(self):
+        """מחיקת האריחים שלא הוגשו הכי הרבה זמן, עד 90% מ-max_bytes"""
+        entries = sorted(self._scan())
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._bytes = total
+
+
+def tiles_for_bbox(top_left: Tuple[float, float], bottom_right: Tuple[float, float], zoom: int):
+    """כל האריחים (x, y) בזום הנתון שמכסים את המלבן (Web Mercator / slippy map)"""
+    def tile_xy(lat, lon):
+        n = 2 ** zoom
+        lat_rad = np.radians(np.clip(lat, -85.0511, 85.0511))
+        x = int((lon + 180.0) / 360.0 * n)
+        y = int((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    x0, y0 = tile_xy(*top_left)
+    x1, y1 = tile_xy(*bottom_right)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield x, y
+
+
+class Metrics:
+    """מונים פשוטים שנחשפים ב-/metrics"""
+
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] += n
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+
+class AdmissionControl:
+    """
+    בקרת כניסה לנקודות הקצה של הנתונים.
+
+    - לכל לקוח (לפי כתובת IP) דלי אסימונים משלו -> 429 כשהוא חורג
+    - תקרה גלובלית לבקשות במקביל -> 503 כשהשרת עמוס
+      בקשות רגילות מקבלות רק max_concurrent - reserved מקומות,
+      בקשות בעדיפות יכולות להשתמש בכל התקרה
+    - עדיפות נקבעת כאן ולא על ידי הלקוח: הבקשה הראשונה של לקוח שאין
+      לו עדיין דלי (טעינה ראשונה של הדף)
+    """
+
+    def __init__(self, max_concurrent: int, reserved: int,
+                 client_rate: float, client_burst: float, max_clients: int):
+        self.max_concurrent = max_concurrent
+        self.reserved = reserved
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def client_bucket(self, client: str) -> Tuple[TokenBucket, bool]:
+        """
+        הדלי של הלקוח (LRU - לקוחות ישנים נזרקים כשיש יותר מדי)
+
+        Returns:
+            (bucket, new) - new=True אם זו הבקשה הראשונה שראינו מהלקוח
+        """
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.client_rate, self.client_burst)
+                self._buckets[client] = bucket
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+                return bucket, True
+            self._buckets.move_to_end(client)
+            return bucket, False
+
+    def try_enter(self, priority: bool) -> bool:
+        """תפיסת מקום לבקשה. False אם אין מקום"""
+        limit = self.max_concurrent if priority else self.max_concurrent - self.reserved
+        with self._lock:
+            if self.in_flight >= limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+
+def rejected_response(status: int, error: str, retry_after: float, **extra):
+    """תשובה מהירה לבקשה שנדחתה (429 / 503) עם Retry-After"""
+    response = jsonify({"points": [], "error": error, **extra})
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, int(round(retry_after))))
+    return response
+
+
+def guarded():
+    """
+    דקורטור לנקודות הקצה של הנתונים: תקציב ללקוח + תקרה גלובלית.
+
+    הבקשה הראשונה של לקוח חדש (טעינה ראשונה של הדף) מקבלת עדיפות
+    ויכולה להשתמש במקומות השמורים.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if store.role == "ingest":
+                # הבקשות כאן מגיעות מה-workers, שכבר עשו בקרת כניסה ללקוח עצמו
+                return view(*args, **kwargs)
+            metrics.inc("requests_total")
+
+            bucket, priority = admission.client_bucket(request.remote_addr or "unknown")
+            if not bucket.try_acquire():
+                metrics.inc("rejected_rate_limited")
+                return rejected_response(429, "rate limited", bucket.wait_time())
+
+            if not admission.try_enter(priority):
+                metrics.inc("shed_overload")
+                return rejected_response(503, "overloaded", 1)
+            if priority:
+                metrics.inc("requests_priority")
+            try:
+                return view(*args, **kwargs)
+            finally:
+                admission.leave()
+        return wrapper
+    return decorator
+
+
+def next_poll_seconds(snapshot: Snapshot, stale: bool) -> float:
+    """
+    מתי כדאי ללקוח לבקש שוב.
+
+    - snapshot טרי: כשיפוג ה-ttl שלו (לפני כן נקבל את אותו מידע)
+    - snapshot ישן: כשה-upstream צפוי לחזור (backoff של המפסק / הגבלת קצב)
+    - בעומס: מכפילים לפי מספר הבקשות במקביל
+    ומוסיפים jitter קטן כדי שהלקוחות לא יסתנכרנו.
+    """
+    if stale:
+        wait = max(store.breaker.retry_in(), store.limiter.wait_time(), store.ttl)
+    else:
+        wait = store.ttl - snapshot.age()
+    # הבקשה הנוכחית עצמה לא נחשבת עומס
+    wait *= 1.0 + max(0, admission.in_flight - 1) / POLL_LOAD_SOFT_LIMIT
+    wait *= random.uniform(1.0, 1.1)
+    return min(MAX_POLL_SECONDS, max(MIN_POLL_SECONDS, wait))
+
+
+def snapshot_meta(snapshot: Snapshot, stale: bool) -> Dict:
+    """שדות המטא-דאטה שמצורפים לכל תשובה שמבוססת על snapshot"""
+    return {
+        "stale": stale,
+        "age": round(snapshot.age(), 1),
+        "next_poll_ms": int(next_poll_seconds(snapshot, stale) * 1000),
+    }
+
+
+def load_landmarks(path: str, geofences: Dict) -> Tuple[bytes, str]:
+    """
+    השכבה הקבועה של המפה: נקודות הציון מקובץ ההגדרות וקווי המתאר של הגדרות.
+
+    Returns:
+        (JSON מוכן, גרסה) - הגרסה היא hash של התוכן, כך שה-URL משתנה רק כשהתוכן משתנה
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            landmarks = json.load(f).get("landmarks", [])
+    except (OSError, ValueError) as e:
+        print(f"לא הצלחנו לטעון נקודות ציון מ-{path}: {e}")
+        landmarks = []
+    payload = {
+        "landmarks": landmarks,
+        "geofences": [
+            {"name": name, "bounds": [[bottom_right[0], top_left[1]], [top_left[0], bottom_right[1]]]}
+            for name, (top_left, bottom_right) in geofences.items()
+        ],
+    }
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return body, hashlib.sha1(body).hexdigest()[:12]
+
+
+def owns_upstream() -> bool:
+    """האם התהליך הזה פונה ל-FlightRadar24 (standalone / ingest) או רק קורא (worker)"""
+    return store.role != "reader"
+
+
+# בלי proxy של הסביבה - הפנייה ל-ingest היא תמיד מקומית
+_ingest_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def proxy_to_ingest():
+    """העברת הבקשה הנוכחית כמו שהיא לתהליך ה-ingest והחזרת התשובה שלו"""
+    url = f"http://{INGEST_HTTP_ADDRESS}{request.full_path}"
+    try:
+        with _ingest_opener.open(url, timeout=INGEST_PROXY_TIMEOUT_SECONDS) as upstream:
+            status, headers, body = upstream.status, upstream.headers, upstream.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, e.headers, e.read()
+    except OSError as e:
+        metrics.inc("ingest_proxy_errors")
+        return rejected_response(503, f"ingest unavailable: {e}", 1)
+    response = Response(body, status=status, content_type=headers.get("Content-Type"))
+    if headers.get("Retry-After"):
+        response.headers["Retry-After"] = headers["Retry-After"]
+    return response
+
+
+def served_by_ingest(view):
+    """
+    דקורטור לנקודות קצה שתלויות במצב שקיים רק בתהליך שפונה ל-upstream
+    (start_consumers): ב-worker הבקשה מועברת ל-ingest.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if owns_upstream():
+            return view(*args, **kwargs)
+        return proxy_to_ingest()
+    return wrapper
+
+
+def upstream_unavailable_response(e: UpstreamUnavailable):
+    """תשובת 503 כשאין שום snapshot להגיש"""
+    metrics.inc("upstream_unavailable")
+    return rejected_response(503, e.reason, e.retry_after, stale=True)
+
+
+tracker = FlightTracker()
+airlines = ReferenceTable("airlines", loader=load_airlines_from_api, may_refresh=owns_upstream).load()
+aircraft_types = ReferenceTable("aircraft_types").load()
+airports = AirportIndex(loader=load_airports_from_api, may_refresh=owns_upstream).load()
+receiver = LocalReceiver(LOCAL_RECEIVER_SOURCE) if LOCAL_RECEIVER_SOURCE else None
+store = SnapshotStore(
+    tracker,
+    REGIONS,
+    limiter=TokenBucket(UPSTREAM_RATE_PER_SECOND, UPSTREAM_BURST),
+    breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_BASE_BACKOFF_SECONDS, BREAKER_MAX_BACKOFF_SECONDS),
+    ttl=SNAPSHOT_TTL_SECONDS,
+    shared_dir=SHARED_SNAPSHOT_DIR,
+    persist_dir=CACHE_DIR,
+    receiver=receiver,
+)
+geofences = GeofenceEngine(GEOFENCES, GEOFENCE_DWELL_SECONDS, GEOFENCE_EVENT_LOG_SIZE)
+# חישוב מראש של ברירת המחדל כך ש-/overflights מוכן עם כל snapshot
+store.add_listener("area", lambda snapshot: upcoming_overflights(
+    snapshot, OVERFLIGHT_HORIZON_SECONDS, OVERFLIGHT_MAX_DISTANCE_KM))
+LANDMARKS_BODY, LANDMARKS_VERSION = load_landmarks(LANDMARKS_PATH, GEOFENCES)
+traffic_stats = TrafficStats()
+tile_cache = TileCache(TILE_UPSTREAM_URL, TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, TILE_MAX_AGE_SECONDS)
+viewports = ViewportSubscriptions()
+position_history = PositionHistory()
+heatmap = Heatmap(position_history, AREA_TOP_LEFT, AREA_BOTTOM_RIGHT)
+metrics = Metrics()
+flight_details = LRUCache(FLIGHT_DETAILS_CACHE_SIZE, FLIGHT_DETAILS_TTL_SECONDS)
+details_limiter = TokenBucket(FLIGHT_DETAILS_RATE_PER_SECOND, FLIGHT_DETAILS_BURST)
+details_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_BASE_BACKOFF_SECONDS, BREAKER_MAX_BACKOFF_SECONDS)
+prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+admission = AdmissionControl(
+    MAX_CONCURRENT_REQUESTS,
+    PRIORITY_RESERVED_SLOTS,
+    CLIENT_RATE_PER_SECOND,
+    CLIENT_BURST,
+    MAX_TRACKED_CLIENTS,
+)
+
+STARTUP = {"import_seconds": round(time.perf_counter() - _IMPORT_STARTED, 3)}
+_created_app = None
+_create_app_lock = threading.Lock()
+
+
+def start_consumers():
+    """
+    חיבור המאזינים בעלי המצב המצטבר (גדרות, סטטיסטיקה, היסטוריית מיקומים,
+    prefetch של פרטי טיסה). רק בתהליך שפונה ל-upstream - worker שקורא snapshots
+    משותפים מעביר את נקודות הקצה שלהם ל-ingest (served_by_ingest), כך שיש
+    עותק אחד של כל מצב ולא N עותקים שמתעדכנים רק כשה-worker מקבל בקשה.
+    נקרא פעם אחת, מ-create_app.
+    """
+    store.add_listener("area", geofences.update)
+    store.add_listener("area", traffic_stats.update)
+    store.add_listener("area", position_history.record)
+    geofences.add_listener(prefetch_flight_details)
+
+
+def create_app() -> Flask:
+    """
+    בניית אפליקציית ה-Flask: רישום ה-routes, קומפילציה חד פעמית של התבנית
+    וטעינת ה-snapshot האחרון מהדיסק (warm start)
+
+    המצב עצמו (store, מנועים, מאזינים) שייך למודול ומשותף לכל התהליך, ולכן
+    קריאה נוספת מחזירה את אותה אפליקציה ולא מריצה warm start או מחברת מאזינים שוב.
+
+    Returns:
+        אפליקציה מוכנה להגשה
+    """
+    global _created_app
+    with _create_app_lock:
+        if _created_app is None:
+            _created_app = _build_app()
+        return _created_app
+
+
+def _build_app() -> Flask:
+    started = time.perf_counter()
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(bp)
+    # render_template_string מקמפל את התבנית מחדש בכל בקשה
+    flask_app.extensions["radar_index"] = flask_app.jinja_env.from_string(TEMPLATE)
+    if owns_upstream():
+        start_consumers()
+    # ב-ingest הלולאה עצמה מרעננת (run_ingest)
+    store.warm_start(refresh=store.role == "standalone")
+    STARTUP["create_app_seconds"] = round(time.perf_counter() - started, 3)
+    STARTUP["warm_regions"] = sorted(store._snapshots)
+    print(f"עלייה: ייבוא {STARTUP['import_seconds']:.3f} שניות, "
+          f"create_app {STARTUP['create_app_seconds']:.3f} שניות, warm: {STARTUP['warm_regions']}")
+    return flask_app
+
+
+def __getattr__(name):
+    # `app:app` (gunicorn / flask run) בונה את האפליקציה רק כשמבקשים אותה
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def main():
+    # הגדרת הפוליגון - ניתן לשנות את הקואורדינטות כאן
+    # דוגמה: אזור מרכז ישראל (תל אביב-ירושלים)
+    TOP_LEFT = (32.5, 34.5)  # (latitude, longitude) - שמאל למעלה
+    BOTTOM_RIGHT = (31.5, 35.5)  # (latitude, longitude) - ימין למטה
+
+    print(f"מחפש טיסות באזור:")
+    print(f"  פינה שמאלית עליונה: {TOP_LEFT}")
+    print(f"  פינה ימנית תחתונה: {BOTTOM_RIGHT}")
+
+    # יצירת אובייקט FlightTracker
+    tracker = FlightTracker()
+
+    try:
+        # חיפוש טיסות באזור
+        flights = tracker.get_flights_in_area(TOP_LEFT, BOTTOM_RIGHT)
+
+        # הצגת התוצאות
+        # tracker.print_flight_info(flights)
+
+    except Exception as e:
+        print(f"שגיאה: {e}")
+        import traceback
+        traceback.print_exc()
+
+
+@bp.route("/")
+def index():
+    # זמן הרענון ההתחלתי בשניות (אחר כך השרת מכתיב next_poll_ms)
+    # ?render=canvas / auto מחליף את הציור ל-canvas (מומלץ כשיש אלפי מטוסים)
+    render_mode = request.args.get("render", "dom")
+    if render_mode not in ("dom", "canvas", "auto"):
+        render_mode = "dom"
+    return current_app.extensions["radar_index"].render(refresh_seconds=5, render_mode=render_mode,
+                                                        landmarks_url=f"/landmarks/{LANDMARKS_VERSION}.json",
+                                                        viewport_min_zoom=CLUSTER_MAX_ZOOM)
+
+
+@bp.route("/tiles/<int:z>/<int:x>/<int:y>.png")
+def tiles(z, x, y):
+    """אריח מפה דרך ה-cache המקומי (ראו TileCache)"""
+    if not (0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return Response("bad tile", status=404, mimetype="text/plain")
+    try:
+        data, source = tile_cache.get(z, x, y)
+    except urllib.error.HTTPError as e:
+        return Response(f"upstream {e.code}", status=404 if e.code == 404 else 502, mimetype="text/plain")
+    except (urllib.error.URLError, OSError) as e:
+        metrics.inc("tile_upstream_errors")
+        return Response(f"upstream unavailable: {e}", status=502, mimetype="text/plain")
+    metrics.inc(f"tiles_{source}")
+    response = Response(data, mimetype="image/png")
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+
+@bp.route("/landmarks")
+def landmarks():
+    """הפניה לגרסה הנוכחית של השכבה הקבועה"""
+    return redirect(f"/landmarks/{LANDMARKS_VERSION}.json")
+
+
+@bp.route("/landmarks/<version>.json")
+def landmarks_versioned(version):
+    """
+    נקודות הציון וקווי המתאר של הגדרות:
+    {"landmarks": [{"name", "info", "lat", "lng"}, ...], "geofences": [{"name", "bounds"}, ...]}
+    ה-URL כולל hash של התוכן ולכן אפשר לשמור אותו בדפדפן לתמיד.
+    """
+    if version != LANDMARKS_VERSION:
+        return redirect(f"/landmarks/{LANDMARKS_VERSION}.json")
+    response = Response(LANDMARKS_BODY, mimetype="application/json")
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    response.set_etag(LANDMARKS_VERSION)
+    return response.make_conditional(request)
+
+
+@bp.route("/data")
+@guarded()
+def data():
+    """
+    כאן מחזירים JSON שמייצג נקודות.
+    fields= בוחר אילו שדות לשלוח: preset (minimal / tooltip / full) או רשימה מופרדת בפסיקים.
+    zoom= (זום המפה) - מתחת ל-CLUSTER_MAX_ZOOM מתקבל גם "clusters":
+      [{"lat": ..., "lng": ..., "count": 12, "heading": 270}, ...]
+    region= אחד מ-REGIONS (ברירת מחדל: area)
+    id= / callsign= / registration= / airline= (אפשר כמה ערכים עם פסיקים) -
+      רק הטיסות שתואמות לכל הסינונים, בלי אשכולות
+    min_altitude= / max_altitude= (וגם speed, vertical_speed) - סינון טווחים,
+      אפשר לשלב עם כל השאר
+    הפורמט:
+    {
+      "points": [
+        {"lat": ..., "lng": ..., "name": "...", "info": "..."},
+        ...
+      ],
+      "stale": false,       # true אם ה-upstream לא זמין ומוגש ה-snapshot האחרון
+      "age": 1.2,           # גיל ה-snapshot בשניות
+      "next_poll_ms": 3800  # מתי כדאי לבקש שוב
+    }
+    """
+    # NW = (34.25, 33.35)
+    # SE = (35.90, 29.50)
+
+    # TOP_LEFT = (32.0573501,34.7737489)      # (latitude, longitude) - שמאל למעלה
+    # BOTTOM_RIGHT = (32.0655618,34.7788870)
+    # TOP_LEFT = (34.25, 33.35)      # (latitude, longitude) - שמאל למעלה
+    # BOTTOM_RIGHT = (35.90, 29.50)
+
+    region = request.args.get("region", "area")
+    if region not in REGIONS:
+        response = jsonify({"error": f"unknown region, expected one of {sorted(REGIONS)}"})
+        response.status_code = 400
+        return response
+    try:
+        ranges = parse_ranges(request.args)
+    except ValueError as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 400
+        return response
+
+    try:
+        snapshot, stale = store.get(region)
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    fields = parse_fields(request.args.get("fields"))
+    criteria = parse_lookup(request.args)
+    if criteria or ranges:
+        return points_response(snapshot, stale, fields, rows=filter_rows(snapshot, criteria, ranges))
+
+    return points_response(snapshot, stale, fields, zoom=request.args.get("zoom", type=int))
+
+
+@bp.route("/viewport")
+@guarded()
+def viewport():
+    """
+    רק המטוסים בחלון המפה של הלקוח, כ-diff מול הבקשה הקודמת שלו.
+    /viewport?bounds=south,west,north,east&fields=tooltip&sub=<id מהתשובה הקודמת>
+    הפורמט:
+    {
+      "sub": "3f2a...",   # לשלוח בבקשה הבאה
+      "full": false,      # true - לנקות הכל ולהתחיל מ-upsert
+      "upsert": [{...}],  # נקודות חדשות בחלון או שהשתנו
+      "remove": ["id"],   # מזהים שיצאו מהחלון / מה-snapshot
+      "stale": false, "age": 1.2, "next_poll_ms": 3800
+    }
+    """
+    try:
+        south, west, north, east = (float(v) for v in request.args.get("bounds", "").split(","))
+        # nan / inf או חלון הפוך נותנים תשובה ריקה שנראית תקינה
+        if not (np.all(np.isfinite((south, west, north, east))) and south < north and west < east):
+            raise ValueError("bad bounds")
+    except ValueError:
+        response = jsonify({"error": "bounds=south,west,north,east (finite, south<north, west<east)"})
+        response.status_code = 400
+        return response
+
+    try:
+        snapshot, stale = store.get("area")
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    # בלי id אי אפשר לעשות diff - תמיד מצרפים אותו
+    fields = canonical_fields((parse_fields(request.args.get("fields")) or POINT_FIELDS) + ("id",))
+    result = viewports.poll(request.args.get("sub"), snapshot, (south, west, north, east), fields)
+    head = json.dumps({"sub": result["sub"], "full": result["full"], "remove": result["remove"]},
+                      separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    meta = json.dumps(snapshot_meta(snapshot, stale), separators=(",", ":")).encode("utf-8")
+    body = (head[:-1] + b',"upsert":[' + b",".join(result["upsert"]) + b"]," + meta[1:])
+    return Response(body, mimetype="application/json")
+
+
+@bp.route("/watchlist")
+@guarded()
+def watchlist():
+    """
+    הטיסות מרשימת מעקב שנמצאות עכשיו באזור.
+    /watchlist?registration=4X-EKA,4X-EDF&callsign=ELY001 (בלי פרמטרים - WATCHLIST)
+    כל ערך שתואם מספיק ("או"). "missing" - ערכים שלא נמצאו כרגע.
+    """
+    criteria = parse_lookup(request.args)
+    if not criteria:
+        criteria = {key: tuple(filter(None, map(normalize_key, values)))
+                    for key, values in WATCHLIST.items() if key in INDEXED_FIELDS}
+    try:
+        snapshot, stale = store.get("area")
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    points = snapshot_points(snapshot)
+    missing = {key: [value for value in values if value not in snapshot.index(key)]
+               for key, values in criteria.items()}
+    return jsonify({
+        "points": [points[i] for i in lookup_rows(snapshot, criteria, match_all=False)],
+        "missing": {key: values for key, values in missing.items() if values},
+        **snapshot_meta(snapshot, stale),
+    })
+
+
+@bp.route("/data1")
+@guarded()
+def data1():
+    """
+    הטיסות שנמצאות כרגע בתיבה הקטנה סביב האתר (SITE_TOP_LEFT / SITE_BOTTOM_RIGHT).
+    אותו פורמט כמו /data.
+    """
+    # changed 10/1/26  # TOP_LEFT = (32.0720497, 34.7296015)  # 32.057, 34.773)      # (latitude, longitude) - שמאל למעלה
+    try:
+        snapshot, stale = store.get("site")
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    return points_response(snapshot, stale, parse_fields(request.args.get("fields")))
+
+
+@bp.route("/events")
+@guarded()
+@served_by_ingest
+def events():
+    """
+    אירועי הגדרות (enter / exit / dwell).
+
+    פרמטרים (כולם אופציונליים):
+      since    - להחזיר רק אירועים עם seq גדול מזה (ללקוח שעוקב אחרי הפיד)
+      fence    - שם גדר
+      type     - enter / exit / dwell
+      flight   - flight id או callsign
+      start/end - טווח זמן (epoch seconds)
+      limit    - מקסימום אירועים (לפחות 1)
+    """
+    limit = request.args.get("limit", 500, type=int)
+    if limit is None or limit < 1:
+        response = jsonify({"error": "limit must be a positive integer"})
+        response.status_code = 400
+        return response
+
+    # מרעננים את ה-snapshot כדי שהמנוע יתעדכן גם אם אף אחד לא מסתכל במפה
+    try:
+        store.get("area")
+    except UpstreamUnavailable:
+        pass
+
+    args = request.args
+    found = geofences.query(
+        since=args.get("since", 0, type=int),
+        fence=args.get("fence"),
+        kind=args.get("type"),
+        flight_id=args.get("flight"),
+        start=args.get("start", type=float),
+        end=args.get("end", type=float),
+        limit=min(limit, GEOFENCE_EVENT_LOG_SIZE),
+    )
+    return jsonify({
+        "events": found,
+        "last_seq": geofences.last_seq,
+        "inside": {name: geofences.inside(name) for name in geofences.fences},
+    })
+
+
+@bp.route("/nearest")
+@guarded()
+def nearest():
+    """
+    k המטוסים הקרובים לנקודה (ברירת מחדל: HERE).
+    /nearest?lat=32.05&lng=34.77&k=5&alt=0   (alt = גובה הקרקע ברגל)
+    """
+    lat = request.args.get("lat", HERE[0], type=float)
+    lng = request.args.get("lng", HERE[1], type=float)
+    k = request.args.get("k", 5, type=int)
+    ground_alt = request.args.get("alt", 0.0, type=float)
+    # nan נכשל בהשוואות הטווח; alt אין לו טווח ולכן בודקים אותו במפורש
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and np.isfinite(ground_alt)) or k < 1:
+        response = jsonify({"error": "bad lat/lng/k/alt"})
+        response.status_code = 400
+        return response
+
+    try:
+        snapshot, stale = store.get("area")
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    return jsonify({
+        "lat": lat,
+        "lng": lng,
+        "flights": nearest_flights(snapshot, lat, lng, k, ground_alt),
+        **snapshot_meta(snapshot, stale),
+    })
+
+
+@bp.route("/overflights")
+@guarded()
+def overflights():
+    """
+    מטוסים שצפויים לעבור מעל נקודות הקרקע (GROUND_POINTS) בדקות הקרובות.
+    /overflights?point=here&horizon=600&within=5
+    horizon / within (חיוביים) מעוגלים כלפי מעלה לערכים ב-OVERFLIGHT_HORIZON_STEPS_SECONDS /
+    OVERFLIGHT_DISTANCE_STEPS_KM (הערכים בפועל חוזרים בתשובה)
+    """
+    horizon = request.args.get("horizon", OVERFLIGHT_HORIZON_SECONDS, type=float)
+    within = request.args.get("within", OVERFLIGHT_MAX_DISTANCE_KM, type=float)
+    point = request.args.get("point")
+    if point is not None and point not in GROUND_POINTS:
+        response = jsonify({"error": f"unknown point {point}", "points": list(GROUND_POINTS)})
+        response.status_code = 404
+        return response
+    if not (np.isfinite(horizon) and np.isfinite(within) and horizon > 0 and within > 0):
+        response = jsonify({"error": "horizon and within must be positive numbers"})
+        response.status_code = 400
+        return response
+    horizon = quantize_up(horizon, OVERFLIGHT_HORIZON_STEPS_SECONDS)
+    within = quantize_up(within, OVERFLIGHT_DISTANCE_STEPS_KM)
+
+    try:
+        snapshot, stale = store.get("area")
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+
+    found = upcoming_overflights(snapshot, horizon, within)
+    if point is not None:
+        found = {point: found[point]}
+    return jsonify({"overflights": found, "horizon": horizon, "within": within,
+                    **snapshot_meta(snapshot, stale)})
+
+
+@bp.route("/flight/<flight_id>")
+@guarded()
+@served_by_ingest
+def flight(flight_id):
+    """פרטים מלאים על טיסה אחת (נטען לפי דרישה ונשמר ב-cache)"""
+    try:
+        details, cached = fetch_flight_details(flight_id)
+    except UpstreamNotFound as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 404
+        return response
+    except UpstreamUnavailable as e:
+        return upstream_unavailable_response(e)
+    return jsonify({"id": flight_id, "cached": cached, "details": details})
+
+
+@bp.route("/stats")
+@guarded()
+@served_by_ingest
+def stats():
+    """
+    כמה טיסות נראו באזור בכל חלון זמן (STATS_WINDOWS_MINUTES), בחלוקה
+    לחברה, סוג מטוס, רצועת גובה וכיוון. טיסה נספרת פעם אחת לכל חלון,
+    לפי מה שהיה כשנראתה לאחרונה.
+    """
+    # כמו ב-/events: הסטטיסטיקה מתעדכנת מה-snapshots, גם אם אף אחד לא מסתכל במפה
+    try:
+        store.get("area")
+    except UpstreamUnavailable:
+        pass
+
+    return jsonify({
+        "windows": traffic_stats.as_dict(),
+        "tracked_flights": len(traffic_stats),
+    })
+
+
+@bp.route("/heatmap")
+@guarded()
+@served_by_ingest
+def heatmap_view():
+    """
+    צפיפות התנועה באזור של /data לפי מיקומים שנדגמו בחלון הזמן.
+    /heatmap?window=60&cell=0.02&alt=0,5000,10000,60000
+      window - דקות אחורה, cell - גודל תא במעלות, alt - גבולות רצועות הגובה ברגל (בסדר עולה ממש)
+    הפורמט (רק תאים שאינם ריקים; row נספר מדרום, col ממערב):
+    {"bounds": [[south, west], [north, east]], "cell": 0.02, "rows": 50, "cols": 50,
+     "alt_edges": [...], "cells": [[row, col, band, count], ...], "max": 123, "positions": 4567}
+    """
+    window = request.args.get("window", HEATMAP_DEFAULT_WINDOW_MINUTES, type=float)
+    cell = request.args.get("cell", HEATMAP_DEFAULT_CELL_DEGREES, type=float)
+    try:
+        altitude_edges = tuple(float(v) for v in request.args.get("alt", "0,100000").split(","))
+    except ValueError:
+        altitude_edges = ()
+    # רצועה ריקה (alt=0,0) נותנת היסטוגרמה שתמיד ריקה
+    if np.any(np.diff(altitude_edges) <= 0):
+        altitude_edges = ()
+    # float() מקבל גם nan / inf, שעוברים את ההשוואות ומפילים את חישוב הרשת
+    if not np.all(np.isfinite((window, cell) + altitude_edges)):
+        window = cell = None
+    lat_edges, lon_edges, _ = heatmap.edges(max(cell or 0, HEATMAP_MIN_CELL_DEGREES), altitude_edges)
+    if (not window or window <= 0 or not cell or cell < HEATMAP_MIN_CELL_DEGREES or len(altitude_edges) < 2 or
+            (len(lat_edges) - 1) * (len(lon_edges) - 1) * (len(altitude_edges) - 1) > HEATMAP_MAX_CELLS):
+        response = jsonify({"error": "bad window/cell/alt", "min_cell": HEATMAP_MIN_CELL_DEGREES,
+                            "max_cells": HEATMAP_MAX_CELLS})
+        response.status_code = 400
+        return response
+
+    counts = heatmap.counts(window * 60.0, cell, altitude_edges)
+    nonzero = np.nonzero(counts)
+    return jsonify({
+        "bounds": [[float(lat_edges[0]), float(lon_edges[0])], [float(lat_edges[-1]), float(lon_edges[-1])]],
+        "cell": cell,
+        "rows": counts.shape[0],
+        "cols": counts.shape[1],
+        "alt_edges": list(altitude_edges),
+        "cells": np.column_stack(nonzero + (counts[nonzero],)).tolist(),
+        "max": int(counts.max()) if counts.size else 0,
+        "positions": int(counts.sum()),
+        "window": window,
+    })
+
+
+@bp.route("/metrics")
+def metrics_view():
+    """מונים ומצב נוכחי של השרת (JSON)"""
+    return jsonify({
+        "counters": metrics.as_dict(),
+        "in_flight": admission.in_flight,
+        "breaker": store.breaker.state,
+        "role": store.role,
+        "startup": STARTUP,
+        "generations": {name: snapshot.generation for name, snapshot in store._snapshots.items()},
+        "tile_cache": {"hits": tile_cache.hits, "misses": tile_cache.misses},
+        "viewport_subscriptions": len(viewports),
+        "local_receiver": None if receiver is None else dict(
+            receiver.status(), upstream_skipped=store.upstream_skipped),
+        "flight_details_cache": {
+            "size": len(flight_details),
+            "hits": flight_details.hits,
+            "misses": flight_details.misses,
+            "breaker": details_breaker.state,
+        },
+    })
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """השרת הפנימי של ה-ingest לא מדפיס שורה לכל בקשה שמועברת מה-workers"""
+
+    def log_request(self, *args):
+        pass
+
+
+def run_ingest():
+    """
+    לולאת ה-ingest: מרעננת את כל האזורים כל SNAPSHOT_TTL_SECONDS ומפרסמת
+    לקבצים המשותפים. רץ כתהליך יחיד לצד ה-workers (ראו gunicorn.conf.py).
+    במקביל מגיש ב-INGEST_HTTP_ADDRESS את נקודות הקצה שה-workers מעבירים אליו
+    (served_by_ingest).
+    """
+    store.become_ingest()
+    # create_app מחבר את המאזינים ומפרסם מיד ל-workers את ה-snapshot השמור
+    internal_app = create_app()
+    host, _, port = INGEST_HTTP_ADDRESS.rpartition(":")
+    server = make_server(host, int(port), internal_app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name="ingest-http", daemon=True).start()
+    print(f"ingest: מפרסם {list(store.sources)} ל-{SHARED_SNAPSHOT_DIR}, מגיש ב-{INGEST_HTTP_ADDRESS}")
+    while True:
+        started = time.monotonic()
+        # ה-workers לא מרעננים טבלאות ייחוס בעצמם - רק קוראים את ה-cache שנכתב כאן
+        airlines.maybe_refresh()
+        airports.maybe_refresh()
+        for region in store.sources:
+            try:
+                store.get(region)
+            except UpstreamUnavailable as e:
+                print(f"ingest: {region} לא זמין ({e.reason})")
+        time.sleep(max(0.5, store.ttl - (time.monotonic() - started)))
+
+
+def run_seed_tiles(top_left: Tuple[float, float], bottom_right: Tuple[float, float], min_zoom: int, max_zoom: int):
+    """
+    טעינה מראש של כל האריחים של האזור ל-cache (אריחים טריים מדולגים).
+    שימו לב למדיניות השימוש של שרת האריחים - לא לזרוע זומים גבוהים על אזור גדול.
+    """
+    tiles = [(z, x, y) for z in range(min_zoom, max_zoom + 1) for x, y in tiles_for_bbox(top_left, bottom_right, z)]
+    print(f"seed-tiles: {len(tiles)} אריחים, זום {min_zoom}-{max_zoom}", file=sys.stderr)
+
+    def seed(tile):
+        try:
+            return tile_cache.get(*tile)[1]
+        except (urllib.error.URLError, OSError) as e:
+            print(f"seed-tiles: {tile} נכשל ({e})", file=sys.stderr)
+            return "failed"
+
+    done = Counter()
+    with ThreadPoolExecutor(max_workers=TILE_UPSTREAM_CONCURRENCY) as pool:
+        for i, source in enumerate(pool.map(seed, tiles), 1):
+            done[source] += 1
+            if i % 100 == 0 or i == len(tiles):
+                print(f"seed-tiles: {i}/{len(tiles)} {dict(done)}", file=sys.stderr)
+
+
+class NdjsonWriter:
+    """
+    כתיבת רשומות NDJSON (שורה לכל רשומה) ל-stream או לקובץ מתחלף:
+    כשהקובץ מגיע ל-max_bytes הוא עובר ל-<path>.1 (והקודמים ל-.2 ...), עד backups קבצים.
+    """
+
+    def __init__(self, path: str = None, stream=None, max_bytes: int = 0, backups: int = 5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = stream
+        self._size = 0
+        if path is not None:
+            self._open()
+
+    def write(self, record: Dict):
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line.encode("utf-8"))
+
+    def rotate_if_needed(self) -> bool:
+        """
+        Returns:
+            True אם התחיל קובץ חדש (הרשומה הבאה היא הראשונה בו)
+        """
+        if self.path is None or not self.max_bytes or self._size < self.max_bytes:
+            return False
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+        return True
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def close(self):
+        if self.path is not None:
+            self._file.close()
+
+
+def track_record(snapshot: Snapshot, previous: Snapshot = None) -> Dict:
+    """רשומה אחת של run_track: snapshot מלא, או diff מול previous אם יש"""
+    if previous is None:
+        return {"type": "snapshot", "fetched_at": snapshot.fetched_at, "flights": snapshot.flights}
+    before, after = previous.by_id(), snapshot.by_id()
+    added, removed, _ = snapshot_diff(before, after)
+    return {
+        "type": "diff",
+        "fetched_at": snapshot.fetched_at,
+        "added": [after[flight_id] for flight_id in added],
+        "updated": [flight for flight_id, flight in after.items()
+                    if flight_id in before and before[flight_id] != flight],
+        "removed": removed,
+    }
+
+
+def run_track(top_left: Tuple[float, float], bottom_right: Tuple[float, float], interval: float,
+              duration: float = None, output: str = None, mode: str = "diff",
+              max_bytes: int = 0, backups: int = 5):
+    """
+    מעקב רציף בלי שרת ה-web: כל interval שניות מושכים את האזור וכותבים NDJSON.
+
+    mode="snapshot" - כל רשומה היא snapshot מלא:
+        {"type": "snapshot", "fetched_at": ..., "flights": [...]}
+    mode="diff" - snapshot מלא בהתחלה (ובתחילת כל קובץ אחרי החלפה), ואחר כך רק שינויים:
+        {"type": "diff", "fetched_at": ..., "added": [...], "updated": [...], "removed": [ids]}
+
+    בזיכרון נשמר רק ה-snapshot הקודם. סבב שבו ה-upstream לא זמין לא נכתב.
+    ה-NDJSON הולך ל-stdout (או ל-output); הודעות (שגיאות upstream וכו') ל-stderr.
+    """
+    writer = NdjsonWriter(output, sys.stdout, max_bytes, backups)
+    tracking = SnapshotStore(
+        tracker,
+        {"track": (top_left, bottom_right)},
+        limiter=TokenBucket(UPSTREAM_RATE_PER_SECOND, UPSTREAM_BURST),
+        breaker=CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_BASE_BACKOFF_SECONDS, BREAKER_MAX_BACKOFF_SECONDS),
+        ttl=0.0,
+        receiver=receiver,
+    )
+    deadline = None if duration is None else time.monotonic() + duration
+    previous = None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                snapshot, stale = tracking.get("track")
+            except UpstreamUnavailable as e:
+                snapshot, stale = None, True
+                print(f"track: upstream לא זמין ({e.reason})", file=sys.stderr)
+            if snapshot is not None and not stale and snapshot is not previous:
+                if writer.rotate_if_needed():
+                    # קובץ חדש מתחיל ב-snapshot מלא כדי שאפשר יהיה לשחזר ממנו לבד
+                    previous = None
+                writer.write(track_record(snapshot, previous if mode == "diff" else None))
+                previous = snapshot
+            remaining = interval - (time.monotonic() - started)
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+            if remaining > 0:
+                time.sleep(remaining)
+    except (KeyboardInterrupt, BrokenPipeError):
+        # Ctrl-C או צרכן שנסגר (למשל | head) - יציאה שקטה
+        pass
+    finally:
+        writer.close()
+
+
+def parse_bbox(value: str) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    """"top_lat,left_lon,bottom_lat,right_lon" -> (top_left, bottom_right)"""
+    try:
+        top, left, bottom, right = (float(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected top_lat,left_lon,bottom_lat,right_lon")
+    if not (bottom < top and left < right):
+        raise argparse.ArgumentTypeError("top must be north of bottom and left west of right")
+    return (top, left), (bottom, right)
 
-if __name__ == "__main__":
-    main()
 
 if __name__ == "__main__":
-    # להאזין לכל הממשק (אם תרצה להיכנס ממחשב אחר ברשת)
-    # app.run(host="0.0.0.0", port=5000, debug=True)
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description="מפת מטוסים")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="שרת ה-web (ברירת מחדל)")
+    commands.add_parser("ingest", help="תהליך ingest יחיד לפריסה מרובת workers (דורש RADAR_SHARED_DIR)")
+    track = commands.add_parser("track", help="מעקב רציף בלי שרת: NDJSON ל-stdout או לקובץ")
+    track.add_argument("--bbox", type=parse_bbox, default=(AREA_TOP_LEFT, AREA_BOTTOM_RIGHT),
+                       help="top_lat,left_lon,bottom_lat,right_lon (ברירת מחדל: האזור של /data)")
+    track.add_argument("--interval", type=float, default=SNAPSHOT_TTL_SECONDS, help="שניות בין משיכות")
+    track.add_argument("--duration", type=float, default=None, help="כמה שניות לרוץ (ברירת מחדל: בלי הגבלה)")
+    track.add_argument("--output", default=None, help="קובץ פלט (ברירת מחדל: stdout)")
+    track.add_argument("--mode", choices=("diff", "snapshot"), default="diff")
+    track.add_argument("--max-bytes", type=int, default=100 * 1024 * 1024,
+                       help="גודל קובץ לפני החלפה (0 - בלי החלפה)")
+    track.add_argument("--backups", type=int, default=5, help="כמה קבצים ישנים לשמור")
+    seed = commands.add_parser("seed-tiles", help="טעינה מראש של אריחי המפה של האזור ל-cache")
+    seed.add_argument("--bbox", type=parse_bbox, default=(AREA_TOP_LEFT, AREA_BOTTOM_RIGHT),
+                      help="top_lat,left_lon,bottom_lat,right_lon (ברירת מחדל: האזור של /data)")
+    seed.add_argument("--min-zoom", type=int, default=7)
+    seed.add_argument("--max-zoom", type=int, default=12)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        run_ingest()
+    elif args.command == "seed-tiles":
+        run_seed_tiles(*args.bbox, min_zoom=args.min_zoom, max_zoom=min(args.max_zoom, TILE_MAX_ZOOM))
+    elif args.command == "track":
+        # SnapshotStore דורש שכל האריחים של רענון ייכנסו ב-burst (ראו _reserve_tiles)
+        tile_count = len(split_tiles(*args.bbox, TILE_MAX_DEGREES))
+        if tile_count > UPSTREAM_BURST:
+            parser.error(f"--bbox needs {tile_count} upstream tiles per refresh, "
+                         f"more than UPSTREAM_BURST ({UPSTREAM_BURST}); use a smaller area")
+        run_track(*args.bbox, interval=args.interval, duration=args.duration, output=args.output,
+                  mode=args.mode, max_bytes=args.max_bytes, backups=args.backups)
+    else:
+        # להאזין לכל הממשק (אם תרצה להיכנס ממחשב אחר ברשת)
+        # create_app().run(host="0.0.0.0", port=5000, debug=True)
+        create_app().run(debug=True)
@@ -0,0 +1,33 @@
+# פריסה מרובת workers עם תהליך ingest יחיד:
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# תהליך ה-ingest הוא היחיד שפונה ל-FlightRadar24 ומפרסם snapshots לקבצים
+# ממופי זיכרון ב-RADAR_SHARED_DIR; כל ה-workers קוראים משם, כך שהוספת
+# workers לא מכפילה את התעבורה ל-upstream.
+# נקודות קצה עם מצב מצטבר (/events, /stats, /heatmap, /flight) מוגשות רק
+# על ידי ה-ingest: ה-workers מעבירים אותן אליו ב-RADAR_INGEST_ADDR.
+import multiprocessing
+import os
+import subprocess
+import sys
+
+os.environ.setdefault("RADAR_SHARED_DIR", "/dev/shm/radar")
+
+bind = os.environ.get("RADAR_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("RADAR_WORKERS", multiprocessing.cpu_count()))
+threads = 4
+
+_ingest = None
+
+
+def on_starting(server):
+    global _ingest
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    _ingest = subprocess.Popen([sys.executable, app_path, "ingest"])
+    server.log.info("ingest process started (pid %s)", _ingest.pid)
+
+
+def on_exit(server):
+    if _ingest is not None and _ingest.poll() is None:
+        _ingest.terminate()
+        _ingest.wait(timeout=10)
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# app.py יושב בשורש הריפו (אין חבילה)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_flight():
+    """טיסה בצורה של get_flights_in_area, עם ערכי ברירת מחדל"""
+    def make(flight_id, latitude=32.0, longitude=35.0, **fields):
+        flight = {
+            'id': flight_id,
+            'callsign': 'ELY1',
+            'registration': 'N/A',
+            'aircraft': 'B738',
+            'airline': 'ELY',
+            'origin': 'N/A',
+            'destination': 'N/A',
+            'latitude': latitude,
+            'longitude': longitude,
+            'altitude': 30000,
+            'speed': 450,
+            'heading': 90,
+            'vertical_speed': 0,
+            'icao_24bit': 'N/A',
+            'position_time': 0,
+        }
+        flight.update(fields)
+        return flight
+
+    return make
@@ -0,0 +1,46 @@
+import json
+import time
+
+import pytest
+
+import app
+
+TOP_LEFT, BOTTOM_RIGHT = (33.0, 34.0), (31.0, 36.0)
+
+
+def aircraft_json(tmp_path, document):
+    path = tmp_path / "aircraft.json"
+    path.write_text(json.dumps(document), encoding="utf-8")
+    return app.LocalReceiver(str(path))
+
+
+def entry(hex_id, **fields):
+    return dict({"hex": hex_id, "flight": "ISR1", "lat": 32.0, "lon": 35.0, "seen": 0, "seen_pos": 0}, **fields)
+
+
+def test_reads_aircraft_in_the_area(tmp_path):
+    receiver = aircraft_json(tmp_path, {"now": time.time(), "aircraft": [entry("44aa11"), entry("44aa12", lat=40.0)]})
+    found = receiver.aircraft(TOP_LEFT, BOTTOM_RIGHT)
+    assert [a['icao_24bit'] for a in found] == ["44AA11"]
+    # שלוש האותיות הראשונות של אות הקריאה
+    assert found[0]['airline'] == "ISR"
+    assert receiver.errors == 0
+
+
+@pytest.mark.parametrize("document", [[1, 2], {"now": "abc", "aircraft": []}, {"now": 0, "aircraft": 5}])
+def test_bad_document_counts_an_error(tmp_path, document):
+    receiver = aircraft_json(tmp_path, document)
+    assert receiver.aircraft(TOP_LEFT, BOTTOM_RIGHT) is None
+    assert receiver.errors == 1
+
+
+def test_bad_entries_are_skipped(tmp_path):
+    receiver = aircraft_json(tmp_path, {"now": time.time(), "aircraft": [
+        entry("44aa11"),
+        "not an object",
+        entry("44aa12", lat="north"),
+        entry("44aa13", seen="recently"),
+    ]})
+    found = receiver.aircraft(TOP_LEFT, BOTTOM_RIGHT)
+    assert [a['icao_24bit'] for a in found] == ["44AA11"]
+    assert receiver.errors == 3
@@ -0,0 +1,72 @@
+import app
+
+
+def receiver(hex_id, latitude=32.5, longitude=34.9, measured_at=200.0, **fields):
+    """מטוס מהמקלט, בצורה של receiver_aircraft"""
+    aircraft = {
+        'icao_24bit': hex_id,
+        'callsign': 'N/A',
+        'registration': 'N/A',
+        'aircraft': 'N/A',
+        'airline': 'N/A',
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': 12000,
+        'speed': 300,
+        'heading': 180,
+        'vertical_speed': -500,
+        'position_time': measured_at,
+        'state_time': measured_at,
+    }
+    aircraft.update(fields)
+    return aircraft
+
+
+def test_newer_receiver_position_wins(make_flight):
+    flights = [make_flight("fr1", icao_24bit="4X1234", position_time=100.0, origin="TLV")]
+    merged = app.merge_receiver(flights, 110.0, [receiver("4X1234", callsign="ELY9")])
+
+    assert len(merged) == 1
+    flight = merged[0]
+    assert (flight['latitude'], flight['longitude'], flight['altitude'], flight['heading']) == (32.5, 34.9, 12000, 180)
+    assert flight['position_time'] == 200.0
+    # שדות של FlightRadar24 נשארים
+    assert flight['origin'] == "TLV" and flight['callsign'] == "ELY1"
+    # הקלט לא משתנה
+    assert flights[0]['latitude'] == 32.0
+
+
+def test_older_receiver_position_is_ignored(make_flight):
+    flights = [make_flight("fr1", icao_24bit="4X1234", position_time=100.0)]
+    merged = app.merge_receiver(flights, 110.0, [receiver("4X1234", measured_at=50.0)])
+    assert merged[0]['latitude'] == 32.0 and merged[0]['altitude'] == 30000
+
+
+def test_match_by_registration_and_fill_missing_fields(make_flight):
+    flights = [make_flight("fr1", registration="4X-EKA", aircraft='N/A', position_time=100.0)]
+    local = [receiver("ABCDEF", registration="4x-eka", aircraft="B789", altitude=None)]
+    merged = app.merge_receiver(flights, 110.0, local)
+
+    assert len(merged) == 1
+    flight = merged[0]
+    assert flight['aircraft'] == "B789"
+    assert flight['icao_24bit'] == "ABCDEF"
+    # המקלט לא דיווח גובה - נשאר של FlightRadar24
+    assert flight['altitude'] == 30000 and flight['latitude'] == 32.5
+
+
+def test_unmatched_receiver_aircraft_is_added(make_flight):
+    flights = [make_flight("fr1", icao_24bit="4X1234")]
+    merged = app.merge_receiver(flights, 110.0, [receiver("44AA11", callsign="ISR123")])
+
+    assert [flight['id'] for flight in merged] == ["fr1", app.AIRCRAFT_ID_PREFIX + "44aa11"]
+    local = merged[1]
+    assert local['origin'] == 'N/A' and local['upstream_id'] == 'N/A'
+    assert local['callsign'] == "ISR123"
+
+
+def test_drop_upstream_only_flights(make_flight):
+    flights = [make_flight("fr1", icao_24bit="4X1234"), make_flight("fr2", icao_24bit="4X9999")]
+    merged = app.merge_receiver(flights, 110.0, [receiver("4X1234"), receiver("44AA11")],
+                                keep_unmatched=False)
+    assert [flight['id'] for flight in merged] == ["fr1", app.AIRCRAFT_ID_PREFIX + "44aa11"]
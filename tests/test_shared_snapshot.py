@@ -0,0 +1,50 @@
+import struct
+
+import pytest
+
+import app
+
+
+def test_missing_file_reads_as_empty(tmp_path):
+    shared = app.SharedSnapshotFile(str(tmp_path / "snapshot.bin"))
+    assert shared.read() is None
+    assert shared.generation() == 0
+
+
+def test_write_read_round_trip(tmp_path, make_flight):
+    path = str(tmp_path / "snapshot.bin")
+    writer = app.SharedSnapshotFile(path, capacity=64 * 1024)
+    flights = [make_flight("a1", callsign="אל על"), make_flight("b2", latitude=31.5)]
+
+    generation = writer.write(flights, fetched_at=1700000000.5)
+    assert generation % 2 == 0 and generation > 0
+
+    # קורא בתהליך אחר פותח את הקובץ מחדש
+    reader = app.SharedSnapshotFile(path, capacity=64 * 1024)
+    assert reader.generation() == generation
+    assert reader.read() == (flights, 1700000000.5, generation)
+
+    newer = writer.write(flights[:1], fetched_at=1700000010.0)
+    assert newer == generation + 2
+    assert reader.read() == (flights[:1], 1700000010.0, newer)
+
+
+def test_reader_waits_out_a_write_in_progress(tmp_path, make_flight, monkeypatch):
+    path = str(tmp_path / "snapshot.bin")
+    shared = app.SharedSnapshotFile(path, capacity=64 * 1024)
+    shared.write([make_flight("a1")], fetched_at=1.0)
+    # generation אי-זוגי = באמצע כתיבה
+    struct.pack_into("<Q", shared._mm, 8, 3)
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: None)
+    with pytest.raises(app.UpstreamUnavailable):
+        shared.read(retries=3)
+
+    # כותב שמתחיל מ-generation אי-זוגי (נפל באמצע) ממשיך ממנו
+    assert shared.write([make_flight("b2")], fetched_at=2.0) == 4
+    assert shared.read()[0][0]['id'] == "b2"
+
+
+def test_snapshot_larger_than_file_is_rejected(tmp_path, make_flight):
+    shared = app.SharedSnapshotFile(str(tmp_path / "snapshot.bin"), capacity=256)
+    with pytest.raises(ValueError):
+        shared.write([make_flight(str(i)) for i in range(10)], fetched_at=1.0)
@@ -0,0 +1,185 @@
+import http.server
+import os
+import threading
+import time
+import urllib.error
+
+import pytest
+from flask import Flask
+
+import app
+
+TILE_SIZE = 1000
+
+
+@pytest.fixture
+def tile_server(monkeypatch):
+    """שרת אריחים מקומי. state['status'] קובע מה הוא מחזיר, state['requests'] סופר בקשות"""
+    monkeypatch.setenv("no_proxy", "127.0.0.1")
+    state = {"status": 200, "requests": 0, "delay": 0.0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"] += 1
+            time.sleep(state["delay"])
+            if state["status"] != 200:
+                self.send_response(state["status"])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = self.path.encode().ljust(TILE_SIZE, b".")
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def make_cache(tile_server, directory, max_bytes=10 * TILE_SIZE, max_age=3600):
+    return app.TileCache(tile_server["url"], str(directory), max_bytes, max_age, timeout=5)
+
+
+def test_miss_then_hit(tile_server, tmp_path):
+    cache = make_cache(tile_server, tmp_path)
+
+    data, source = cache.get(7, 76, 52)
+    assert source == "miss"
+    assert data.startswith(b"/7/76/52.png")
+    assert os.path.exists(cache.path(7, 76, 52))
+
+    again, source = cache.get(7, 76, 52)
+    assert source == "hit"
+    assert again == data
+    assert tile_server["requests"] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_tile_is_fetched_again(tile_server, tmp_path):
+    cache = make_cache(tile_server, tmp_path, max_age=0)
+    cache.get(7, 76, 52)
+    _, source = cache.get(7, 76, 52)
+    assert source == "miss"
+    assert tile_server["requests"] == 2
+
+
+def test_upstream_error_without_copy_raises(tile_server, tmp_path):
+    tile_server["status"] = 500
+    cache = make_cache(tile_server, tmp_path)
+    with pytest.raises(urllib.error.HTTPError):
+        cache.get(7, 76, 52)
+    assert not os.path.exists(cache.path(7, 76, 52))
+
+
+def test_upstream_error_serves_stale_copy(tile_server, tmp_path):
+    cache = make_cache(tile_server, tmp_path, max_age=0)
+    data, _ = cache.get(7, 76, 52)
+
+    tile_server["status"] = 503
+    stale, source = cache.get(7, 76, 52)
+    assert source == "stale"
+    assert stale == data
+
+
+def test_eviction_removes_least_recently_served(tile_server, tmp_path):
+    cache = make_cache(tile_server, tmp_path, max_bytes=3.5 * TILE_SIZE)
+    for y in (1, 2, 3):
+        cache.get(7, 76, y)
+    # atime קובע את סדר ה-LRU: 2 הוגש הכי מזמן
+    now = time.time()
+    for y, ago in ((1, 100), (2, 300), (3, 200)):
+        path = cache.path(7, 76, y)
+        os.utime(path, (now - ago, os.stat(path).st_mtime))
+
+    cache.get(7, 76, 4)
+
+    assert not os.path.exists(cache.path(7, 76, 2))
+    for y in (1, 3, 4):
+        assert os.path.exists(cache.path(7, 76, y))
+
+
+def test_concurrent_misses_share_one_download(tile_server, tmp_path):
+    tile_server["delay"] = 0.3
+    cache = make_cache(tile_server, tmp_path)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def fetch():
+        barrier.wait()
+        results.append(cache.get(7, 76, 52))
+
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert tile_server["requests"] == 1
+    assert len(results) == 8
+    assert len({data for data, _ in results}) == 1
+    assert cache.misses == 1
+
+
+@pytest.fixture
+def client(tile_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "tile_cache", make_cache(tile_server, tmp_path))
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(app.bp)
+    return flask_app.test_client()
+
+
+def test_tiles_route_serves_through_cache(client, tile_server):
+    response = client.get("/tiles/7/76/52.png")
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.data.startswith(b"/7/76/52.png")
+    assert "max-age" in response.headers["Cache-Control"]
+
+    assert client.get("/tiles/7/76/52.png").data == response.data
+    assert tile_server["requests"] == 1
+
+
+def test_tiles_route_rejects_tiles_outside_the_zoom(client, tile_server):
+    assert client.get(f"/tiles/7/{2 ** 7}/0.png").status_code == 404
+    assert client.get(f"/tiles/{app.TILE_MAX_ZOOM + 1}/0/0.png").status_code == 404
+    assert tile_server["requests"] == 0
+
+
+def test_tiles_route_upstream_errors(client, tile_server):
+    tile_server["status"] = 404
+    assert client.get("/tiles/7/76/52.png").status_code == 404
+    tile_server["status"] = 500
+    assert client.get("/tiles/7/76/53.png").status_code == 502
+
+
+def test_seed_tiles_fills_the_cache_once(tile_server, tmp_path, monkeypatch):
+    cache = make_cache(tile_server, tmp_path, max_bytes=1000 * TILE_SIZE)
+    monkeypatch.setattr(app, "tile_cache", cache)
+    top_left, bottom_right = (32.5, 34.5), (31.5, 35.5)
+    expected = [(z, x, y) for z in (7, 8) for x, y in app.tiles_for_bbox(top_left, bottom_right, z)]
+
+    app.run_seed_tiles(top_left, bottom_right, min_zoom=7, max_zoom=8)
+    assert tile_server["requests"] == len(expected)
+    for tile in expected:
+        assert os.path.exists(cache.path(*tile))
+
+    # אריחים טריים לא נטענים שוב
+    app.run_seed_tiles(top_left, bottom_right, min_zoom=7, max_zoom=8)
+    assert tile_server["requests"] == len(expected)
+
+
+def test_seed_tiles_keeps_going_after_a_failure(tile_server, tmp_path, monkeypatch, capsys):
+    tile_server["status"] = 500
+    monkeypatch.setattr(app, "tile_cache", make_cache(tile_server, tmp_path))
+    app.run_seed_tiles((32.5, 34.5), (31.5, 35.5), min_zoom=7, max_zoom=7)
+    assert "failed" in capsys.readouterr().err
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import app
+
+
+def test_token_bucket_burst_then_empty():
+    bucket = app.TokenBucket(rate=1.0, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() > 0
+
+
+def test_token_bucket_refills_over_time():
+    bucket = app.TokenBucket(rate=100.0, capacity=1)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.acquire(timeout=0.5)
+
+
+def test_token_bucket_acquire_gives_up_after_timeout():
+    bucket = app.TokenBucket(rate=0.1, capacity=1)
+    bucket.try_acquire()
+    started = time.monotonic()
+    assert not bucket.acquire(timeout=0.05)
+    # לא מחכים כשברור שהאסימון לא יגיע בזמן
+    assert time.monotonic() - started < 0.05
+
+
+def test_token_bucket_multiple_tokens():
+    bucket = app.TokenBucket(rate=0.0, capacity=5)
+    assert not bucket.try_acquire(6)
+    assert bucket.try_acquire(5)
+    assert bucket.wait_time() == float("inf")
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = app.CircuitBreaker(failure_threshold=2, base_backoff=60, max_backoff=600)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_in() > 0
+
+
+def test_circuit_breaker_half_open_allows_one_probe(monkeypatch):
+    breaker = app.CircuitBreaker(failure_threshold=1, base_backoff=10, max_backoff=600)
+    breaker.record_failure()
+    later = time.monotonic() + 100
+    monkeypatch.setattr(app.time, "monotonic", lambda: later)
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.retry_in() == 0.0
+
+
+def test_circuit_breaker_backoff_doubles_on_failed_probe(monkeypatch):
+    monkeypatch.setattr(app.random, "uniform", lambda low, high: 1.0)
+    breaker = app.CircuitBreaker(failure_threshold=1, base_backoff=10, max_backoff=15)
+    breaker.record_failure()
+    assert breaker.retry_in() == pytest.approx(10, abs=0.5)
+
+    breaker._open_until = 0.0
+    assert breaker.allow()
+    breaker.record_failure()
+    # 20 שניות, חסום ב-max_backoff
+    assert breaker.state == "open"
+    assert breaker.retry_in() == pytest.approx(15, abs=0.5)
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+from flask import Flask
+
+import app
+
+BOUNDS = (31.0, 34.0, 33.0, 36.0)  # south, west, north, east
+FIELDS = ("id", "lat", "lng")
+
+
+def snapshot(flights, generation):
+    return app.Snapshot(flights, fetched_at=0.0, generation=generation)
+
+
+def ids(items):
+    return sorted(json.loads(item)["id"] for item in items)
+
+
+def test_first_poll_is_full(make_flight):
+    subscriptions = app.ViewportSubscriptions()
+    flights = [make_flight("a"), make_flight("b", latitude=32.5), make_flight("out", latitude=40.0)]
+    result = subscriptions.poll(None, snapshot(flights, 1), BOUNDS, FIELDS)
+
+    assert result["full"]
+    assert ids(result["upsert"]) == ["a", "b"]
+    assert result["remove"] == []
+    assert len(subscriptions) == 1
+
+
+def test_poll_sends_only_changes(make_flight):
+    subscriptions = app.ViewportSubscriptions()
+    first = subscriptions.poll(None, snapshot([make_flight("a"), make_flight("b"), make_flight("c")], 1),
+                               BOUNDS, FIELDS)
+
+    # a לא זז, b זז, c יצא מהחלון, d נכנס
+    flights = [make_flight("a"), make_flight("b", latitude=32.1), make_flight("c", latitude=40.0), make_flight("d")]
+    result = subscriptions.poll(first["sub"], snapshot(flights, 2), BOUNDS, FIELDS)
+
+    assert result["sub"] == first["sub"]
+    assert not result["full"]
+    assert ids(result["upsert"]) == ["b", "d"]
+    assert result["remove"] == ["c"]
+
+    again = subscriptions.poll(first["sub"], snapshot(flights, 2), BOUNDS, FIELDS)
+    assert again["upsert"] == [] and again["remove"] == []
+
+
+def test_moving_the_viewport_removes_what_left_it(make_flight):
+    subscriptions = app.ViewportSubscriptions()
+    current = snapshot([make_flight("north", latitude=32.8), make_flight("south", latitude=31.2)], 1)
+    first = subscriptions.poll(None, current, BOUNDS, FIELDS)
+
+    result = subscriptions.poll(first["sub"], current, (32.0, 34.0, 33.0, 36.0), FIELDS)
+    assert result["upsert"] == []
+    assert result["remove"] == ["south"]
+
+
+def test_unknown_or_changed_subscription_starts_over(make_flight):
+    subscriptions = app.ViewportSubscriptions()
+    current = snapshot([make_flight("a")], 1)
+    first = subscriptions.poll(None, current, BOUNDS, FIELDS)
+
+    unknown = subscriptions.poll("no-such-sub", current, BOUNDS, FIELDS)
+    assert unknown["full"] and unknown["sub"] != first["sub"]
+
+    other_fields = subscriptions.poll(first["sub"], current, BOUNDS, ("id", "lat"))
+    assert other_fields["full"] and other_fields["sub"] != first["sub"]
+
+
+def test_oldest_subscription_is_dropped_over_the_limit(make_flight):
+    subscriptions = app.ViewportSubscriptions(max_subscriptions=2)
+    current = snapshot([make_flight("a")], 1)
+    first = subscriptions.poll(None, current, BOUNDS, FIELDS)
+    subscriptions.poll(None, current, BOUNDS, FIELDS)
+    subscriptions.poll(None, current, BOUNDS, FIELDS)
+
+    assert len(subscriptions) == 2
+    assert subscriptions.poll(first["sub"], current, BOUNDS, FIELDS)["full"]
+
+
+@pytest.mark.parametrize("bounds", ["nan,34,33,36", "31,34,inf,36", "33,34,31,36", "31,36,33,34", "31,34,33"])
+def test_bad_bounds_are_rejected(bounds):
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(app.bp)
+    response = flask_app.test_client().get(f"/viewport?bounds={bounds}")
+    assert response.status_code == 400